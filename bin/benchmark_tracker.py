@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+import argparse
+import time
+import yaml
+import numpy as np
+import pandas as pd
+import trackpy as tp
+from pcnaDeep.tracker import link_lap, close_gaps
+
+POS_COLUMNS = ['x', 'y', 'BF_mean', 'BF_std']
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark tracker linking backends on the same object tables.")
+    parser.add_argument(
+        "tables",
+        nargs='+',
+        help="Object tables (csv) with columns Center_of_the_object_0/1, BF_mean, BF_std and frame, "
+             "e.g. the `_tracks.csv` output.",
+    )
+    parser.add_argument(
+        "--pcna-config",
+        default="../config/pcnaCfg.yaml",
+        metavar="FILE",
+        help="path to pcnaDeep config file, TRACKER section is used",
+    )
+    parser.add_argument(
+        "--output",
+        help="Optional csv file to save the benchmark summary.",
+    )
+    return parser
+
+
+def get_links(f, particle):
+    """Links of a tracking result, as pairs of row positions consecutive in time within a track.
+    """
+    order = np.lexsort((f['frame'].values, particle))
+    same = particle[order][1:] == particle[order][:-1]
+    return set(zip(order[:-1][same].tolist(), order[1:][same].tolist()))
+
+
+def run_backends(f, tracker_cfg):
+    """Link one object table with every backend.
+
+    Returns:
+        list: one dict of summary per backend.
+    """
+    displace = float(tracker_cfg['DISPLACE'])
+    gap_fill = int(tracker_cfg['GAP_FILL'])
+    max_cost = tracker_cfg['MAX_COST']
+    lap_kw = {'search_range': displace, 'pos_columns': POS_COLUMNS,
+              'weights': [float(w) for w in tracker_cfg['FEATURE_WEIGHTS']],
+              'max_cost': None if max_cost is None else float(max_cost)}
+    backends = {
+        'trackpy': lambda: tp.link(f, search_range=displace, memory=gap_fill, adaptive_stop=0.4 * displace,
+                                   pos_columns=POS_COLUMNS),
+        'trackpy (memory 0)': lambda: tp.link(f, search_range=displace, memory=0, adaptive_stop=0.4 * displace,
+                                              pos_columns=POS_COLUMNS),
+        'lap': lambda: close_gaps(link_lap(f, **lap_kw), gap_fill=gap_fill, **lap_kw),
+        'lap (no gap closing)': lambda: link_lap(f, **lap_kw),
+    }
+    out = []
+    links = {}
+    for name, link in backends.items():
+        start = time.time()
+        try:
+            t = link()
+        except Exception as e:
+            out.append({'backend': name, 'time': time.time() - start, 'error': type(e).__name__ + ': ' + str(e)})
+            continue
+        elapsed = time.time() - start
+        # linking may reorder rows, align particle IDs back to the input table
+        particle = t['particle'].reindex(f.index).values
+        links[name] = get_links(f, particle)
+        out.append({'backend': name, 'time': elapsed, 'tracks': len(np.unique(particle)),
+                    'links': len(links[name]), 'error': ''})
+
+    # agreement with the default backend
+    ref = links.get('trackpy')
+    for rec in out:
+        if ref is not None and rec['backend'] in links:
+            shared = links[rec['backend']] & ref
+            rec['links_shared_with_trackpy'] = len(shared)
+            rec['jaccard_to_trackpy'] = len(shared) / max(len(links[rec['backend']] | ref), 1)
+    return out
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    with open(args.pcna_config, 'r') as file:
+        tracker_cfg = yaml.safe_load(file)['TRACKER']
+    tp.quiet()
+
+    summary = []
+    for path in args.tables:
+        table = pd.read_csv(path)
+        f = table[['Center_of_the_object_0', 'Center_of_the_object_1', 'BF_mean', 'BF_std', 'frame']].copy()
+        f.columns = POS_COLUMNS + ['frame']
+        f = f.reset_index(drop=True)
+        out = pd.DataFrame(run_backends(f, tracker_cfg))
+        out.insert(0, 'table', path)
+        out.insert(1, 'objects', f.shape[0])
+        out.insert(2, 'frames', len(np.unique(f['frame'])))
+        print(out.drop(columns='table').to_string(index=False))
+        summary.append(out)
+
+    summary = pd.concat(summary)
+    if args.output:
+        summary.to_csv(args.output, index=False)
@@ -1,26 +1,33 @@
 # -*- coding: utf-8 -*-
 import argparse
+import copy
 import multiprocessing as mp
 import os
+import queue
 import re
+import shutil
 import time
 import yaml
 import pprint
 import gc
+import itertools
 import numpy as np
 import pandas as pd
 import skimage.io as io
+import tifffile
 import torch
 from skimage.util import img_as_ubyte
 from detectron2.config import get_cfg
 from detectron2.utils.logger import setup_logger
-from pcnaDeep.predictor import VisualizationDemo, predictFrame
+from pcnaDeep.predictor import VisualizationDemo, predictStack
 from pcnaDeep.refiner import Refiner
 from pcnaDeep.resolver import Resolver
-from pcnaDeep.tracker import track
+from pcnaDeep.tracker import track, OnlineTracker, BACKENDS
+from pcnaDeep.cache import StageCache
+from pcnaDeep.journal import DetectJournal
 from pcnaDeep.split import split_frame, join_frame, join_table, resolve_joined_stack
-from pcnaDeep.data.utils import getDetectInput
-from tqdm import trange
+from pcnaDeep.data.utils import getDetectInput, TiffStack, DetectInputStack, MaskStore, WatchStack
+from tqdm import tqdm
 
 
 def setup_cfg(args):
@@ -46,10 +53,19 @@ def check_PCNA_cfg(config, img_shape):
             raise ValueError('Edge region should not be larger than image size or negative.')
         if float(config['SIZE_FLT']) > img_shape[1] * img_shape[2]:
             raise ValueError('Object size filter should not be larger than image size.')
+        if int(config['INFER_BATCH']) < 1:
+            raise ValueError('Inference batch size should be positive.')
         if float(config['TRACKER']['DISPLACE']) >= np.min([img_shape[1], img_shape[2]]):
             raise ValueError('Tracker displacement should be smaller than image size.')
         if float(config['TRACKER']['GAP_FILL']) >= img_shape[0]:
             raise ValueError('Tracker memory should be smaller than time frame length.')
+        if config['TRACKER']['BACKEND'] not in BACKENDS:
+            raise ValueError('Tracker backend should be one of ' + str(BACKENDS) + '.')
+        weights = config['TRACKER']['FEATURE_WEIGHTS']
+        if len(weights) != 4 or min([float(w) for w in weights]) < 0:
+            raise ValueError('Tracker feature weights should be 4 non-negative values.')
+        if config['TRACKER']['MAX_COST'] is not None and float(config['TRACKER']['MAX_COST']) <= 0:
+            raise ValueError('Tracker link cost cut-off should be positive.')
         for i in ['MAX_BG', 'MIN_S', 'MIN_M']:
             if float(config['POST_PROCESS'][i]) >= img_shape[0] or float(config['POST_PROCESS'][i]) <=0:
                 raise ValueError('Cell cycle phase length should be positive and smaller than frame length.')
@@ -63,6 +79,19 @@ def check_PCNA_cfg(config, img_shape):
         to_check = float(config['POST_PROCESS']['RESOLVER']['G2_TRH'])
         if to_check <= 0:
             raise ValueError('G2 intensity threshold should be positive.')
+        if int(config['POST_PROCESS']['RESOLVER']['WORKERS']) < 1:
+            raise ValueError('Number of resolver workers should be positive.')
+        tile = int(config['TILE']['SIZE'])
+        if tile < 0:
+            raise ValueError('Tile size should not be negative.')
+        if tile and (int(config['TILE']['OVERLAP']) < 0 or int(config['TILE']['OVERLAP']) >= tile):
+            raise ValueError('Tile overlap should be non-negative and smaller than the tile size.')
+        if tile and (float(config['TILE']['IOU_TRH']) <= 0 or float(config['TILE']['IOU_TRH']) > 1):
+            raise ValueError('Tile IoU threshold should be within range (0, 1].')
+        if tile and int(config['SPLIT']['GRID']):
+            raise ValueError('Tiled inference and split mode cannot be used together.')
+        if float(config['CACHE']['MAX_SIZE']) <= 0:
+            raise ValueError('Cache size limit should be positive.')
     except KeyError as e:
         raise KeyError('Field not found in config file: ' + str(e))
     return
@@ -107,6 +136,57 @@ def get_parser():
         default=0.5,
         help="Minimum score for instance predictions to be shown",
     )
+    parser.add_argument(
+        "--post-workers",
+        type=int,
+        default=0,
+        help="Number of processes to post-process detection in parallel with the model. Default 0, run sequentially.",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read input frame by frame and write mask to disk during detection, memory bounded to single frame. "
+             "Not compatible with split mode.",
+    )
+    parser.add_argument(
+        "--batch-workers",
+        type=int,
+        default=1,
+        help="Batch mode, number of worker processes each holding a model and detecting one movie at a time. "
+             "Tracking and post-processing of a movie run in a separate process while the next one is detected.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run, frames already in the detection journal of the output directory are not "
+             "detected again. In batch mode, movies done according to `batch_status.csv` are skipped. Implies "
+             "--journal.",
+    )
+    parser.add_argument(
+        "--journal",
+        action="store_true",
+        help="Write detection results to a journal in the output directory frame by frame, so that the run can be "
+             "continued with --resume if interrupted. Costs an extra write of the mask.",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Watch input directories of an ongoing acquisition, one TIFF file per time point, either composite "
+             "(--stack-input) or PCNA and bright field (--pcna and --bf). Frames are detected and tracked as they "
+             "land. Acquisition ends when a file named END appears in the (PCNA) directory.",
+    )
+    parser.add_argument(
+        "--watch-timeout",
+        type=float,
+        default=600,
+        help="Watch mode, end acquisition if no new frame comes within the time, in seconds.",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=int,
+        default=10,
+        help="Watch mode, write partial tracks every such number of frames.",
+    )
     parser.add_argument(
         "--opts",
         help="Modify pcnaDeep config options using the command-line 'KEY VALUE' pairs. For pcnaDeep config, "
@@ -117,15 +197,210 @@ def get_parser():
     return parser
 
 
-def main(stack, config, output, prefix, logger):
-    check_PCNA_cfg(config, stack.shape)
+def get_tracker_kw(config):
+    """Keyword arguments of `track()` and `OnlineTracker` from the TRACKER config, except the backend.
+    """
+    max_cost = config['TRACKER']['MAX_COST']
+    return {'displace': int(config['TRACKER']['DISPLACE']), 'gap_fill': int(config['TRACKER']['GAP_FILL']),
+            'weights': [float(w) for w in config['TRACKER']['FEATURE_WEIGHTS']],
+            'max_cost': None if max_cost is None else float(max_cost)}
 
-    logger.info("Run on image shape: " + str(stack.shape))
+
+def get_tile_kw(config):
+    """Tiled inference arguments of `predictStack()` from the TILE section of the pcnaDeep config.
+    """
+    return {'tile_size': int(config['TILE']['SIZE']), 'tile_overlap': int(config['TILE']['OVERLAP']),
+            'tile_iou': float(config['TILE']['IOU_TRH'])}
+
+
+STAGES = ['detect', 'track', 'refine', 'resolve']
+
+
+def get_stage_keys(config, files, model_key, content=True):
+    """Cache keys of pipeline stages, each from the key of the stage before and the config sections it depends on.
+
+    Args:
+        config (dict): pcnaDeep config.
+        files (list): input image files of the movie.
+        model_key (str): key of the detection model, see `get_model_key()`.
+        content (bool): identify input files by content, otherwise by path, size and modification time, see
+            `StageCache.stat_files()`.
+
+    Returns:
+        (dict): key of each stage in `STAGES`.
+    """
+    post_cfg = config['POST_PROCESS']
+    refiner_cfg = post_cfg['REFINER']
+    # the confidence threshold is part of the detectron2 config, hence of `model_key`
+    file_key = StageCache.hash_files if content else StageCache.stat_files
+    keys = {'detect': StageCache.make_key(file_key(files), model_key, config['PIX_SATURATE'],
+                                          config['GAMMA'], config['SIZE_FLT'], config['EDGE_FLT'], config['SPLIT'],
+                                          config['TILE'], config['RESOLVE_ON_DEVICE'])}
+    keys['track'] = StageCache.make_key(keys['detect'], config['TRACKER'])
+    svm_data = None
+    if refiner_cfg['MODE'] == 'SVM':
+        svm_data = file_key([refiner_cfg['SVM_TRAIN_DATA']])
+    keys['refine'] = StageCache.make_key(keys['track'], post_cfg['MAX_BG'], post_cfg['MIN_M'], refiner_cfg, svm_data)
+    resolver_cfg = {k: v for k, v in post_cfg['RESOLVER'].items() if k != 'WORKERS'}
+    keys['resolve'] = StageCache.make_key(keys['refine'], post_cfg['MAX_BG'], post_cfg['MIN_S'], post_cfg['MIN_M'],
+                                          resolver_cfg)
+    return keys
+
+
+def load_stages(cache, keys):
+    """Outputs of cached stages, from the first stage on until one is not cached.
+
+    Returns:
+        (dict): stage name to the output, see `StageCache.load()`.
+    """
+    hits = {}
+    if cache is None:
+        return hits
+    for stage in STAGES:
+        hit = cache.load(stage, keys[stage])
+        if hit is None:
+            break
+        hits[stage] = hit
+    return hits
+
+
+def stage_keys(cache, config, files, model_key, stream=False, journal=False):
+    """Keys of a movie, and whether input can be read lazily, i.e. when streaming or detection is cached.
+
+    Input is only hashed by content for the cache. The detect key also identifies the detection journal (see
+    `detect()`), without cache it is built from file stats so that the input is not read an extra time.
+
+    Args:
+        journal (bool): whether detection is journaled.
+
+    Returns:
+        (dict): key of each stage, None if neither cache nor journal is used.
+        (bool): whether to read input lazily.
+    """
+    if cache is None and not journal:
+        return None, stream
+    keys = get_stage_keys(config, files, model_key, content=cache is not None)
+    return keys, stream or (cache is not None and cache.contains('detect', keys['detect']))
+
+
+def get_model_key(cfg, content=True):
+    """Key of the detection model, from detectron2 config (including the confidence threshold) and model weights.
+
+    Args:
+        cfg (detectron2.config.CfgNode): detectron2 config.
+        content (bool): identify weights by content, otherwise by file stats, see `get_stage_keys()`.
+    """
+    weights = None
+    if os.path.isfile(cfg.MODEL.WEIGHTS):
+        weights = (StageCache.hash_files if content else StageCache.stat_files)([cfg.MODEL.WEIGHTS])
+    return StageCache.make_key(cfg.dump(), weights)
+
+
+def load_movie(files, config, lazy=False):
+    """Read a movie for detection, either a composite stack (one file) or PCNA and bright field stacks (two files).
+    """
+    if len(files) == 1:
+        # Input image must be uint8
+        return TiffStack(files[0]) if lazy else io.imread(files[0])
+    if lazy:
+        return DetectInputStack(TiffStack(files[0]), TiffStack(files[1]), sat=float(config['PIX_SATURATE']),
+                                gamma=float(config['GAMMA']))
+    return getDetectInput(io.imread(files[0]), io.imread(files[1]), sat=float(config['PIX_SATURATE']),
+                          gamma=float(config['GAMMA']), torch_gpu=True)
+
+
+def refine_resolve(track_out, config, output, prefix, logger, cache=None, keys=None, hits=None):
+    """Refine and resolve tracks, mask is read from `<prefix>_mask.tif` of the output directory if required.
+
+    Args:
+        cache (StageCache): optional, cache to save outputs of each stage.
+        keys (dict): cache key of each stage, see `get_stage_keys()`.
+        hits (dict): outputs of stages cached, see `load_stages()`.
+    """
+    logger.info('Refining and Resolving...')
+    hits = {} if hits is None else hits
+    post_cfg = config['POST_PROCESS']
+    if 'refine' in hits:
+        ann, track_rfd, mt_dic, imprecise = hits['refine'][0]
+    else:
+        ann, track_rfd, mt_dic, imprecise = refine(track_out, config, output, prefix, logger)
+        if cache is not None:
+            cache.save('refine', keys['refine'], (ann, track_rfd, mt_dic, imprecise))
+    ann.to_csv(os.path.join(output, prefix + '_tracks_ann.csv'), index=0)
+    logger.debug(pprint.pformat(mt_dic, indent=4))
+
+    if 'resolve' in hits:
+        track_rsd, phase = hits['resolve'][0]
+    else:
+        myResolver = Resolver(track_rfd, ann, mt_dic, maxBG=float(post_cfg['MAX_BG']), minS=float(post_cfg['MIN_S']),
+                              minM=float(post_cfg['MIN_M']),
+                              minLineage=int(post_cfg['RESOLVER']['MIN_LINEAGE']), impreciseExit=imprecise,
+                              G2_trh=int(post_cfg['RESOLVER']['G2_TRH']),
+                              workers=int(post_cfg['RESOLVER']['WORKERS']))
+        track_rsd, phase = myResolver.doResolve()
+        if cache is not None:
+            cache.save('resolve', keys['resolve'], (track_rsd, phase))
+    track_rsd.to_csv(os.path.join(output, prefix + '_tracks_refined.csv'), index=0)
+    phase.to_csv(os.path.join(output, prefix + '_phase.csv'), index=0)
+
+    return
+
+
+def refine(track_out, config, output, prefix, logger):
+    """Run the Refiner on tracks, see `refine_resolve()`.
+    """
+    post_cfg = config['POST_PROCESS']
+    refiner_cfg = post_cfg['REFINER']
+    if not bool(refiner_cfg['MASK_CONSTRAINT']['ENABLED']):
+        logger.info('Mask constraint disabled')
+        mask_out = None
+        df = None
+    else:
+        logger.info('Mask constraint enabled.')
+        df = float(refiner_cfg['MASK_CONSTRAINT']['DILATE_FACTOR'])
+        # read back from disk, frames are loaded on demand
+        mask_out = MaskStore(os.path.join(output, prefix + '_mask.tif'))
+    myRefiner = Refiner(track_out, threshold_mt_F=int(refiner_cfg['MAX_DIST_TRH']),
+                        threshold_mt_T=int(refiner_cfg['MAX_FRAME_TRH']), smooth=int(refiner_cfg['SMOOTH']),
+                        maxBG=float(post_cfg['MAX_BG']),
+                        minM=float(post_cfg['MIN_M']), search_range=int(refiner_cfg['SEARCH_RANGE']),
+                        sample_freq=float(refiner_cfg['SAMPLE_FREQ']),
+                        model_train=refiner_cfg['SVM_TRAIN_DATA'], svm_c=int(refiner_cfg['C']),
+                        mode=refiner_cfg['MODE'], mask=mask_out, dilate_factor=df, 
+                        aso_trh=float(refiner_cfg['ASO_TRH']), dist_weight=float(refiner_cfg['DIST_WEIGHT']),
+                        gate=bool(refiner_cfg['GATE']))
+    ann, track_rfd, mt_dic, imprecise = myRefiner.doTrackRefine()
+    if mask_out is not None:
+        mask_out.close()
+    del mask_out
+    gc.collect()
+    return ann, track_rfd, mt_dic, imprecise
+
+
+def journal_dir(output, prefix):
+    return os.path.join(output, prefix + '_journal')
+
+
+def detect(stack, config, output, prefix, logger, post_workers=0, stream=False, resume=False, journal=False,
+           journal_key=None):
+    """Detect objects of each frame and write the mask to `<prefix>_mask.tif` of the output directory.
+
+    With `journal` or `resume`, results of each frame are appended to a journal in the output directory as they come
+    (see `DetectJournal`). With `resume`, frames completed by an interrupted run are read back from it instead of
+    detected again. The journal is only resumed by a run of the same `journal_key`, i.e. the detect key of
+    `get_stage_keys()`.
+
+    Returns:
+        (pandas.DataFrame): object table.
+        (pandas.DataFrame): tracked object table if linked during detection with the online backend, otherwise None.
+    """
     table_out = pd.DataFrame()
     mask_out = []
     spl = int(config['SPLIT']['GRID'])
     edge_raw = config['EDGE_FLT']  # not filter edge objects when resolving separate tiles.
     if spl:
+        if stream:
+            raise ValueError('Split mode does not support streaming input.')
         config['EDGE_FLT'] = 0
         new_imgs = []
         for i in range(stack.shape[0]):
@@ -137,16 +412,49 @@ def main(stack, config, output, prefix, logger):
 
     edge = config['EDGE_FLT']
     size_flt = config['SIZE_FLT']
+    infer_batch = int(config['INFER_BATCH'])
+    on_device = bool(config['RESOLVE_ON_DEVICE'])
     instances_frame = []
+    if stream:
+        # write masks to disk as they are produced, only one frame resides in memory
+        mask_out = MaskStore(os.path.join(output, prefix + '_mask.tif'), shape=stack.shape[:3], dtype='uint16')
+    det_journal = None
+    start = 0
+    if journal or resume:
+        if resume and journal_key is None:
+            logger.warning('Cannot resume without the key of input, model and detection config, start over.')
+            resume = False
+        det_journal = DetectJournal(journal_dir(output, prefix), stack.shape[:3], key=journal_key)
+        start = det_journal.open(resume=resume)
+        if start:
+            logger.info('Resume from frame ' + str(start) + ' of the journal.')
+    online = None
+    track_out = None
+    if config['TRACKER']['BACKEND'] == 'online' and not spl:
+        # link each frame as soon as it is detected, tiles of split mode are only tracked after joined
+        online = OnlineTracker(**get_tracker_kw(config))
+        track_out = []
     start_time = time.time()
-    with trange(stack.shape[0], unit='img') as trg:
-        for i in trg:
-            img_relabel, out_props = predictFrame(stack[i,:], i, demo, edge_flt=edge, size_flt=size_flt)
+    remain = stack if start == 0 else (stack[j] for j in range(start, stack.shape[0]))
+    results = predictStack(remain, demo, edge_flt=edge, size_flt=size_flt, batch_size=infer_batch,
+                           num_workers=post_workers, resolve_on_device=on_device, start=start, **get_tile_kw(config))
+    if det_journal is not None:
+        results = itertools.chain(det_journal.replay(), results)
+    with tqdm(total=stack.shape[0], unit='img') as trg:
+        for i, img_relabel, out_props in results:
+            if det_journal is not None and i >= start:
+                det_journal.append(i, img_relabel, out_props)
+            if online is not None:
+                track_out.append(online.update(out_props, frame=i))
             table_out = table_out.append(out_props)
-            img_relabel = torch.from_numpy(img_relabel.astype('int16'))  # new
-            mask_out.append(img_relabel)
+            if stream:
+                mask_out[i] = img_relabel
+            else:
+                img_relabel = torch.from_numpy(img_relabel.astype('int16'))  # new
+                mask_out.append(img_relabel)
             trg.set_description('Frame %i' % i)
             trg.set_postfix(instances=str(out_props.shape[0]))
+            trg.update(1)
             instances_frame.append(out_props.shape[0])
 
     logger.info(
@@ -157,11 +465,16 @@ def main(stack, config, output, prefix, logger):
         )
     )
     
+    if det_journal is not None:
+        det_journal.close()
     tw = stack.shape[1]
     del stack
     gc.collect()
-    mask_out = torch.stack(mask_out, axis=0)
-    mask_out = mask_out.numpy()
+    if stream:
+        mask_out.flush()
+    else:
+        mask_out = torch.stack(mask_out, axis=0)
+        mask_out = mask_out.numpy()
 
     if spl:
         mask_out = join_frame(mask_out.copy(), n=spl)
@@ -171,47 +484,145 @@ def main(stack, config, output, prefix, logger):
                                                    dilate_time=config['SPLIT']['DILATE_ROUND'],
                                                    filter_edge_width=edge_raw)
     
-    logger.info('Tracking...')
-    track_out = track(df=table_out, displace=int(config['TRACKER']['DISPLACE']),
-                        gap_fill=int(config['TRACKER']['GAP_FILL']))
-    track_out.to_csv(os.path.join(output, prefix + '_tracks.csv'), index=False)
+    if online is not None:
+        online.finish()
+        track_out = pd.concat(track_out, ignore_index=True).sort_values(by=['trackId', 'frame'])
 
-    if np.max(mask_out) < 255:
-        mask_out = img_as_ubyte(mask_out)
-    io.imsave(os.path.join(output, prefix + '_mask.tif'), mask_out)
-
-    logger.info('Refining and Resolving...')
-    post_cfg = config['POST_PROCESS']
-    refiner_cfg = post_cfg['REFINER']
-    if not bool(refiner_cfg['MASK_CONSTRAINT']['ENABLED']):
-        logger.info('Mask constraint disabled')
-        mask_out = None
-        df = None
+    if not stream:
+        if np.max(mask_out) < 255:
+            mask_out = img_as_ubyte(mask_out)
+        io.imsave(os.path.join(output, prefix + '_mask.tif'), mask_out)
+        del mask_out
+        gc.collect()
     else:
-        logger.info('Mask constraint enabled.')
-        df = float(refiner_cfg['MASK_CONSTRAINT']['DILATE_FACTOR'])
-    myRefiner = Refiner(track_out, threshold_mt_F=int(refiner_cfg['MAX_DIST_TRH']),
-                        threshold_mt_T=int(refiner_cfg['MAX_FRAME_TRH']), smooth=int(refiner_cfg['SMOOTH']),
-                        maxBG=float(post_cfg['MAX_BG']),
-                        minM=float(post_cfg['MIN_M']), search_range=int(refiner_cfg['SEARCH_RANGE']),
-                        sample_freq=float(refiner_cfg['SAMPLE_FREQ']),
-                        model_train=refiner_cfg['SVM_TRAIN_DATA'], svm_c=int(refiner_cfg['C']),
-                        mode=refiner_cfg['MODE'], mask=mask_out, dilate_factor=df, 
-                        aso_trh=float(refiner_cfg['ASO_TRH']), dist_weight=float(refiner_cfg['DIST_WEIGHT']))
-    ann, track_rfd, mt_dic, imprecise = myRefiner.doTrackRefine()
-    del mask_out
+        mask_out.close()
+    return table_out, track_out
+
+
+def main(stack, config, output, prefix, logger, post_workers=0, stream=False, cache=None, keys=None, resume=False,
+         journal=False):
+    table_out, track_out, hits = main_detect(stack, config, output, prefix, logger, post_workers=post_workers,
+                                             stream=stream, cache=cache, keys=keys, resume=resume, journal=journal)
+    del stack
     gc.collect()
-    
-    ann.to_csv(os.path.join(output, prefix + '_tracks_ann.csv'), index=0)
-    logger.debug(pprint.pformat(mt_dic, indent=4))
+    main_post(table_out, track_out, hits, config, output, prefix, logger, cache=cache, keys=keys)
+    return
+
+
+def main_detect(stack, config, output, prefix, logger, post_workers=0, stream=False, cache=None, keys=None,
+                resume=False, journal=False):
+    """Detection stage of `main()`, the part using the model.
+
+    Returns:
+        (pandas.DataFrame): object table.
+        (pandas.DataFrame): tracked object table if already linked, otherwise None.
+        (dict): outputs of cached stages, see `load_stages()`.
+    """
+    check_PCNA_cfg(config, stack.shape)
+
+    logger.info("Run on image shape: " + str(stack.shape))
+    hits = load_stages(cache, keys)
+    mask_fp = os.path.join(output, prefix + '_mask.tif')
+    if 'detect' in hits:
+        table_out, files = hits['detect']
+        shutil.copyfile(files['mask.tif'], mask_fp)
+        track_out = None
+    else:
+        table_out, track_out = detect(stack, config, output, prefix, logger, post_workers=post_workers, stream=stream,
+                                      resume=resume, journal=journal,
+                                      journal_key=keys['detect'] if keys is not None else None)
+        if cache is not None:
+            cache.save('detect', keys['detect'], table_out, files={'mask.tif': mask_fp})
+    return table_out, track_out, hits
+
+
+def main_post(table_out, track_out, hits, config, output, prefix, logger, cache=None, keys=None):
+    """Stages of `main()` after detection: tracking, refinement and resolution, CPU only.
+
+    Args:
+        table_out, track_out, hits: outputs of `main_detect()`.
+    """
+    if 'track' in hits:
+        track_out = hits['track'][0]
+    else:
+        if track_out is None:
+            logger.info('Tracking...')
+            track_out = track(df=table_out, backend=config['TRACKER']['BACKEND'], **get_tracker_kw(config))
+        if cache is not None:
+            cache.save('track', keys['track'], track_out)
+    track_out.to_csv(os.path.join(output, prefix + '_tracks.csv'), index=False)
+
+    refine_resolve(track_out, config, output, prefix, logger, cache=cache, keys=keys, hits=hits)
+    # kept until here, so a run interrupted after detection resumes without detecting again
+    shutil.rmtree(journal_dir(output, prefix), ignore_errors=True)
+    logger.info(prefix + ' Finished: ' + time.strftime("%Y/%m/%d %H:%M:%S", time.localtime()))
+    logger.info('='*50)
+
+    return
 
-    myResolver = Resolver(track_rfd, ann, mt_dic, maxBG=float(post_cfg['MAX_BG']), minS=float(post_cfg['MIN_S']),
-                          minM=float(post_cfg['MIN_M']),
-                          minLineage=int(post_cfg['RESOLVER']['MIN_LINEAGE']), impreciseExit=imprecise,
-                          G2_trh=int(post_cfg['RESOLVER']['G2_TRH']))
-    track_rsd, phase = myResolver.doResolve()
-    track_rsd.to_csv(os.path.join(output, prefix + '_tracks_refined.csv'), index=0)
-    phase.to_csv(os.path.join(output, prefix + '_phase.csv'), index=0)
+
+def watch(stack, config, output, prefix, logger, post_workers=0, checkpoint=10):
+    """Process an ongoing acquisition, frames are detected and tracked as they land.
+
+    Masks are written to `<prefix>_mask.tif` as one contiguous BigTIFF series, the file is complete once watching
+    ends, also if interrupted. Objects linked are appended to `<prefix>_tracks.csv` every `checkpoint` frames in frame
+    order, the file is rewritten sorted by track once the acquisition ends. Tracks are then refined and resolved.
+
+    Args:
+        stack (WatchStack): frames of the acquisition.
+        checkpoint (int): number of frames between partial track outputs.
+    """
+    if int(config['SPLIT']['GRID']):
+        raise ValueError('Split mode does not support watch mode.')
+    if checkpoint < 1:
+        raise ValueError('Checkpoint interval should be positive.')
+    mask_fp = os.path.join(output, prefix + '_mask.tif')
+    tracks_fp = os.path.join(output, prefix + '_tracks.csv')
+    for fp in [mask_fp, tracks_fp]:
+        if os.path.exists(fp):
+            os.remove(fp)
+    tracker = OnlineTracker(**get_tracker_kw(config))
+    track_out = []
+    written = 0  # frames of track_out in the partial output
+    instances_frame = []
+
+    logger.info('Watching ' + ', '.join(stack.dirs))
+    start_time = time.time()
+    with tifffile.TiffWriter(mask_fp, bigtiff=True) as mask_writer, tqdm(unit='img') as trg:
+        for i, img_relabel, out_props in predictStack(stack, demo, edge_flt=config['EDGE_FLT'],
+                                                      size_flt=config['SIZE_FLT'],
+                                                      batch_size=int(config['INFER_BATCH']), num_workers=post_workers,
+                                                      resolve_on_device=bool(config['RESOLVE_ON_DEVICE']),
+                                                      **get_tile_kw(config)):
+            if i == 0:
+                # movie length is unknown
+                check_PCNA_cfg(config, (np.inf,) + img_relabel.shape)
+            mask_writer.write(img_relabel.astype('uint16'), contiguous=True, metadata=None)
+            track_out.append(tracker.update(out_props, frame=i))
+            if (i + 1) % checkpoint == 0:
+                # track IDs are final once linked, only objects since the last checkpoint are written
+                pd.concat(track_out[written:], ignore_index=True).to_csv(tracks_fp, mode='a', header=written == 0,
+                                                                         index=False)
+                written = len(track_out)
+            trg.set_description('Frame %i' % i)
+            trg.set_postfix(instances=str(out_props.shape[0]))
+            trg.update(1)
+            instances_frame.append(out_props.shape[0])
+
+    if not instances_frame:
+        raise ValueError('No frame found in ' + ', '.join(stack.dirs))
+    logger.info(
+        "{}: {} in {:.2f}s".format(
+            'Total frame '+str(len(instances_frame)),
+            "Mean detected instances: {}".format(np.mean(instances_frame)),
+            time.time() - start_time,
+        )
+    )
+    tracker.finish()
+    track_out = pd.concat(track_out, ignore_index=True).sort_values(by=['trackId', 'frame'])
+    track_out.to_csv(tracks_fp, index=False)
+
+    refine_resolve(track_out, config, output, prefix, logger)
 
     logger.info(prefix + ' Finished: ' + time.strftime("%Y/%m/%d %H:%M:%S", time.localtime()))
     logger.info('='*50)
@@ -219,6 +630,205 @@ def main(stack, config, output, prefix, logger):
     return
 
 
+def _post_movie(job, table_out, track_out, hits, config, cache, keys, log_fp, rank, result_queue):
+    """Post-detection stages of a batch movie, run in its own process, see `BatchWorker`.
+    """
+    logger = setup_logger(name='pcna', abbrev_name='pcna', output=log_fp, distributed_rank=rank)
+    start = time.time()
+    try:
+        main_post(table_out, track_out, hits, config, job['output'], job['prefix'], logger, cache=cache, keys=keys)
+        result_queue.put({'prefix': job['prefix'], 'status': 'done', 'stage': '', 'error': '',
+                          'post_time': time.time() - start})
+    except Exception as e:
+        logger.exception(job['prefix'] + ' failed in post-processing.')
+        result_queue.put({'prefix': job['prefix'], 'status': 'failed', 'stage': 'post',
+                          'error': type(e).__name__ + ': ' + str(e), 'post_time': time.time() - start})
+
+
+class BatchWorker(mp.Process):
+
+    def __init__(self, rank, cfg, config, task_queue, result_queue, log_fp, post_workers=0, stream=False,
+                 cache=None, model_key=None, resume=False, journal=False):
+        """Batch mode worker process, holds one model and detects movies taken from a queue.
+
+        The model is loaded once when the process starts. Tracking and post-processing of a movie run in a child
+        process, while the worker detects the next movie. Failure of a movie is reported to the result queue and does
+        not stop the worker.
+
+        Args:
+            rank (int): worker index from 1, logs are saved to `log_fp` suffixed by the rank.
+            cfg (detectron2.config.CfgNode): detectron2 config, see `setup_cfg()`.
+            config (dict): pcnaDeep config.
+            task_queue (multiprocessing.Queue): jobs, dict of `prefix`, `output` and input `files`, None to stop.
+            result_queue (multiprocessing.Queue): status of each movie, see `run_batch()`.
+            log_fp (str): log file.
+            post_workers (int): see `detect()`.
+            stream (bool): see `detect()`.
+            cache (StageCache): optional stage cache.
+            model_key (str): key of the model in the cache.
+            resume (bool): see `detect()`.
+            journal (bool): see `detect()`.
+        """
+        super().__init__(name='BatchWorker-' + str(rank))
+        self.rank = rank
+        self.cfg = cfg
+        self.config = config
+        self.task_queue = task_queue
+        self.result_queue = result_queue
+        self.log_fp = log_fp
+        self.post_workers = post_workers
+        self.stream = stream
+        self.cache = cache
+        self.model_key = model_key
+        self.resume = resume
+        self.journal = journal
+
+    def run(self):
+        global demo
+        logger = setup_logger(name='pcna', abbrev_name='pcna', output=self.log_fp, distributed_rank=self.rank)
+        demo = VisualizationDemo(self.cfg)
+        post = None
+        for job in iter(self.task_queue.get, None):
+            config = copy.deepcopy(self.config)
+            start = time.time()
+            try:
+                keys, lazy = stage_keys(self.cache, config, job['files'], self.model_key, self.stream,
+                                        journal=self.journal or self.resume)
+                imgs = load_movie(job['files'], config, lazy=lazy)
+                table_out, track_out, hits = main_detect(imgs, config, job['output'], job['prefix'], logger,
+                                                         post_workers=self.post_workers, stream=self.stream,
+                                                         cache=self.cache, keys=keys, resume=self.resume,
+                                                         journal=self.journal)
+                del imgs
+                gc.collect()
+            except Exception as e:
+                logger.exception(job['prefix'] + ' failed in detection.')
+                self.result_queue.put({'prefix': job['prefix'], 'status': 'failed', 'stage': 'detect',
+                                       'error': type(e).__name__ + ': ' + str(e),
+                                       'detect_time': time.time() - start, 'worker': self.rank})
+                continue
+            self.result_queue.put({'prefix': job['prefix'], 'status': 'detected', 'detect_time': time.time() - start,
+                                   'worker': self.rank})
+            # one movie in post-processing at a time, bounds memory held by pending tables
+            self._join(post)
+            post = (job, mp.Process(target=_post_movie, args=(job, table_out, track_out, hits, config, self.cache,
+                                                              keys, self.log_fp, self.rank, self.result_queue)))
+            post[1].start()
+            del table_out, track_out, hits
+        self._join(post)
+
+    def _join(self, post):
+        if post is None:
+            return
+        job, p = post
+        p.join()
+        if p.exitcode != 0:
+            # killed before reporting, e.g. out of memory
+            self.result_queue.put({'prefix': job['prefix'], 'status': 'failed', 'stage': 'post',
+                                   'error': 'Process exited with code ' + str(p.exitcode)})
+
+
+def run_batch(jobs, cfg, config, logger, workers=1, post_workers=0, stream=False, cache=None, model_key=None,
+              log_fp=None, status_fp=None, resume=False, journal=False, poll=5):
+    """Process movies with a pool of `BatchWorker`, each holding its own model.
+
+    Workers are spread over available GPUs. The status of each movie is logged as it changes and saved to `status_fp`,
+    a failed movie does not stop the batch.
+
+    Args:
+        jobs (list): dict of `prefix`, `output` directory and input `files` of each movie, see `load_movie()`.
+        cfg (detectron2.config.CfgNode): detectron2 config.
+        config (dict): pcnaDeep config.
+        logger (logging.Logger): logger.
+        workers (int): number of worker processes.
+        post_workers (int): see `detect()`.
+        stream (bool): see `detect()`.
+        cache (StageCache): optional stage cache.
+        model_key (str): key of the model in the cache.
+        log_fp (str): log file of workers, suffixed by their rank.
+        status_fp (str): optional csv file to save the status of each movie.
+        resume (bool): skip movies done according to the previous `status_fp`, others resume detection from their
+            journal, see `detect()`.
+        journal (bool): see `detect()`.
+        poll (int): seconds between checks of worker liveness.
+
+    Returns:
+        (pandas.DataFrame): prefix, status, failed stage, error, detection and post-processing time and worker of each
+            movie.
+    """
+    if workers < 1:
+        raise ValueError('Number of batch workers should be at least 1, not ' + str(workers))
+    status = {job['prefix']: {'prefix': job['prefix'], 'status': 'pending', 'stage': '', 'error': '',
+                              'detect_time': np.nan, 'post_time': np.nan, 'worker': np.nan} for job in jobs}
+    if resume and status_fp is not None and os.path.isfile(status_fp):
+        last = pd.read_csv(status_fp, dtype={'prefix': str, 'stage': str, 'error': str}).fillna(
+            {'stage': '', 'error': ''})
+        for rec in last[last['status'] == 'done'].to_dict('records'):
+            if rec['prefix'] in status:
+                status[rec['prefix']].update(rec)
+        jobs = [job for job in jobs if status[job['prefix']]['status'] != 'done']
+        logger.info('Resume batch, ' + str(len(status) - len(jobs)) + ' movies already done.')
+    workers = min(workers, len(jobs))
+    task_queue = mp.Queue()
+    result_queue = mp.Queue()
+    for job in jobs:
+        task_queue.put(job)
+    n_gpu = torch.cuda.device_count() if cfg.MODEL.DEVICE.startswith('cuda') else 0
+    pool = []
+    for k in range(workers):
+        worker_cfg = cfg
+        if n_gpu > 1:
+            worker_cfg = cfg.clone()
+            worker_cfg.defrost()
+            worker_cfg.MODEL.DEVICE = 'cuda:' + str(k % n_gpu)
+            worker_cfg.freeze()
+        task_queue.put(None)
+        pool.append(BatchWorker(k + 1, worker_cfg, config, task_queue, result_queue, log_fp,
+                                post_workers=post_workers, stream=stream, cache=cache, model_key=model_key,
+                                resume=resume, journal=journal))
+        pool[-1].start()
+    logger.info('Batch of ' + str(len(jobs)) + ' movies on ' + str(workers) + ' workers, logs in ' + str(log_fp) +
+                '.rank*')
+
+    def collect(rec):
+        if status[rec['prefix']]['status'] in ['done', 'failed'] and rec['status'] == 'detected':
+            # reports of detection and post-processing come from different processes, may arrive out of order
+            status[rec['prefix']].update({k: rec[k] for k in ['detect_time', 'worker']})
+            return
+        status[rec['prefix']].update(rec)
+        msg = rec['prefix'] + ' ' + rec['status']
+        if rec['status'] == 'failed':
+            logger.error(msg + ' at ' + rec['stage'] + ': ' + rec['error'])
+        else:
+            logger.info(msg + ' ({}/{} finished)'.format(
+                sum([v['status'] in ['done', 'failed'] for v in status.values()]), len(status)))
+
+    while any([w.is_alive() for w in pool]):
+        try:
+            collect(result_queue.get(timeout=poll))
+        except queue.Empty:
+            pass
+    for w in pool:
+        w.join()
+    while True:
+        try:
+            collect(result_queue.get(timeout=0.1))
+        except queue.Empty:
+            break
+    for v in status.values():
+        if v['status'] not in ['done', 'failed']:
+            # worker died before reporting
+            v.update({'status': 'failed', 'stage': 'detect' if v['status'] == 'pending' else 'post',
+                      'error': 'Worker exited unexpectedly'})
+
+    out = pd.DataFrame(list(status.values()))
+    if status_fp is not None:
+        out.to_csv(status_fp, index=False)
+    logger.info('Batch finished, {} done, {} failed.'.format(np.sum(out['status'] == 'done'),
+                                                             np.sum(out['status'] == 'failed')))
+    return out
+
+
 if __name__ == "__main__":
     mp.set_start_method("spawn", force=True)
     args = get_parser().parse_args()
@@ -250,12 +860,34 @@ if __name__ == "__main__":
     args.opts = dtrn_opts
     cfg = setup_cfg(args)
     logger.info("Finished setup.")
-    demo = VisualizationDemo(cfg)
+    if args.watch or not bool(pcna_cfg_dict['BATCH']):
+        # in batch mode, the model is loaded by each batch worker
+        demo = VisualizationDemo(cfg)
+    cache = None
+    if bool(pcna_cfg_dict['CACHE']['ENABLED']):
+        cache = StageCache(pcna_cfg_dict['CACHE']['DIR'],
+                           max_size=int(float(pcna_cfg_dict['CACHE']['MAX_SIZE']) * 1024 ** 3))
+    # identifies detection results in the cache and the journal, weights are only hashed for the cache
+    model_key = None
+    if cache is not None or args.journal or args.resume:
+        model_key = get_model_key(cfg, content=cache is not None)
 
     logger.info("Start inferring.")
     ipt = args.stack_input
 
-    if bool(pcna_cfg_dict['BATCH']):
+    if args.watch:
+        if ipt is not None:
+            imgs = WatchStack(ipt, timeout=args.watch_timeout)
+        elif args.pcna is not None and args.bf is not None:
+            imgs = WatchStack(args.pcna, args.bf, sat=float(pcna_cfg_dict['PIX_SATURATE']),
+                              gamma=float(pcna_cfg_dict['GAMMA']), timeout=args.watch_timeout)
+        else:
+            raise ValueError('Watch mode requires input directories, --stack-input or --pcna and --bf.')
+        prefix = os.path.basename(os.path.normpath(imgs.dirs[0]))
+        watch(stack=imgs, config=pcna_cfg_dict, output=args.output, prefix=prefix, logger=logger,
+              post_workers=args.post_workers, checkpoint=args.checkpoint)
+
+    elif bool(pcna_cfg_dict['BATCH']):
         if args.pcna is not None and args.bf is not None:
             if os.path.isdir(args.pcna) and os.path.isdir(args.bf) and os.path.isdir(args.output):
                 pcna_imgs = os.listdir(args.pcna)
@@ -282,27 +914,27 @@ if __name__ == "__main__":
                     prefix = prefix[:-1] if prefix[-1] in ['_','-'] else prefix
                     pairs.append((prefix, pcna_fp, dic_fp))
                 
+                jobs = []
                 for si in pairs:
                     md = os.path.join(args.output, si[0])
                     if os.path.exists(md):
                         logger.warning('Directory ' + md + ' exists, will override files inside.')
                     else:
                         os.mkdir(md)
-                    imgs = getDetectInput(io.imread(os.path.join(args.pcna, si[1])), 
-                                          io.imread(os.path.join(args.bf, si[2])),
-                                          sat=float(pcna_cfg_dict['PIX_SATURATE']),
-                                          gamma=float(pcna_cfg_dict['GAMMA']), torch_gpu=True)
-    
-                    main(stack=imgs, config=pcna_cfg_dict, output=os.path.join(args.output, si[0]), 
-                         prefix=si[0], logger=logger)
-                    del imgs
-                    gc.collect()
+                    jobs.append({'prefix': si[0], 'output': md,
+                                 'files': [os.path.join(args.pcna, si[1]), os.path.join(args.bf, si[2])]})
+                run_batch(jobs, cfg, pcna_cfg_dict, logger, workers=args.batch_workers,
+                          post_workers=args.post_workers, stream=args.stream, cache=cache, model_key=model_key,
+                          log_fp=os.path.join(args.output, 'log.txt'),
+                          status_fp=os.path.join(args.output, 'batch_status.csv'), resume=args.resume,
+                          journal=args.journal)
             else:
                 raise ValueError('Must input directory in batch mode, not single file.')
         
         elif ipt is not None:
             if os.path.isdir(ipt):
                 stack_imgs = os.listdir(ipt)
+                jobs = []
                 for si in stack_imgs:
                     prefix = re.match('(.+)\.\w+',si).group(1)
                     prefix = prefix[:-1] if prefix[-1] in ['_','-'] else prefix
@@ -311,22 +943,33 @@ if __name__ == "__main__":
                         logger.warning('Directory ' + md + ' exists, will override files inside.')
                     else:
                         os.mkdir(md)
-                    imgs = io.imread(os.path.join(ipt, si))
-
-                    main(stack=imgs, config=pcna_cfg_dict, output=os.path.join(args.output, prefix), 
-                         prefix=prefix, logger=logger)
-                    del imgs
-                    gc.collect()
+                    jobs.append({'prefix': prefix, 'output': md, 'files': [os.path.join(ipt, si)]})
+                run_batch(jobs, cfg, pcna_cfg_dict, logger, workers=args.batch_workers,
+                          post_workers=args.post_workers, stream=args.stream, cache=cache, model_key=model_key,
+                          log_fp=os.path.join(args.output, 'log.txt'),
+                          status_fp=os.path.join(args.output, 'batch_status.csv'), resume=args.resume,
+                          journal=args.journal)
             else:
                 raise ValueError('Must input directory in batch mode, not single file.')
 
-    if (ipt is not None or (args.pcna is not None and args.bf is not None)) and not bool(pcna_cfg_dict['BATCH']):
+    if (ipt is not None or (args.pcna is not None and args.bf is not None)) and not bool(pcna_cfg_dict['BATCH']) \
+            and not args.watch:
         flag = True
+        keys, lazy = stage_keys(cache, pcna_cfg_dict, [ipt] if ipt is not None else [args.pcna, args.bf], model_key,
+                                args.stream, journal=args.journal or args.resume)
         if ipt is not None:
             prefix = os.path.basename(ipt)
             prefix = re.match('(.+)\.\w+',prefix).group(1)
             # Input image must be uint8
-            imgs = io.imread(ipt)
+            if lazy:
+                imgs = TiffStack(ipt)
+            else:
+                imgs = io.imread(ipt)
+        elif lazy:
+            prefix = os.path.basename(args.pcna)
+            prefix = re.match('(.+)\.\w+', prefix).group(1)
+            imgs = DetectInputStack(TiffStack(args.pcna), TiffStack(args.bf), sat=float(pcna_cfg_dict['PIX_SATURATE']),
+                                    gamma=float(pcna_cfg_dict['GAMMA']))
         else:
             prefix = os.path.basename(args.pcna)
             prefix = re.match('(.+)\.\w+', prefix).group(1)
@@ -344,4 +987,6 @@ if __name__ == "__main__":
         elif prefix.split('_')[-1] in ['DIC', 'dic', 'mCy', 'mcy', 'pcna', 'PCNA']:
             prefix = '_'.join(prefix.split('_')[:-1])
 
-        main(stack=imgs, config=pcna_cfg_dict, output=args.output, prefix=prefix, logger=logger)
+        main(stack=imgs, config=pcna_cfg_dict, output=args.output, prefix=prefix, logger=logger,
+             post_workers=args.post_workers, stream=args.stream, cache=cache, keys=keys, resume=args.resume,
+             journal=args.journal)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+
+
+class StageCache:
+
+    def __init__(self, root, max_size=None):
+        """Content-addressed cache of pipeline stage outputs on disk.
+
+        Each entry holds the outputs of one stage under a key, built with `make_key()` from the content of the input and
+        the parameters the stage depends on, usually including the key of the stage before. Entries are written to a
+        temporary directory and renamed once complete, so a run interrupted never leaves a partial entry. When the
+        cache grows over `max_size`, least recently used entries are removed.
+
+        Args:
+            root (str): cache directory, created if not exists.
+            max_size (int): maximum size of the cache in bytes, no limit if None.
+        """
+        if max_size is not None and max_size <= 0:
+            raise ValueError('Cache size limit should be positive, not ' + str(max_size))
+        self.root = root
+        self.max_size = max_size
+        self.logger = logging.getLogger('pcna.Cache')
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        """Hash of JSON-serializable parts, e.g. config sections and keys of other stages.
+
+        Returns:
+            (str): SHA-256 hex digest.
+        """
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def hash_files(paths, chunk_size=1 << 20):
+        """Hash of the content of files, independent of their paths.
+
+        Returns:
+            (str): SHA-256 hex digest.
+        """
+        h = hashlib.sha256()
+        for fp in paths:
+            with open(fp, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    h.update(chunk)
+            h.update(b'\0')
+        return h.hexdigest()
+
+    @staticmethod
+    def stat_files(paths):
+        """Cheap identity of files from their absolute path, size and modification time, without reading them.
+
+        Returns:
+            (str): SHA-256 hex digest.
+        """
+        stats = [os.stat(fp) for fp in paths]
+        return StageCache.make_key([[os.path.abspath(fp), st.st_size, st.st_mtime_ns] for fp, st in zip(paths, stats)])
+
+    def _entry(self, stage, key):
+        return os.path.join(self.root, stage, key)
+
+    def contains(self, stage, key):
+        """Whether outputs of a stage are cached, without loading them.
+        """
+        return os.path.isdir(self._entry(stage, key))
+
+    def load(self, stage, key):
+        """Look up outputs of a stage.
+
+        Args:
+            stage (str): stage name.
+            key (str): entry key.
+
+        Returns:
+            (tuple): object saved and dict of file name to path in the cache, None if not cached.
+        """
+        entry = self._entry(stage, key)
+        if not os.path.isdir(entry):
+            return None
+        try:
+            # last use time for eviction
+            now = time.time()
+            os.utime(entry, (now, now))
+            with open(os.path.join(entry, 'data.pkl'), 'rb') as f:
+                data = pickle.load(f)
+            files = {fn: os.path.join(entry, fn) for fn in os.listdir(entry) if fn != 'data.pkl'}
+        except FileNotFoundError:
+            # evicted by another run meanwhile
+            return None
+        self.logger.info('Cache hit of ' + stage + ': ' + key[:12])
+        return data, files
+
+    def save(self, stage, key, data, files=None):
+        """Store outputs of a stage, then evict least recently used entries over the size limit.
+
+        Args:
+            stage (str): stage name.
+            key (str): entry key.
+            data (object): picklable outputs, e.g. tables.
+            files (dict): name to path of output files to copy into the entry, e.g. masks.
+        """
+        entry = self._entry(stage, key)
+        tmp = entry + '.tmp' + str(os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        try:
+            with open(os.path.join(tmp, 'data.pkl'), 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            for fn, fp in (files or {}).items():
+                shutil.copyfile(fp, os.path.join(tmp, fn))
+            if self.max_size is not None and self._size(tmp) > self.max_size:
+                self.logger.warning('Output of ' + stage + ' is larger than the cache size limit, not cached.')
+            elif not os.path.isdir(entry):
+                # otherwise the same outputs are saved by another run
+                try:
+                    os.replace(tmp, entry)
+                except OSError:
+                    if not os.path.isdir(entry):
+                        raise
+                    # saved by another run meanwhile
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp, ignore_errors=True)
+        self.evict(keep=entry)
+
+    @staticmethod
+    def _size(path):
+        return sum([os.path.getsize(os.path.join(path, fn)) for fn in os.listdir(path)])
+
+    def entries(self):
+        """Complete entries in the cache.
+
+        Returns:
+            (list): (path, size in bytes, last use time) of each entry.
+        """
+        out = []
+        for stage in os.listdir(self.root):
+            sd = os.path.join(self.root, stage)
+            if not os.path.isdir(sd):
+                continue
+            for key in os.listdir(sd):
+                entry = os.path.join(sd, key)
+                if '.tmp' in key or not os.path.isdir(entry):
+                    continue
+                out.append((entry, self._size(entry), os.path.getmtime(entry)))
+        return out
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in the size limit.
+
+        Args:
+            keep (str): path of an entry never removed, e.g. the one just saved.
+        """
+        if self.max_size is None:
+            return
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum([e[1] for e in entries])
+        for entry, size, _ in entries:
+            if total <= self.max_size:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            self.logger.info('Cache evicted ' + os.path.relpath(entry, self.root))
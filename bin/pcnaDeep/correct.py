@@ -4,7 +4,7 @@ import argparse
 import re
 import pprint
 import numpy as np
-from pcnaDeep.data.utils import find_daugs
+from pcnaDeep.data.utils import LineageGraph
 
 
 class Trk_obj:
@@ -56,7 +56,7 @@ class Trk_obj:
         if frame not in list(self.track[self.track['trackId'] == old_id]['frame']):
             raise ValueError('Selected frame is not in the original track.')
 
-        dir_daugs = list(np.unique(self.track.loc[self.track['parentTrackId'] == old_id, 'trackId']))
+        dir_daugs = LineageGraph.from_track(self.track).daughters(old_id)
         for dd in dir_daugs:
             self.del_parent(dd)
 
@@ -81,7 +81,7 @@ class Trk_obj:
         self.track.loc[self.track['trackId'] == new, 'lineageId'] = new_lin
         self.track.loc[self.track['trackId'] == new, 'parentTrackId'] = new_par
         # daughters of the new track, change lineage
-        daugs = find_daugs(self.track, new)
+        daugs = LineageGraph.from_track(self.track).descendants(new)
         if daugs:
             self.track.loc[self.track['trackId'].isin(daugs), 'lineageId'] = new_lin
         print('Replaced/Created track ' + str(old_id) + ' from ' + str(frame+self.frame_base) +
@@ -115,7 +115,7 @@ class Trk_obj:
         self.track.loc[self.track['trackId'] == daug, 'lineageId'] = par_lin
         self.track.loc[self.track['trackId'] == daug, 'parentTrackId'] = par
         # daughter of the daughter
-        daugs_of_daug = find_daugs(self.track, daug)
+        daugs_of_daug = LineageGraph.from_track(self.track).descendants(daug)
         if daugs_of_daug:
             self.track.loc[self.track['trackId'].isin(daugs_of_daug), 'lineageId'] = par_lin
         print('Parent ' + str(par) + ' associated with daughter ' + str(daug) + '.')
@@ -137,7 +137,7 @@ class Trk_obj:
         self.track.loc[self.track['trackId'] == daug, 'lineageId'] = daug
         self.track.loc[self.track['trackId'] == daug, 'parentTrackId'] = 0
         # daughters of the daughter, change lineage
-        daugs = find_daugs(self.track, daug)
+        daugs = LineageGraph.from_track(self.track).descendants(daug)
         if daugs:
             self.track.loc[self.track['trackId'].isin(daugs), 'lineageId'] = daug
 
@@ -224,7 +224,7 @@ class Trk_obj:
 
         if frame is None:
             # For all direct daughter of the track to delete, first remove association
-            dir_daugs = list(np.unique(self.track.loc[self.track['parentTrackId'] == trk_id, 'trackId']))
+            dir_daugs = LineageGraph.from_track(self.track).daughters(trk_id)
             for dd in dir_daugs:
                 self.del_parent(dd)
 
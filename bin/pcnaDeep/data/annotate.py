@@ -5,6 +5,7 @@ import pandas as pd
 import skimage.io as io
 from skimage.util import img_as_uint
 from skimage.util import img_as_ubyte
+from pcnaDeep.data.utils import LineageGraph
 
 
 def relabel_trackID(label_table):
@@ -30,42 +31,39 @@ def relabel_trackID(label_table):
     return label_table
 
 
-def label_by_track(mask, label_table):
+def label_by_track(mask, label_table, out=None):
     """Label objects in mask with track ID
 
     Args:
-        mask (numpy.ndarray): uint8 np array, output from main model.
+        mask (numpy.ndarray or MaskStore): uint8 np array, output from main model.
         label_table (pandas.DataFrame): track table.
+        out (MaskStore): optional, writable store to write labeled frames into, so that the stack is never
+            held in memory. If not supplied, `mask` is relabeled in place (uint8/16 cast may copy).
     
     Returns:
-        numpy.ndarray: uint8/16 dtype based on track count.
+        numpy.ndarray: uint8/16 dtype based on track count, or `out` if supplied.
     """
 
     assert mask.shape[0] == np.max(label_table['frame'] + 1)
 
-    if np.max(label_table['trackId']) * 2 > 254:
-        mask = mask.astype('uint16')
-
-    for i in np.unique(label_table['frame']):
+    if out is None:
+        if np.max(label_table['trackId']) * 2 > 254:
+            mask = mask.astype('uint16')
+        out = mask
+
+    frames = set(np.unique(label_table['frame']))
+    for i in range(mask.shape[0]):
+        if i not in frames:
+            if out is not mask:
+                out[i] = mask[i]
+            continue
         sub_table = label_table[label_table['frame'] == i]
-        sl = mask[i, :, :].copy()
-        lbs = np.unique(sl).tolist()
-
-        '''
-        if lbs[-1] + 1 != len(lbs):
-            raise ValueError('Mask is not continuously or wrongly labeled.')
-        '''
-
-        ori_labels = set(lbs) - {0}
-        untracked = list(ori_labels - set(list(sub_table['continuous_label'])))
-        #  remove untracked
-        for j in untracked:
-            sl[mask[i, :, :] == j] = 0
-        #  update tracked
-        for j in sub_table.index:
-            sl[mask[i, :, :] == sub_table.loc[j, 'continuous_label']] = sub_table.loc[j, 'trackId']
-        mask[i, :, :] = sl.copy()
-    return mask
+        sl = mask[i]
+        #  untracked objects map to 0, tracked ones to their track ID
+        lut = np.zeros(max(int(np.max(sl)), int(np.max(sub_table['continuous_label']))) + 1, dtype=out.dtype)
+        lut[sub_table['continuous_label'].values.astype(int)] = sub_table['trackId'].values
+        out[i] = lut[sl]
+    return out
 
 
 def get_lineage_txt(label_table):
@@ -122,9 +120,11 @@ def break_track(label_table):
     # to t1-8. Since this indicates faulty track, warning shown
     # *** this should NOT usually happen
 
-    for l in np.unique(label_table['trackId']):
-        daugs = np.unique(label_table[label_table['parentTrackId'] == l]['trackId'])
-        if len(daugs) == 2:
+    lineage = LineageGraph.from_track(label_table)
+    tracks = set(np.unique(label_table['trackId']))
+    for l in lineage:
+        daugs = lineage.daughters(l)
+        if len(daugs) == 2 and l in tracks:
             daug1 = label_table[label_table['trackId'] == daugs[0]]['frame'].iloc[0]
             daug2 = label_table[label_table['trackId'] == daugs[1]]['frame'].iloc[0]
             par = label_table[label_table['trackId'] == l]
@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
 import copy
+from collections import OrderedDict
 import json
 import os
 import re
+import time
 import torch
 import numpy as np
 import pandas as pd
 import skimage.exposure as exposure
 import skimage.io as io
 import skimage.measure as measure
+import tifffile
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from PIL import Image, ImageDraw
 from skimage.util import img_as_ubyte
 import warnings
@@ -182,20 +188,8 @@ def getDetectInput(pcna, dic, gamma=1, sat=1, torch_gpu=False):
         dic_img = np.expand_dims(dic_img, axis=0)
 
     outs = []
-    rg = (sat, 100-sat)
     for f in range(stack.shape[0]):
-        # rescale mCherry intensity
-        fme = exposure.adjust_gamma(stack[f, :, :], gamma)
-        fme = exposure.rescale_intensity(fme, in_range=tuple(np.percentile(fme, rg)))
-        dic_img[f, :, :] = exposure.rescale_intensity(dic_img[f, :, :],
-                                                      in_range=tuple(np.percentile(dic_img[f, :, :], rg)))
-
-        # save two-channel image for downstream
-        fme = img_as_ubyte(fme)
-        dic_slice = img_as_ubyte(dic_img[f, :, :])
-        slice_list = [fme, fme, dic_slice]
-
-        s = np.stack(slice_list, axis=2)
+        s = getDetectInputFrame(stack[f, :, :], dic_img[f, :, :], gamma=gamma, sat=sat)
         if torch_gpu:
             s = torch.from_numpy(s)
         outs.append(s)
@@ -208,6 +202,291 @@ def getDetectInput(pcna, dic, gamma=1, sat=1, torch_gpu=False):
     return final_out
 
 
+def getDetectInputFrame(pcna, dic, gamma=1, sat=1):
+    """Generate composite of a single PCNA and DIC slice, see `getDetectInput()`.
+
+    Args:
+        pcna (numpy.ndarray): uint16 PCNA-mScarlet image slice (H*W).
+        dic (numpy.ndarray): uint16 DIC or phase contrast image slice.
+        gamma (float): gamma adjustment, >0.
+        sat (float): percent saturation, 0~100.
+
+    Returns:
+        (numpy.ndarray): uint8 composite image (H*W*C)
+    """
+    rg = (sat, 100-sat)
+    # rescale mCherry intensity
+    fme = exposure.adjust_gamma(pcna, gamma)
+    fme = exposure.rescale_intensity(fme, in_range=tuple(np.percentile(fme, rg)))
+    dic = exposure.rescale_intensity(dic, in_range=tuple(np.percentile(dic, rg)))
+
+    # save two-channel image for downstream
+    fme = img_as_ubyte(fme)
+    dic_slice = img_as_ubyte(dic)
+    return np.stack([fme, fme, dic_slice], axis=2)
+
+
+class TiffStack:
+
+    def __init__(self, fp):
+        """Read-only view of a multi-page TIFF stack, frames are only read from disk on access.
+
+        Memory-maps the file if the image data is stored contiguously and uncompressed, otherwise reads page by page.
+
+        Args:
+            fp (str): path to the TIFF file, one page per frame.
+        """
+        self.fp = fp
+        self.tif = tifffile.TiffFile(fp)
+        series = self.tif.series[0]
+        self.shape = tuple(series.shape)
+        self.dtype = series.dtype
+        try:
+            self.mmap = tifffile.memmap(fp)
+        except ValueError:
+            self.mmap = None
+            if len(self.tif.pages) != self.shape[0]:
+                raise ValueError('Cannot read ' + fp + ' by page, frame count and page count do not match.')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, i):
+        if self.mmap is not None:
+            return np.asarray(self.mmap[i])
+        if isinstance(i, slice):
+            return np.stack([self.tif.pages[j].asarray() for j in range(*i.indices(self.shape[0]))], axis=0)
+        return self.tif.pages[int(i)].asarray()
+
+    def __iter__(self):
+        for i in range(self.shape[0]):
+            yield self[i]
+
+    def close(self):
+        self.mmap = None
+        self.tif.close()
+
+
+class DetectInputStack:
+
+    def __init__(self, pcna, dic, gamma=1, sat=1):
+        """Lazy `getDetectInput()`: composite is generated frame by frame on access.
+
+        Args:
+            pcna (TiffStack or numpy.ndarray): uint16 PCNA-mScarlet image stack (T*H*W).
+            dic (TiffStack or numpy.ndarray): uint16 DIC or phase contrast image stack.
+            gamma (float): gamma adjustment, >0.
+            sat (float): percent saturation, 0~100.
+        """
+        if pcna.dtype != np.dtype('uint16') or dic.dtype != np.dtype('uint16'):
+            raise ValueError('Input image must be in uint16 format.')
+        if sat < 0 or sat > 100:
+            raise ValueError('Saturated pixel should not be negative or exceeds 100')
+        if tuple(pcna.shape) != tuple(dic.shape):
+            raise ValueError('PCNA and DIC stack should have the same shape.')
+        self.pcna = pcna
+        self.dic = dic
+        self.gamma = gamma
+        self.sat = sat
+        self.shape = tuple(pcna.shape) + (3,)
+        self.dtype = np.dtype('uint8')
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, i):
+        return getDetectInputFrame(self.pcna[i], self.dic[i], gamma=self.gamma, sat=self.sat)
+
+    def __iter__(self):
+        for i in range(self.shape[0]):
+            yield self[i]
+
+
+class WatchStack:
+
+    def __init__(self, pcna, dic=None, gamma=1, sat=1, poll=2, timeout=600, end_mark='END'):
+        """Frames of an ongoing acquisition, written into a directory as one TIFF file per time point.
+
+        Iterating yields frames as their files land, in natural order of file names (`t2` before `t10`). A file is
+        taken once its size stays the same over two polls and it can be read. Iteration ends when a file named
+        `end_mark` appears in the directory, or when no new frame comes within `timeout` seconds.
+
+        Args:
+            pcna (str): directory of uint16 PCNA-mScarlet slices, or of uint8 composite slices (H*W*C) if `dic` is
+                not given.
+            dic (str): optional, directory of uint16 DIC or phase contrast slices, the i-th files of both directories
+                make frame i, composite is generated by `getDetectInputFrame()`.
+            gamma (float): gamma adjustment, >0.
+            sat (float): percent saturation, 0~100.
+            poll (float): interval between directory scans, in seconds.
+            timeout (float): maximum waiting time for the next frame, in seconds.
+            end_mark (str): name of the file marking the end of acquisition.
+        """
+        for d in [pcna, dic]:
+            if d is not None and not os.path.isdir(d):
+                raise ValueError('Watched input must be a directory, not: ' + str(d))
+        if sat < 0 or sat > 100:
+            raise ValueError('Saturated pixel should not be negative or exceeds 100')
+        self.dirs = [pcna] if dic is None else [pcna, dic]
+        self.gamma = gamma
+        self.sat = sat
+        self.poll = poll
+        self.timeout = timeout
+        self.end_mark = end_mark
+        self.n_frame = 0  # frames yielded
+        self._sizes = [{} for _ in self.dirs]  # file size seen at last poll
+
+    @staticmethod
+    def _natural_key(name):
+        return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', name)]
+
+    def _ready(self, k, complete=False):
+        """Files of directory `k` in natural order, up to the first one still being written, unless `complete`.
+        """
+        files = sorted([f for f in os.listdir(self.dirs[k]) if re.search(r'\.tiff?$', f, re.IGNORECASE)],
+                       key=self._natural_key)
+        sizes = {f: os.path.getsize(os.path.join(self.dirs[k], f)) for f in files}
+        ready = []
+        for f in files:
+            if not complete and (sizes[f] == 0 or self._sizes[k].get(f) != sizes[f]):
+                break
+            ready.append(f)
+        self._sizes[k] = sizes
+        return ready
+
+    def _read(self, i, names):
+        try:
+            imgs = [io.imread(os.path.join(d, f)) for d, f in zip(self.dirs, names)]
+        except (OSError, ValueError):
+            # not readable yet, e.g. file header written last
+            return None
+        if len(imgs) == 1:
+            return imgs[0]
+        if imgs[0].dtype != np.dtype('uint16') or imgs[1].dtype != np.dtype('uint16'):
+            raise ValueError('Input image must be in uint16 format, frame ' + str(i) + ': ' + str(names))
+        return getDetectInputFrame(imgs[0], imgs[1], gamma=self.gamma, sat=self.sat)
+
+    def __iter__(self):
+        last = time.time()
+        while True:
+            # all files are complete once the end of acquisition is marked
+            ended = os.path.exists(os.path.join(self.dirs[0], self.end_mark))
+            ready = [self._ready(k, complete=ended) for k in range(len(self.dirs))]
+            n = min([len(r) for r in ready])
+            while self.n_frame < n:
+                img = self._read(self.n_frame, [r[self.n_frame] for r in ready])
+                if img is None:
+                    break
+                self.n_frame += 1
+                last = time.time()
+                yield img
+            if ended and self.n_frame == n:
+                return
+            if time.time() - last > self.timeout:
+                return
+            time.sleep(self.poll)
+
+
+class MaskStore:
+
+    def __init__(self, fp, shape=None, dtype='uint16', mode='r', cache_size=16):
+        """Label mask stack kept on disk, with per-frame random access and a LRU cache of decoded frames.
+
+        Indexing by frame (`store[t]`, `store[t, y0:y1, x0:x1]`, `store[t0:t1]`) only reads the frames required.
+        Cached frames are read-only, copy before modifying.
+
+        Args:
+            fp (str): path to the TIFF mask file.
+            shape (tuple): (T, H, W), if given, create a new memory-mapped mask at `fp` (overwrite).
+            dtype (str): data type of the new mask, only used when `shape` is given.
+            mode (str): 'r' for read-only or 'r+' for writable access to an existing file.
+            cache_size (int): number of decoded frames to keep in memory.
+        """
+        self.fp = fp
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._pages = None
+        if shape is not None:
+            self._mmap = tifffile.memmap(fp, shape=tuple(shape), dtype=dtype)
+            self.writable = True
+        else:
+            if mode not in ['r', 'r+']:
+                raise ValueError('Mode can only be r or r+, not: ' + str(mode))
+            try:
+                self._mmap = tifffile.memmap(fp, mode=mode)
+                self.writable = mode == 'r+'
+            except ValueError:
+                # compressed file, decode page by page
+                if mode == 'r+':
+                    raise ValueError('Cannot open compressed mask ' + fp + ' as writable.')
+                self._mmap = None
+                self._pages = TiffStack(fp)
+                self.writable = False
+        src = self._mmap if self._mmap is not None else self._pages
+        self.shape = tuple(src.shape)
+        self.dtype = np.dtype(src.dtype)
+        if len(self.shape) != 3:
+            raise ValueError('Mask must be in T*H*W format, got shape: ' + str(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _frame_index(self, i):
+        i = int(i)
+        if i < 0:
+            i += self.shape[0]
+        if i < 0 or i >= self.shape[0]:
+            raise IndexError('Frame ' + str(i) + ' out of range for mask of ' + str(self.shape[0]) + ' frames.')
+        return i
+
+    def _read(self, i):
+        if i in self._cache:
+            self._cache.move_to_end(i)
+            return self._cache[i]
+        if self._mmap is not None:
+            sl = np.array(self._mmap[i])
+        else:
+            sl = self._pages[i]
+        sl.flags.writeable = False
+        self._cache[i] = sl
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return sl
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            t, rest = key[0], key[1:]
+        else:
+            t, rest = key, ()
+        if isinstance(t, slice):
+            out = np.stack([self._read(i) for i in range(*t.indices(self.shape[0]))], axis=0)
+            return out[(slice(None),) + rest]
+        sl = self._read(self._frame_index(t))
+        return sl[rest] if rest else sl
+
+    def __setitem__(self, i, value):
+        if not self.writable:
+            raise ValueError('Mask ' + self.fp + ' is opened read-only.')
+        i = self._frame_index(i)
+        self._mmap[i] = value
+        self._cache.pop(i, None)
+
+    def __iter__(self):
+        for i in range(self.shape[0]):
+            yield self[i]
+
+    def flush(self):
+        if self._mmap is not None and self.writable:
+            self._mmap.flush()
+
+    def close(self):
+        self.flush()
+        self._cache.clear()
+        self._mmap = None
+        if self._pages is not None:
+            self._pages.close()
+
+
 def retrieve(table, mask, image, rp_fields=[], funcs=[]):
     """Retrieve extra skimage.measure.regionprops fields of every object;
         Or apply customized functions to extract features form the masked object.
@@ -316,14 +595,96 @@ def get_outlier(array, col_ids=None):
     return idx
 
 
+def assign_by_component(row, col, cost, shape):
+    """Minimum cost assignment on a sparse cost matrix, solved on each connected component separately.
+
+    Missing entries cost 0, as in a dense matrix filled with zeros. The optimum is the same as
+    `linear_sum_assignment()` on the dense matrix; only assignments to supplied entries are returned.
+
+    Args:
+        row (numpy.ndarray): row index of each entry.
+        col (numpy.ndarray): column index of each entry.
+        cost (numpy.ndarray): cost of each entry, (row, col) pairs must be unique.
+        shape (tuple): (rows, columns) of the full matrix.
+
+    Returns:
+        (numpy.ndarray, numpy.ndarray, numpy.ndarray): assigned rows (ascending), columns and their costs.
+    """
+    if len(row) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([], dtype=float)
+    n_r, n_c = shape
+    graph = coo_matrix((np.ones(len(row)), (row, n_r + col)), shape=(n_r + n_c, n_r + n_c))
+    _, labels = connected_components(graph, directed=False)
+    comp = labels[row]
+    order = np.argsort(comp, kind='stable')
+    bounds = np.flatnonzero(np.diff(comp[order])) + 1
+    r_ind, c_ind, costs = [], [], []
+    for e in np.split(order, bounds):
+        rows = np.unique(row[e])
+        cols = np.unique(col[e])
+        sub = np.zeros((rows.shape[0], cols.shape[0]))
+        sub[np.searchsorted(rows, row[e]), np.searchsorted(cols, col[e])] = cost[e]
+        ri, ci = linear_sum_assignment(sub)
+        r_ind.append(rows[ri])
+        c_ind.append(cols[ci])
+        costs.append(sub[ri, ci])
+    r_ind = np.concatenate(r_ind)
+    c_ind = np.concatenate(c_ind)
+    costs = np.concatenate(costs)
+    order = np.argsort(r_ind, kind='stable')
+    return r_ind[order], c_ind[order], costs[order]
+
+
+PHASES = ('G1/G2', 'S', 'M')  # predicted phases, in the column order of classification confidence
+PHASE_NAMES = PHASES + ('G1', 'G2', 'G1*', 'G2*', 'E')  # all phases, including resolved and emerging ones
+PHASE_CODE = {name: code for code, name in enumerate(PHASE_NAMES)}
+PHASE_DTYPE = pd.CategoricalDtype(PHASE_NAMES)
+
+
+def phase_codes(cls):
+    """Encode cell cycle phases as int8 codes indexing `PHASE_NAMES`.
+
+    Args:
+        cls (pandas.Series or array-like): phase names, a categorical of phases, or phase codes.
+
+    Returns:
+        numpy.ndarray: phase codes.
+    """
+    if isinstance(cls, pd.Series) and isinstance(cls.dtype, pd.CategoricalDtype) and cls.dtype == PHASE_DTYPE:
+        codes = cls.cat.codes.values
+    else:
+        cls = np.asarray(cls)
+        if cls.dtype.kind in 'iu':
+            codes = cls.astype(np.int8)
+            if codes.shape[0] and (codes.min() < 0 or codes.max() >= len(PHASE_NAMES)):
+                raise ValueError('Cell cycle phase code must be within 0~' + str(len(PHASE_NAMES) - 1))
+            return codes
+        codes = pd.Categorical(cls, dtype=PHASE_DTYPE).codes
+    if np.any(codes < 0):
+        raise ValueError('Cell cycle phase must be one of ' + str(PHASE_NAMES))
+    return codes
+
+
+def phase_labels(codes):
+    """Decode int8 phase codes into a categorical of phase names, which is written out as plain strings.
+
+    Args:
+        codes (numpy.ndarray): phase codes indexing `PHASE_NAMES`.
+
+    Returns:
+        pandas.Categorical: cell cycle phases.
+    """
+    return pd.Categorical.from_codes(codes, dtype=PHASE_DTYPE)
+
+
 def deduce_transition(l, tar, confidence, min_tar, max_res, escape=0, casual_end=True):
     """ Deduce mitosis exit and entry based on adaptive searching
 
         Args:
-            l (list): list of the target cell cycle phase
+            l (list): list of the cell cycle phase, either as names or as codes indexing `PHASE_NAMES`
             tar (str): target cell cycle phase
             min_tar (int): minimum duration of an entire target phase
-            confidence (numpy.ndarray): matrix of confidence
+            confidence (numpy.ndarray): matrix of confidence, columns ordered as `PHASES`
             max_res (int): maximum accumulative duration of unwanted phase
             escape (int): do not consider the first n instances
             casual_end (bool): at the end of the track, whether loosen criteria of a match
@@ -331,9 +692,11 @@ def deduce_transition(l, tar, confidence, min_tar, max_res, escape=0, casual_end
         Returns:
             tuple: two indices of the classification list corresponding to entry and exit
     """
-    mp = {'G1/G2': 0, 'S': 1, 'M': 2}
-    confid_cls = list(map(lambda x: confidence[x, mp[l[x]]], range(confidence.shape[0])))
-    idx = np.array([i for i in range(len(l)) if l[i] == tar])
+    codes = phase_codes(l)
+    if codes.shape[0] and codes.max() >= len(PHASES):
+        raise ValueError('Cell cycle phase must be one of ' + str(PHASES))
+    confid_cls = confidence[np.arange(codes.shape[0]), codes]
+    idx = np.flatnonzero(codes == PHASE_CODE[tar])
     idx = idx[idx >= escape].tolist()
     if len(idx) == 0:
         return None
@@ -383,8 +746,327 @@ def deduce_transition(l, tar, confidence, min_tar, max_res, escape=0, casual_end
         return None
 
 
+
+def deduce_transition_batch(cls, confidence, offsets, tar, min_tar, max_res, escape=0, casual_end=True):
+    """ Batched `deduce_transition` over many tracks at once.
+
+        Tracks are concatenated into one ragged array, track `t` spans `offsets[t]:offsets[t+1]`. The adaptive
+        search runs on all tracks together, one target instance per step. Tracks whose accumulated penalty ends up
+        within rounding error of `max_res` are sent to `deduce_transition`, so that results are identical.
+
+        Args:
+            cls (numpy.ndarray): concatenated cell cycle phase, either as names or as codes indexing `PHASE_NAMES`
+            confidence (numpy.ndarray): concatenated matrix of confidence, columns ordered as `PHASES`
+            offsets (numpy.ndarray): track boundaries, length of track number + 1
+            tar (str): target cell cycle phase
+            min_tar (int): minimum duration of an entire target phase
+            max_res (int): maximum accumulative duration of unwanted phase
+            escape (int or numpy.ndarray): do not consider the first n instances, can be set per track
+            casual_end (bool): at the end of the track, whether loosen criteria of a match
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray): entry and exit indices relative to the track start, -1 if not found
+    """
+    codes = phase_codes(cls)
+    confidence = np.asarray(confidence, dtype=float)
+    offsets = np.asarray(offsets, dtype=int)
+    n = offsets.shape[0] - 1
+    size = codes.shape[0]
+    if size and codes.max() >= len(PHASES):
+        raise ValueError('Cell cycle phase must be one of ' + str(PHASES))
+    if offsets[0] != 0 or offsets[-1] != size or np.any(np.diff(offsets) < 0):
+        raise ValueError('Offsets do not partition the input.')
+
+    trk = np.repeat(np.arange(n), np.diff(offsets))
+    escape = np.broadcast_to(np.asarray(escape, dtype=int), (n,))
+    confid_cls = confidence[np.arange(size), codes]
+    pos = np.nonzero((codes == PHASE_CODE[tar]) & (np.arange(size) - offsets[trk] >= escape[trk]))[0]
+    k = np.bincount(trk[pos], minlength=n)
+    ps = np.concatenate([[0], np.cumsum(k)[:-1]]).astype(int)
+
+    # penalty between successive target instances, pairs across tracks are never read
+    gap = np.zeros(max(pos.shape[0] - 1, 0))
+    lo, hi = pos[:-1] + 1, pos[1:]
+    nonempty = hi > lo
+    if np.any(nonempty):
+        gap[nonempty] = np.add.reduceat(confid_cls, np.stack([lo[nonempty], hi[nonempty]], axis=1).ravel())[::2]
+
+    entry = np.full(n, -1)
+    m_exit = np.full(n, -1)
+    has = k > 0
+    entry[has] = pos[ps[has]]
+    acc = np.zeros(n)
+    acc[has] = confid_cls[entry[has]]
+    g_panelty = np.zeros(n)
+    found = np.zeros(n, dtype=bool)
+    done = np.zeros(n, dtype=bool)
+    ambiguous = np.zeros(n, dtype=bool)
+    tol = 1e-9 * max(1., abs(max_res))
+    last_i = np.maximum(k - 1, 0)
+    for i in range(int(k.max()) - 1 if n else 0):
+        act = np.nonzero((k > i + 1) & ~done)[0]
+        if act.shape[0] == 0:
+            break
+        j = ps[act] + i
+        acc[act] += confid_cls[pos[j + 1]]
+        g_panelty[act] += gap[j]
+        ambiguous[act] |= np.abs(g_panelty[act] - max_res) <= tol
+        hit = acc[act] >= min_tar
+        found[act] |= hit
+        reset = act[hit & (g_panelty[act] < max_res)]
+        g_panelty[reset] = 0
+        acc[reset] = 0
+        over = g_panelty[act] >= max_res
+        stop = over & found[act]
+        m_exit[act[stop]] = pos[j[stop]]
+        done[act[stop]] = True
+        last_i[act[stop]] = i
+        restart = act[over & ~found[act]]
+        g_panelty[restart] = 0
+        acc[restart] = 0
+        entry[restart] = pos[ps[restart] + i + 1]
+
+    multi = k > 1
+    last = np.full(n, -1)
+    last[has] = pos[ps[has] + k[has] - 1]
+    ambiguous &= multi
+    ambiguous |= multi & (np.abs(g_panelty - max_res) <= tol)
+    end = multi & ~done & found
+    m_exit[end] = last[end]
+    cur = np.full(n, -1)
+    cur[has] = pos[ps[has] + last_i[has]]
+    loose = multi & ~end & (g_panelty < max_res) & \
+        (found | (casual_end & (cur - entry + 1 >= min_tar) & (entry != last)))
+    found |= loose
+    m_exit[loose] = last[loose]
+
+    single = k == 1
+    m_exit[single] = entry[single]
+    valid = single | (multi & found & (m_exit >= 0))
+    entry = np.where(valid, entry - offsets[:-1], -1)
+    m_exit = np.where(valid, m_exit - offsets[:-1], -1)
+    for t in np.nonzero(ambiguous)[0]:
+        s, e = offsets[t], offsets[t + 1]
+        out = deduce_transition(codes[s:e], tar, confidence[s:e], min_tar, max_res,
+                                escape=escape[t], casual_end=casual_end)
+        entry[t], m_exit[t] = out if out is not None else (-1, -1)
+    return entry, m_exit
+
+
+class LineageGraph:
+    """Mitosis relationships between tracks, indexed from both the parent and the daughter side.
+
+    Holds the information of the mitosis dictionary (`mt_dic`) used across pcnaDeep::
+
+        {parent: {'div': mitosis entry, 'daug': {daughter: {'m_exit': mitosis exit, 'dist': distance/score}}}}
+
+    Parent, daughters and descendants are looked up without scanning the track table, and relationships are
+    registered or removed in place. Parents and daughters keep their insertion order, so that serializing back
+    gives the same dictionary.
+    """
+
+    def __init__(self):
+        self._div = {}  # parent: mitosis entry
+        self._daug = {}  # parent: {daughter: {'m_exit': mitosis exit, 'dist': distance/score}}
+        self._parent = {}  # daughter: parent
+
+    @classmethod
+    def from_mt_dic(cls, mt_dic):
+        """Build from a mitosis dictionary.
+
+        Args:
+            mt_dic (dict): standard mitosis info dictionary in pcnaDeep.
+        """
+        graph = cls()
+        for par in mt_dic.keys():
+            graph._div[par] = mt_dic[par]['div']
+            graph._daug[par] = {}
+            for daug in mt_dic[par]['daug'].keys():
+                graph._daug[par][daug] = dict(mt_dic[par]['daug'][daug])
+                graph._parent[daug] = par
+        return graph
+
+    @classmethod
+    def from_track(cls, track):
+        """Build from the `parentTrackId` column of a tracked object table. Mitosis entry, exit and distance are not
+        recorded in the table and left as None.
+
+        Args:
+            track (pandas.DataFrame): tracked object table.
+        """
+        graph = cls()
+        pairs = track.loc[track['parentTrackId'] != 0, ['trackId', 'parentTrackId']].drop_duplicates()
+        pairs = pairs.sort_values(by=['parentTrackId', 'trackId'])
+        for daug, par in zip(pairs['trackId'], pairs['parentTrackId']):
+            graph.add(par, daug)
+        return graph
+
+    @classmethod
+    def from_ann(cls, ann):
+        """Build from a track annotation table (see `pcnaDeep.refiner.Refiner.register_track()`). Relationships are
+        read from `mitosis_parent`, daughter order from `mitosis_daughter`, mitosis entry and exit from `m_entry` and
+        `m_exit`. Distance is not recorded in the table and left as None.
+
+        Args:
+            ann (pandas.DataFrame): track annotation table.
+        """
+        graph = cls()
+        daugs = {}
+        m_exit = {}
+        for trk, par, ext in zip(ann['track'], ann['mitosis_parent'], ann['m_exit']):
+            if par is not None and not pd.isna(par) and par != 0:
+                daugs.setdefault(int(par), []).append(trk)
+                m_exit[trk] = None if ext is None or pd.isna(ext) else ext
+        for trk, entry, ds in zip(ann['track'], ann['m_entry'], ann['mitosis_daughter']):
+            if trk not in daugs.keys():
+                continue
+            order = [d for d in str(ds).split('/') if d not in ['', 'nan', 'None']]
+            order = {int(float(order[i])): i for i in range(len(order))}
+            for d in sorted(daugs[trk], key=lambda x: order.get(x, len(order))):
+                graph.add(trk, d, m_exit=m_exit[d], m_entry=None if entry is None or pd.isna(entry) else entry)
+        return graph
+
+    def to_mt_dic(self):
+        """Serialize to the mitosis dictionary.
+
+        Returns:
+            dict: standard mitosis info dictionary in pcnaDeep.
+        """
+        return {par: {'div': self._div[par], 'daug': {d: dict(info) for d, info in self._daug[par].items()}}
+                for par in self._daug.keys()}
+
+    def to_ann(self, ann, m_entry=True):
+        """Write relationships to the mitosis columns of a track annotation table, in place.
+
+        `mitosis_daughter` lists daughters as '/d1/d2', `mitosis_identity` lists '/daughter' if the track has a
+        parent, then '/parent' for each daughter.
+
+        Args:
+            ann (pandas.DataFrame): track annotation table.
+            m_entry (bool): whether to write mitosis entry of parents as well.
+
+        Returns:
+            pandas.DataFrame: the annotation table.
+        """
+        tracks = list(ann['track'])
+        parent = [self._parent.get(t) for t in tracks]
+        ann['mitosis_parent'] = pd.Series(parent, index=ann.index, dtype=object)
+        ann['m_exit'] = pd.Series([None if parent[i] is None else self._daug[parent[i]][tracks[i]]['m_exit']
+                                   for i in range(len(tracks))], index=ann.index, dtype=object)
+        ann['mitosis_daughter'] = [''.join(['/' + str(d) for d in self._daug.get(t, {}).keys()]) for t in tracks]
+        ann['mitosis_identity'] = [('/daughter' if parent[i] is not None else '') +
+                                   '/parent' * len(self._daug.get(tracks[i], {})) for i in range(len(tracks))]
+        if m_entry:
+            ann['m_entry'] = pd.Series([self._div.get(t) for t in tracks], index=ann.index, dtype=object)
+        return ann
+
+    def copy(self):
+        """Copy of the graph, relationships can be changed independently.
+        """
+        graph = LineageGraph()
+        graph._div = self._div.copy()
+        graph._daug = {par: {d: dict(info) for d, info in daugs.items()} for par, daugs in self._daug.items()}
+        graph._parent = self._parent.copy()
+        return graph
+
+    def add(self, parent, daughter, m_exit=None, dist=None, m_entry=None):
+        """Register a parent-daughter relationship. Mitosis entry is only taken when the parent is new.
+
+        Args:
+            parent (int): parent track ID.
+            daughter (int): daughter track ID.
+            m_exit (int): mitosis exit frame of the daughter.
+            dist (float): distance or association score.
+            m_entry (int): mitosis entry frame of the parent.
+        """
+        if parent == daughter:
+            raise ValueError('Track ' + str(parent) + ' cannot be its own daughter.')
+        if parent not in self._daug.keys():
+            self._div[parent] = m_entry
+            self._daug[parent] = {}
+        self._daug[parent][daughter] = {'m_exit': m_exit, 'dist': dist}
+        self._parent[daughter] = parent
+        return
+
+    def remove(self, parent, daughter):
+        """Remove a parent-daughter relationship, parent without daughter is dropped.
+
+        Args:
+            parent (int): parent track ID.
+            daughter (int): daughter track ID.
+        """
+        if daughter not in self._daug.get(parent, {}).keys():
+            raise ValueError('Track ' + str(daughter) + ' is not a daughter of ' + str(parent) + '.')
+        del self._daug[parent][daughter]
+        if self._parent.get(daughter) == parent:
+            del self._parent[daughter]
+        if len(self._daug[parent]) == 0:
+            del self._daug[parent], self._div[parent]
+        return
+
+    def set_dist(self, parent, daughter, dist):
+        """Update distance or association score of a relationship.
+        """
+        self._daug[parent][daughter]['dist'] = dist
+        return
+
+    def parent(self, daughter):
+        """Parent track ID, None if the track has no parent.
+        """
+        return self._parent.get(daughter)
+
+    def daughters(self, parent):
+        """List of daughter track IDs, in registration order.
+        """
+        return list(self._daug.get(parent, {}).keys())
+
+    def descendants(self, track_id):
+        """List of all daughters, granddaughters ... of a track.
+        """
+        out = []
+        seen = {track_id}
+        queue = [track_id]
+        while queue:
+            for d in self._daug.get(queue.pop(0), {}).keys():
+                if d not in seen:
+                    seen.add(d)
+                    out.append(d)
+                    queue.append(d)
+        return out
+
+    def m_entry(self, parent):
+        """Mitosis entry frame of a parent.
+        """
+        return self._div[parent]
+
+    def m_exit(self, daughter):
+        """Mitosis exit frame of a daughter.
+        """
+        return self._daug[self._parent[daughter]][daughter]['m_exit']
+
+    def parents(self):
+        """List of parent track IDs, in registration order.
+        """
+        return list(self._daug.keys())
+
+    def relations(self):
+        """List of (parent, daughter) pairs, in registration order.
+        """
+        return [(par, d) for par in self._daug.keys() for d in self._daug[par].keys()]
+
+    def __contains__(self, parent):
+        return parent in self._daug
+
+    def __len__(self):
+        return len(self._daug)
+
+    def __iter__(self):
+        return iter(list(self._daug.keys()))
+
+
 def find_daugs(track, track_id):
-    """Return list of daughters according to certain parent track ID.
+    """Return list of daughters according to certain parent track ID. Scans the table recursively, for repeated
+    lookup, build a `LineageGraph.from_track()` and use `LineageGraph.descendants()`.
 
     Args:
         track (pandas.DataFrame): tracked object table.
@@ -458,17 +1140,98 @@ def expand_bbox(bbox, factor, limit):
     return tuple(new_bbox)
 
 
+def expand_bbox_array(bbox, factor, limit):
+    """Vectorized `expand_bbox()` over many bounding boxes.
+
+    Args:
+        bbox (numpy.ndarray): bounding boxes (N*4) as (x1, y1, x2, y2).
+        factor (float): positive value, see `expand_bbox()`.
+        limit (tuple): (x_max, y_max), limit values to avoid boundary crush.
+
+    Returns:
+        (numpy.ndarray): new bounding boxes (N*4), integer.
+    """
+    if factor < 0:
+        raise ValueError('Must expand bounding box with a positive factor.')
+
+    bbox = np.asarray(bbox, dtype='float64').reshape(-1, 4)
+    h = bbox[:, 2] - bbox[:, 0]
+    w = bbox[:, 3] - bbox[:, 1]
+    factor = factor / 2
+    new_bbox = np.round(np.stack([bbox[:, 0] - factor * h, bbox[:, 1] - factor * w,
+                                  bbox[:, 2] + factor * h, bbox[:, 3] + factor * w], axis=1)).astype('int64')
+    new_bbox[:, :2] = np.maximum(new_bbox[:, :2], 0)
+    new_bbox[new_bbox[:, 2] >= limit[0], 2] = limit[0] - 1
+    new_bbox[new_bbox[:, 3] >= limit[1], 3] = limit[1] - 1
+    return new_bbox
+
+
+def _rect_sum(img, bbox):
+    """Sum of `img` within each bounding box (x1, y1, x2, y2), end exclusive, by summed-area table.
+    """
+    sat = np.zeros((img.shape[0] + 1, img.shape[1] + 1), dtype=img.dtype)
+    sat[1:, 1:] = img.cumsum(axis=0).cumsum(axis=1)
+    x1, y1, x2, y2 = bbox[:, 0], bbox[:, 1], bbox[:, 2], bbox[:, 3]
+    return sat[x2, y2] - sat[x1, y2] - sat[x2, y1] + sat[x1, y1]
+
+
+def get_object_intensity(mask, labels, bbox, intensity, bf, bbox_factor=2):
+    """Measure intensity features of all objects in a labeled slice in one pass.
+
+    Per object, the background is the unlabeled area within its bounding box expanded by `bbox_factor`
+    (see `expand_bbox()`); foreground statistics are drawn from the object pixels in the same region.
+
+    Args:
+        mask (numpy.ndarray): labeled object mask slice (H*W).
+        labels (numpy.ndarray): object labels to measure (N).
+        bbox (numpy.ndarray): bounding boxes of the objects (N*4), as returned by `skimage.measure.regionprops`.
+        intensity (numpy.ndarray): PCNA intensity slice (H*W).
+        bf (numpy.ndarray): bright field intensity slice (H*W).
+        bbox_factor (float): expand factor of the bounding box when calculating background intensity.
+
+    Returns:
+        dict: `mean_intensity`, `background_mean`, `BF_mean` and `BF_std` of each object, as numpy.ndarray (N).
+            Background mean is `nan` if no background pixel in the expanded bounding box.
+    """
+    labels = np.asarray(labels, dtype='int64')
+    ebox = expand_bbox_array(bbox, bbox_factor, mask.shape)
+
+    # background: sum and count of unlabeled pixels within each (overlapping) expanded box
+    bg = mask == 0
+    bg_sum = _rect_sum(np.where(bg, intensity, 0).astype('float64'), ebox)
+    bg_count = _rect_sum(bg.astype('int64'), ebox)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        background = bg_sum / bg_count
+
+    # foreground: expanded boxes never reach the last row/column (see `expand_bbox()`), so exclude them
+    lb = mask[:-1, :-1].ravel().astype('int64')
+    n = max(int(lb.max(initial=0)), int(labels.max(initial=0))) + 1
+    count = np.bincount(lb, minlength=n)[labels]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        its = intensity[:-1, :-1].ravel().astype('float64')
+        mean_its = np.bincount(lb, weights=its, minlength=n)
+        mean_its = mean_its[labels] / count
+        dic = bf[:-1, :-1].ravel().astype('float64')
+        mean_bf = np.bincount(lb, weights=dic, minlength=n)
+        mean_bf = mean_bf / np.bincount(lb, minlength=n)
+        std_bf = np.sqrt(np.bincount(lb, weights=(dic - mean_bf[lb]) ** 2, minlength=n)[labels] / count)
+        mean_bf = mean_bf[labels]
+
+    return {'mean_intensity': mean_its, 'background_mean': background, 'BF_mean': mean_bf, 'BF_std': std_bf}
+
+
 def align_table_and_mask(table, mask):
     """For every object in the mask, check if is consistent with the table. If no, remove the object in the mask.
 
     Args:
         table (pandas.DataFrame): (tracked) object table.
-        mask (numpy.ndarray): labeled object mask, object label should be corresponding to `continuous_label` column in the table.
+        mask (numpy.ndarray or MaskStore): labeled object mask, object label should be corresponding to
+            `continuous_label` column in the table. A writable `MaskStore` is modified frame by frame on disk.
     """
     count = 0
     for i in range(mask.shape[0]):
         sub = table[table['frame'] == i]
-        sls = mask[i,:,:].copy()
+        sls = mask[i].copy()
         lbs = sorted(list(np.unique(sls)))
         if lbs[0] == 0:
             del lbs[0]
@@ -478,7 +1241,7 @@ def align_table_and_mask(table, mask):
             for j in rmd:
                 sls[sls == j] = 0
                 count += 1
-            mask[i,:,:] = sls
+            mask[i] = sls
 
     print('Removed ' + str(count) + ' objects.')
     return mask
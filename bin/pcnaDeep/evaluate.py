@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import os
 import subprocess
+import tempfile
 from pcnaDeep.data.annotate import relabel_trackID, label_by_track, get_lineage_txt, break_track, save_seq
+from pcnaDeep.data.utils import MaskStore
 
 
 class pcna_ctcEvaluator:
@@ -40,17 +42,31 @@ class pcna_ctcEvaluator:
         """Generate standard format for Cell Tracking Challenge Evaluation, for RES or GT.
 
         Args:
-            mask (numpy.ndarray): mask output, no need to have cell cycle labeled
+            mask (numpy.ndarray or MaskStore): mask output, no need to have cell cycle labeled.
+                A `MaskStore` is relabeled frame by frame through a temporary file, without loading the stack.
             track (pandas.DataFrame): tracked object table, can have gaped tracks
             mode (str): either "RES" or "GT".
         """
         track_new = relabel_trackID(track.copy())
         track_new = break_track(track_new.copy())
-        tracked_mask = label_by_track(mask.copy(), track_new.copy())
         txt = get_lineage_txt(track_new)
         fm = ("%0" + str(self.digit_num) + "d") % self.dt_id
+        if isinstance(mask, MaskStore):
+            with tempfile.TemporaryDirectory(dir=self.root) as tmp:
+                tracked_mask = MaskStore(os.path.join(tmp, 'tracked_mask.tif'), shape=mask.shape, dtype='uint16')
+                label_by_track(mask, track_new.copy(), out=tracked_mask)
+                self.__write_ctc(fm, txt, tracked_mask, mode)
+                tracked_mask.close()
+            return
+
+        tracked_mask = label_by_track(mask.copy(), track_new.copy())
         tracked_mask = tracked_mask.astype('uint16')
+        self.__write_ctc(fm, txt, tracked_mask, mode)
+        return
 
+    def __write_ctc(self, fm, txt, tracked_mask, mode):
+        """Write relabeled mask and lineage table in Cell Tracking Challenge format.
+        """
         if mode == 'RES':
             # write out processed files for RES folder
             save_seq(tracked_mask, os.path.join(self.root, fm + '_RES'), 'mask', dig_num=self.digit_num, base=self.t_base, sep='')
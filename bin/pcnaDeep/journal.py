@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import pickle
+import shutil
+import numpy as np
+
+
+class DetectJournal:
+
+    def __init__(self, root, shape, key=None):
+        """On-disk journal of detection results, appended frame by frame so an interrupted run can be resumed.
+
+        The journal directory holds the label images in a raw file of fixed-size records, and the object table of each
+        frame pickled one after another. A frame counts as complete once both are written, a record cut short by a
+        crash is dropped when the journal is opened again.
+
+        Args:
+            root (str): journal directory.
+            shape (tuple): (T, H, W) of the label images.
+            key (str): identifies the input and parameters of the run, a journal of another key is not resumed.
+        """
+        self.root = root
+        self.shape = tuple([int(s) for s in shape])
+        self.key = key
+        self.dtype = np.dtype('uint16')
+        self.frame_bytes = self.shape[1] * self.shape[2] * self.dtype.itemsize
+        self.n_frame = 0
+        self._mask_fp = os.path.join(root, 'mask.raw')
+        self._table_fp = os.path.join(root, 'objects.pkl')
+        self._meta_fp = os.path.join(root, 'meta.json')
+        self._mask = None
+        self._table = None
+        self.logger = logging.getLogger('pcna.Journal')
+
+    def open(self, resume=False):
+        """Open the journal for appending.
+
+        Args:
+            resume (bool): keep complete frames of a previous run with the same shape and key, otherwise start over.
+
+        Returns:
+            (int): number of complete frames, i.e. index of the next frame to append.
+        """
+        meta = {'shape': list(self.shape), 'key': self.key}
+        self.n_frame = 0
+        if resume and os.path.isfile(self._meta_fp):
+            with open(self._meta_fp, 'r') as f:
+                old = json.load(f)
+            if old == meta:
+                self.n_frame, table_end = self._count()
+                os.truncate(self._mask_fp, self.n_frame * self.frame_bytes)
+                os.truncate(self._table_fp, table_end)
+            else:
+                self.logger.warning('Journal at ' + self.root + ' is of another input or config, start over.')
+        elif resume:
+            self.logger.warning('No journal found at ' + self.root + ', start over.')
+        if self.n_frame == 0:
+            shutil.rmtree(self.root, ignore_errors=True)
+            os.makedirs(self.root)
+            with open(self._meta_fp, 'w') as f:
+                json.dump(meta, f)
+            open(self._mask_fp, 'wb').close()
+            open(self._table_fp, 'wb').close()
+        self._mask = open(self._mask_fp, 'ab')
+        self._table = open(self._table_fp, 'ab')
+        return self.n_frame
+
+    def _count(self):
+        """Complete frames on disk, and the end offset of their tables.
+        """
+        n_mask = os.path.getsize(self._mask_fp) // self.frame_bytes if os.path.isfile(self._mask_fp) else 0
+        n_table = 0
+        end = 0
+        if os.path.isfile(self._table_fp):
+            with open(self._table_fp, 'rb') as f:
+                while n_table < n_mask:
+                    try:
+                        pickle.load(f)
+                    except (EOFError, pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+                        break
+                    n_table += 1
+                    end = f.tell()
+        return n_table, end
+
+    def append(self, frame, label, props):
+        """Write results of the next frame. The label image is written first, the table marks the frame complete.
+
+        Args:
+            frame (int): frame index, must follow the last complete frame.
+            label (numpy.ndarray): label image (H*W).
+            props (pandas.DataFrame): object table of the frame.
+        """
+        if frame != self.n_frame:
+            raise ValueError('Journal expects frame ' + str(self.n_frame) + ', got ' + str(frame))
+        self._mask.write(np.ascontiguousarray(label, dtype=self.dtype).tobytes())
+        self._mask.flush()
+        pickle.dump(props, self._table, protocol=pickle.HIGHEST_PROTOCOL)
+        # flushed data survive the process being killed, which is the case of preemption
+        self._table.flush()
+        self.n_frame += 1
+
+    def replay(self):
+        """Read back complete frames in order.
+
+        Yields:
+            tuple: frame index, label image and object table, same as `predictStack()`.
+        """
+        mask = np.memmap(self._mask_fp, dtype=self.dtype, mode='r', shape=(self.n_frame,) + self.shape[1:]) \
+            if self.n_frame else None
+        with open(self._table_fp, 'rb') as f:
+            for i in range(self.n_frame):
+                yield i, np.array(mask[i]), pickle.load(f)
+        del mask
+
+    def close(self):
+        for f in [self._mask, self._table]:
+            if f is not None:
+                f.close()
+        self._mask = None
+        self._table = None
@@ -2,7 +2,10 @@
 # Modified by Yifan Gui from FAIR Detectron2, Apache 2.0 licence.
 import atexit
 import bisect
+from collections import deque
 import multiprocessing as mp
+import queue
+import time
 import torch
 import numpy as np
 import skimage.measure as measure
@@ -13,7 +16,8 @@ import pandas as pd
 from detectron2.data import MetadataCatalog
 from detectron2.engine.defaults import DefaultPredictor
 from detectron2.utils.visualizer import ColorMode, Visualizer
-from pcnaDeep.data.utils import filter_edge, expand_bbox
+from pcnaDeep.data.utils import filter_edge, get_object_intensity
+from pcnaDeep.split import tile_grid, stitch_instances
 
 
 class VisualizationDemo(object):
@@ -38,7 +42,7 @@ class VisualizationDemo(object):
             num_gpu = torch.cuda.device_count()
             self.predictor = AsyncPredictor(cfg, num_gpus=num_gpu)
         else:
-            self.predictor = DefaultPredictor(cfg)
+            self.predictor = BatchPredictor(cfg)
 
     def run_on_image(self, image, vis=True):
         """
@@ -76,6 +80,47 @@ class VisualizationDemo(object):
 
         return predictions, vis_output
 
+    def run_on_batch(self, images):
+        """Run the model on several images at once, without visualization.
+
+        Args:
+            images (list(numpy.ndarray)): images of shape (H, W, C) (in BGR order).
+
+        Returns:
+            list(dict): the output of the model for each image, in input order.
+        """
+        if self.parallel:
+            for image in images:
+                self.predictor.put(image)
+            return [self.predictor.get() for _ in range(len(images))]
+        return self.predictor.run_batch(images)
+
+
+class BatchPredictor(DefaultPredictor):
+    """
+    Extends detectron2 DefaultPredictor to take several images through a single model forward pass.
+    Single image call (`__call__`) is inherited and behaves as DefaultPredictor.
+    """
+
+    def run_batch(self, original_images):
+        """
+        Args:
+            original_images (list(numpy.ndarray)): images of shape (H, W, C) (in BGR order).
+
+        Returns:
+            list(dict): the output of the model for each image, in input order.
+        """
+        with torch.no_grad():
+            inputs = []
+            for original_image in original_images:
+                if self.input_format == "RGB":
+                    original_image = original_image[:, :, ::-1]
+                height, width = original_image.shape[:2]
+                image = self.aug.get_transform(original_image).apply_image(original_image)
+                image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+                inputs.append({"image": image, "height": height, "width": width})
+            return self.model(inputs)
+
 
 class AsyncPredictor:
     """
@@ -171,6 +216,169 @@ class AsyncPredictor:
         return len(self.procs) * 5
 
 
+class PostprocessPool:
+    """
+    Post-process model predictions in a pool of worker processes, so that the CPU-heavy mask relabeling and
+    region properties of one frame run while the model is working on the next.
+    Follows the queueing scheme of `AsyncPredictor`: bounded task/result queues, results are returned in
+    submission order. A frame failing in a worker, or a worker that died, raises `WorkerError` from `get()`.
+    """
+
+    class _StopToken:
+        pass
+
+    class WorkerError(RuntimeError):
+        pass
+
+    class _PostprocessWorker(mp.Process):
+        def __init__(self, task_queue, result_queue, size_flt, edge_flt, on_device, tile_iou):
+            self.task_queue = task_queue
+            self.result_queue = result_queue
+            self.size_flt = size_flt
+            self.edge_flt = edge_flt
+            self.on_device = on_device
+            self.tile_iou = tile_iou
+            super().__init__()
+
+        def run(self):
+
+            while True:
+                task = self.task_queue.get()
+                if isinstance(task, PostprocessPool._StopToken):
+                    break
+                idx, (img, frame_id, mask, cls, conf) = task
+                try:
+                    if isinstance(mask, dict):
+                        # instances of tiles, see `put_crops()`
+                        mask_slice, cls, conf = stitch_instances(mask, img.shape[:2], iou_trh=self.tile_iou)
+                    elif self.on_device:
+                        mask_slice = mask.numpy()
+                    else:
+                        mask_slice = resolve_overlap(mask.char().numpy(), conf, size_flt=self.size_flt)
+                    result = postprocessFrame(img, frame_id, mask_slice, cls, conf,
+                                              size_flt=self.size_flt, edge_flt=self.edge_flt)
+                except Exception as e:
+                    # raised by `get()` in the main process, as a plain message in case the error does not pickle
+                    result = PostprocessPool.WorkerError('Post-processing of frame {} failed, {}: {}'.format(
+                        frame_id, type(e).__name__, e))
+                self.result_queue.put((idx, result))
+
+    def __init__(self, num_workers=1, size_flt=1000, edge_flt=50, resolve_on_device=False, tile_iou=0.5):
+        """
+        Args:
+            num_workers (int): number of post-processing processes.
+            size_flt (int): size filter, in pixel^2.
+            edge_flt (int): filter objects at the edge, in pixel.
+            resolve_on_device (bool): resolve instance overlap on the model device before submitting,
+                see `resolve_overlap_tensor()`.
+            tile_iou (float): IoU to merge duplicates of tiled frames, see `stitch_instances()`.
+        """
+        self.resolve_on_device = resolve_on_device
+        num_workers = max(num_workers, 1)
+        self.task_queue = mp.Queue(maxsize=num_workers * 3)
+        self.result_queue = mp.Queue(maxsize=num_workers * 3)
+        self.size_flt = size_flt
+        self.procs = [PostprocessPool._PostprocessWorker(self.task_queue, self.result_queue, size_flt, edge_flt,
+                                                         resolve_on_device, tile_iou)
+                      for _ in range(num_workers)]
+
+        self.put_idx = 0
+        self.get_idx = 0
+        self.result_rank = []
+        self.result_data = []
+
+        for p in self.procs:
+            p.start()
+        self.closed = False
+        atexit.register(self.shutdown)
+
+    def put(self, img, frame_id, instances):
+        """Submit the predicted instances of one frame.
+
+        Args:
+            img (numpy.ndarray): `uint8` image slice (H*W*C) the instances were predicted from.
+            frame_id (int): index of the slice, start from 0.
+            instances (detectron2.structures.Instances): model prediction of the slice.
+        """
+        self.put_idx += 1
+        # CPU tensors are passed to workers through shared memory rather than pickled
+        if self.resolve_on_device:
+            mask = resolve_overlap_tensor(instances.pred_masks, instances.scores_all, size_flt=self.size_flt).cpu()
+        else:
+            mask = instances.pred_masks.cpu()
+        cls = instances.pred_classes.cpu().numpy()
+        conf = instances.scores_all.cpu().numpy()
+        self.task_queue.put((self.put_idx, (img, frame_id, mask, cls, conf)))
+
+    def put_crops(self, img, frame_id, crops):
+        """Submit the instances of all tiles of one frame, to be stitched by the worker.
+
+        Args:
+            img (numpy.ndarray): `uint8` image slice (H*W*C).
+            frame_id (int): index of the slice, start from 0.
+            crops (dict): instances of the tiles, see `instances_to_crops()`.
+        """
+        self.put_idx += 1
+        self.task_queue.put((self.put_idx, (img, frame_id, crops, None, None)))
+
+    def get(self):
+        self.get_idx += 1  # the index needed for this request
+        if len(self.result_rank) and self.result_rank[0] == self.get_idx:
+            res = self.result_data[0]
+            del self.result_data[0], self.result_rank[0]
+            return res
+
+        while True:
+            # make sure the results are returned in the correct order
+            try:
+                idx, res = self.result_queue.get(timeout=1)
+            except queue.Empty:
+                dead = [p.exitcode for p in self.procs if not p.is_alive()]
+                if dead:
+                    raise PostprocessPool.WorkerError('Post-processing worker exited with code ' + str(dead[0]))
+                continue
+            if isinstance(res, PostprocessPool.WorkerError):
+                raise res
+            if idx == self.get_idx:
+                return res
+            insert = bisect.bisect(self.result_rank, idx)
+            self.result_rank.insert(insert, idx)
+            self.result_data.insert(insert, res)
+
+    def __len__(self):
+        return self.put_idx - self.get_idx
+
+    def shutdown(self):
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.shutdown)
+        tokens = sum([p.is_alive() for p in self.procs])
+        deadline = time.time() + 10
+        while time.time() < deadline and any([p.is_alive() for p in self.procs]):
+            while tokens:
+                try:
+                    self.task_queue.put_nowait(PostprocessPool._StopToken())
+                    tokens -= 1
+                except queue.Full:
+                    break
+            # drop results never read, e.g. after an error, workers can not exit before they are flushed
+            try:
+                self.result_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        for p in self.procs:
+            if p.is_alive():
+                p.terminate()
+            p.join()
+        # tasks left are never taken, do not wait to flush them at exit
+        self.task_queue.cancel_join_thread()
+
+    @property
+    def default_buffer_size(self):
+        return len(self.procs) * 2
+
+
 def pred2json(mask, label_table, fp):
     """Transform detectron2 prediction to VIA2 (VGG Image Annotator) json format.
 
@@ -249,7 +457,7 @@ def pred2json(mask, label_table, fp):
     return tmp
 
 
-def predictFrame(img, frame_id, demonstrator, is_gray=False, size_flt=1000, edge_flt=50):
+def predictFrame(img, frame_id, demonstrator, is_gray=False, size_flt=1000, edge_flt=50, resolve_on_device=False):
     """Predict single frame and deduce meta information.
     
     Args:
@@ -259,6 +467,7 @@ def predictFrame(img, frame_id, demonstrator, is_gray=False, size_flt=1000, edge
         size_flt (int): size filter, in pixel^2.
         is_gray (bool): whether the slice is gray. If true, will convert to 3 channels at first.
         edge_flt (int): filter objects at the edge, whose classification may be imprecise, in pixel.
+        resolve_on_device (bool): resolve instance overlap on the model device, see `resolve_overlap_tensor()`.
 
     Returns:
         tuple: labeled mask and corresponding table.
@@ -268,17 +477,248 @@ def predictFrame(img, frame_id, demonstrator, is_gray=False, size_flt=1000, edge
         img = np.stack([img, img, img], axis=2)  # convert gray to 3 channels
     # Generate mask or visualized output
     predictions = demonstrator.run_on_image(img, vis=False)
+    return processInstances(img, frame_id, predictions['instances'], size_flt=size_flt, edge_flt=edge_flt,
+                            resolve_on_device=resolve_on_device)
 
-    # Generate mask
-    mask = predictions['instances'].pred_masks
-    mask = mask.char().cpu().numpy()
-    mask_slice = np.zeros((mask.shape[1], mask.shape[2])).astype('uint16')  # uint16 locks object detection within 65536
 
-    # For visualising class prediction
-    # 0: G1/G2, 1: S, 2: M, 3: E-early G1
-    cls = predictions['instances'].pred_classes
-    conf = predictions['instances'].scores_all.cpu().numpy()
-    factor = {0: 'G1/G2', 1: 'S', 2: 'M', 3: 'E'}
+def predictBatch(imgs, frame_ids, demonstrator, is_gray=False, size_flt=1000, edge_flt=50, resolve_on_device=False):
+    """Predict several frames through one model forward pass and deduce meta information of each.
+
+    Args:
+        imgs (numpy.ndarray): `uint8` image slices (N*H*W*C), or (N*H*W) if `is_gray`.
+        frame_ids (list(int)): index of each slice, start from 0.
+        demonstrator (VisualizationDemo): an detectron2 demonstrator object.
+        is_gray (bool): whether the slices are gray. If true, will convert to 3 channels at first.
+        size_flt (int): size filter, in pixel^2.
+        edge_flt (int): filter objects at the edge, whose classification may be imprecise, in pixel.
+        resolve_on_device (bool): resolve instance overlap on the model device, see `resolve_overlap_tensor()`.
+
+    Returns:
+        list(tuple): labeled mask and corresponding table of each frame, same as `predictFrame()`.
+    """
+    if len(imgs) != len(frame_ids):
+        raise ValueError('Image count and frame index count do not match.')
+    if is_gray:
+        imgs = [np.stack([img, img, img], axis=2) for img in imgs]
+    else:
+        imgs = [img for img in imgs]
+
+    predictions = demonstrator.run_on_batch(imgs)
+    return [processInstances(imgs[i], frame_ids[i], predictions[i]['instances'], size_flt=size_flt, edge_flt=edge_flt,
+                             resolve_on_device=resolve_on_device) for i in range(len(imgs))]
+
+
+def predictStack(stack, demonstrator, is_gray=False, size_flt=1000, edge_flt=50, batch_size=1, num_workers=0,
+                     resolve_on_device=False, start=0, tile_size=0, tile_overlap=64, tile_iou=0.5):
+    """Predict frames of a stack in order, yielding results frame by frame.
+
+    Args:
+        stack (iterable): `uint8` image slices (H*W*C), or (H*W) if `is_gray`, e.g., a T*H*W*C array.
+        demonstrator (VisualizationDemo): an detectron2 demonstrator object.
+        is_gray (bool): whether the slices are gray. If true, will convert to 3 channels at first.
+        size_flt (int): size filter, in pixel^2.
+        edge_flt (int): filter objects at the edge, whose classification may be imprecise, in pixel.
+        batch_size (int): frames sent through the model in one forward pass.
+        num_workers (int): post-processing processes. If positive, the model predicts the next batch while the
+            workers post-process the previous ones (see `PostprocessPool`); if 0, run sequentially.
+        resolve_on_device (bool): resolve instance overlap on the model device, see `resolve_overlap_tensor()`.
+        start (int): frame index of the first slice, e.g. when resuming an interrupted stack.
+        tile_size (int): if positive, predict overlapping tiles of the size instead of whole frames, see
+            `predictTiledStack()`. `batch_size` then counts tiles.
+        tile_overlap (int): minimum overlap of neighbouring tiles, in pixel.
+        tile_iou (float): IoU to merge duplicate detections in tile overlaps.
+
+    Yields:
+        tuple: frame index, labeled mask and corresponding table, same as `predictFrame()`.
+    """
+    if tile_size > 0:
+        yield from predictTiledStack(stack, demonstrator, tile_size, overlap=tile_overlap, iou_trh=tile_iou,
+                                     is_gray=is_gray, size_flt=size_flt, edge_flt=edge_flt, batch_size=batch_size,
+                                     num_workers=num_workers, start=start)
+        return
+    pool = None
+    if num_workers > 0:
+        pool = PostprocessPool(num_workers=num_workers, size_flt=size_flt, edge_flt=edge_flt,
+                               resolve_on_device=resolve_on_device)
+    pending = deque()  # frame index of submitted frames whose results are not returned yet, in order
+
+    def _run(imgs):
+        if is_gray:
+            imgs = [np.stack([img, img, img], axis=2) for img in imgs]
+        if pool is None:
+            for rs in predictBatch(imgs, list(pending), demonstrator, size_flt=size_flt, edge_flt=edge_flt,
+                                   resolve_on_device=resolve_on_device):
+                yield (pending.popleft(),) + rs
+            return
+        predictions = demonstrator.run_on_batch(imgs)
+        for i in range(len(imgs)):
+            pool.put(imgs[i], pending[len(pool)], predictions[i]['instances'])
+            while len(pool) > pool.default_buffer_size:
+                yield (pending.popleft(),) + pool.get()
+
+    try:
+        imgs = []
+        for frame_id, img in enumerate(stack, start):
+            imgs.append(img)
+            pending.append(frame_id)
+            if len(imgs) == batch_size:
+                yield from _run(imgs)
+                imgs = []
+        if imgs:
+            yield from _run(imgs)
+        while pool is not None and len(pool):
+            yield (pending.popleft(),) + pool.get()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def predictTiledStack(stack, demonstrator, tile_size, overlap=64, iou_trh=0.5, is_gray=False, size_flt=1000,
+                      edge_flt=50, batch_size=1, num_workers=0, start=0):
+    """Predict frames of a stack by overlapping tiles, yielding stitched results frame by frame.
+
+    Frames of any size are cut by `tile_grid()`, tiles of consecutive frames are sent through the model in batches of
+    `batch_size`, so that the memory of the model is bound by the tile size rather than the frame size. Instances of
+    all tiles of a frame are merged by `stitch_instances()` before the usual post-processing.
+
+    Args:
+        stack (iterable): `uint8` image slices (H*W*C), or (H*W) if `is_gray`.
+        demonstrator (VisualizationDemo): an detectron2 demonstrator object.
+        tile_size (int): tile height and width.
+        overlap (int): minimum overlap of neighbouring tiles, should exceed the size of an object.
+        iou_trh (float): IoU to merge duplicate detections in tile overlaps.
+        is_gray (bool): whether the slices are gray. If true, will convert to 3 channels at first.
+        size_flt (int): size filter, in pixel^2.
+        edge_flt (int): filter objects at the edge of the frame, in pixel.
+        batch_size (int): tiles sent through the model in one forward pass.
+        num_workers (int): post-processing processes, which also stitch the tiles, see `PostprocessPool`.
+        start (int): frame index of the first slice.
+
+    Yields:
+        tuple: frame index, labeled mask and corresponding table, same as `predictFrame()`.
+    """
+    pool = None
+    if num_workers > 0:
+        pool = PostprocessPool(num_workers=num_workers, size_flt=size_flt, edge_flt=edge_flt, tile_iou=iou_trh)
+    pending = deque()  # frame index of frames submitted to the pool, in order
+    frames = {}  # frame index -> [image, tile count, instances of predicted tiles]
+
+    def _finish(frame_id):
+        img, _, crops = frames.pop(frame_id)
+        crops = {k: np.concatenate([c[k] for c in crops]) if k != 'mask' else sum([c[k] for c in crops], [])
+                 for k in crops[0]}
+        if pool is None:
+            mask_slice, cls, conf = stitch_instances(crops, img.shape[:2], iou_trh=iou_trh)
+            yield (frame_id,) + postprocessFrame(img, frame_id, mask_slice, cls, conf, size_flt=size_flt,
+                                                 edge_flt=edge_flt)
+            return
+        pool.put_crops(img, frame_id, crops)
+        pending.append(frame_id)
+        while len(pool) > pool.default_buffer_size:
+            yield (pending.popleft(),) + pool.get()
+
+    def _run(batch):
+        predictions = demonstrator.run_on_batch([tile for _, _, tile in batch])
+        for (frame_id, box, _), pred in zip(batch, predictions):
+            frame = frames[frame_id]
+            frame[2].append(instances_to_crops(pred['instances'], box, frame[0].shape[:2], len(frame[2]),
+                                               size_flt=size_flt))
+            if len(frame[2]) == frame[1]:
+                yield from _finish(frame_id)
+
+    try:
+        batch = []
+        for frame_id, img in enumerate(stack, start):
+            if is_gray:
+                img = np.stack([img, img, img], axis=2)
+            grid = tile_grid(img.shape[0], img.shape[1], tile_size, overlap=overlap)
+            frames[frame_id] = [img, len(grid), []]
+            for box in grid:
+                batch.append((frame_id, box, img[box[0]:box[2], box[1]:box[3]]))
+                if len(batch) == batch_size:
+                    yield from _run(batch)
+                    batch = []
+        if batch:
+            yield from _run(batch)
+        while pool is not None and len(pool):
+            yield (pending.popleft(),) + pool.get()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def instances_to_crops(instances, box, shape, tile_id, size_flt=1000):
+    """Transfer detectron2 instances of a tile to host as bounding box local masks in frame coordinates.
+
+    Args:
+        instances (detectron2.structures.Instances): model prediction of the tile.
+        box (tuple): (row_start, col_start, row_end, col_end) of the tile in the frame.
+        shape (tuple): frame height and width.
+        tile_id (int): index of the tile in the frame.
+        size_flt (int): instances smaller than the size (pixel^2) are ignored, as in `resolve_overlap()`.
+
+    Returns:
+        dict: `bbox`, `mask`, `cls`, `conf`, `cut` and `tile` of instances, see `stitch_instances()`.
+    """
+    mask = instances.pred_masks.cpu().numpy().astype('bool')
+    cls = instances.pred_classes.cpu().numpy()
+    conf = instances.scores_all.cpu().numpy()
+    keep = np.nonzero(mask.sum(axis=(1, 2)) >= max(size_flt, 1))[0]
+    mask = mask[keep]
+    rows = mask.any(axis=2)
+    cols = mask.any(axis=1)
+    # first and last foreground row and column of each mask
+    bbox = np.stack([rows.argmax(axis=1), cols.argmax(axis=1),
+                     rows.shape[1] - rows[:, ::-1].argmax(axis=1), cols.shape[1] - cols[:, ::-1].argmax(axis=1)],
+                    axis=1).astype('int64').reshape(-1, 4)
+    # cut by a tile border inside the frame, the object may extend into the neighbouring tile
+    h, w = box[2] - box[0], box[3] - box[1]
+    cut = ((bbox[:, 0] == 0) & (box[0] > 0)) | ((bbox[:, 1] == 0) & (box[1] > 0)) | \
+          ((bbox[:, 2] == h) & (box[2] < shape[0])) | ((bbox[:, 3] == w) & (box[3] < shape[1]))
+    crops = [mask[k, bbox[k, 0]:bbox[k, 2], bbox[k, 1]:bbox[k, 3]].copy() for k in range(len(keep))]
+    return {'bbox': bbox + np.array([box[0], box[1], box[0], box[1]]), 'mask': crops, 'cls': cls[keep],
+            'conf': conf[keep], 'cut': cut, 'tile': np.full(len(keep), tile_id)}
+
+
+def processInstances(img, frame_id, instances, size_flt=1000, edge_flt=50, resolve_on_device=False):
+    """Transfer detectron2 instances of a single frame to host and deduce labeled mask and object table.
+
+    Args:
+        img (numpy.ndarray): `uint8` image slice (H*W*C) the instances were predicted from.
+        frame_id (int): index of the slice, start from 0.
+        instances (detectron2.structures.Instances): model prediction, must have `pred_masks`, `pred_classes` and
+            `scores_all` fields.
+        size_flt (int): size filter, in pixel^2.
+        edge_flt (int): filter objects at the edge, in pixel.
+        resolve_on_device (bool): resolve instance overlap on the model device and only transfer the label image,
+            see `resolve_overlap_tensor()`.
+
+    Returns:
+        tuple: labeled mask and corresponding table.
+    """
+    cls = instances.pred_classes.cpu().numpy()
+    conf = instances.scores_all.cpu().numpy()
+    if resolve_on_device:
+        mask_slice = resolve_overlap_tensor(instances.pred_masks, instances.scores_all, size_flt=size_flt)
+        mask_slice = mask_slice.cpu().numpy()
+    else:
+        mask = instances.pred_masks.char().cpu().numpy()
+        mask_slice = resolve_overlap(mask, conf, size_flt=size_flt)
+    return postprocessFrame(img, frame_id, mask_slice, cls, conf, size_flt=size_flt, edge_flt=edge_flt)
+
+
+def resolve_overlap(mask, conf, size_flt=1000):
+    """Flatten instance masks into one label image. Overlapping pixels go to the instance of higher confidence.
+
+    Args:
+        mask (numpy.ndarray): instance masks (N*H*W), non-zero as foreground.
+        conf (numpy.ndarray): classification confidence of each instance (N*C).
+        size_flt (int): instances smaller than the size (pixel^2) are ignored.
+
+    Returns:
+        numpy.ndarray: `uint16` label image, object labeled with (instance index + 1).
+    """
+    mask_slice = np.zeros((mask.shape[1], mask.shape[2])).astype('uint16')  # uint16 locks object detection within 65536
     ovl_count = 0
     for s in range(mask.shape[0]):
         if np.sum(mask[s, :, :]) < size_flt:
@@ -290,7 +730,63 @@ def predictFrame(img, frame_id, demonstrator, is_gray=False, size_flt=1000, edge
             if sc <= np.max(conf[ori - 1]):
                 mask[s, mask_slice == ori] = 0
         mask_slice[mask[s, :, :] != 0] = s + 1
+    return mask_slice
+
 
+def resolve_overlap_tensor(mask, conf, size_flt=1000):
+    """Flatten instance masks into one label image on the device of the masks.
+
+    Each pixel goes to the most confident instance covering it (earlier instance on tie). Same as
+    `resolve_overlap()` wherever no more than two instances overlap; where more do, `resolve_overlap()` depends on
+    painting order while this does not.
+
+    Args:
+        mask (torch.Tensor): instance masks (N*H*W), non-zero as foreground.
+        conf (torch.Tensor): classification confidence of each instance (N*C).
+        size_flt (int): instances smaller than the size (pixel^2) are ignored.
+
+    Returns:
+        torch.Tensor: `int32` label image on the same device, object labeled with (instance index + 1).
+    """
+    CHUNK_ELEMENTS = 2 ** 26  # bound temporary memory of the reduction
+    n, h, w = mask.shape
+    out = torch.zeros((h, w), dtype=torch.int32, device=mask.device)
+    if n == 0:
+        return out
+    mask = mask.bool()
+    score = conf.max(dim=1).values.cpu().numpy()
+    # priority n for the most confident instance, down to 1; stable sort keeps the earlier instance first on tie
+    order = torch.from_numpy(np.argsort(-score, kind='stable')).to(mask.device)
+    prio = torch.empty(n, dtype=torch.int32, device=mask.device)
+    prio[order] = torch.arange(n, 0, -1, dtype=torch.int32, device=mask.device)
+    prio[mask.sum(dim=(1, 2)) < size_flt] = 0
+    lookup = torch.cat([torch.zeros(1, dtype=torch.int32, device=mask.device),
+                        (order.flip(0) + 1).to(torch.int32)])  # priority -> label
+    step = max(1, CHUNK_ELEMENTS // (n * w))
+    for r in range(0, h, step):
+        top = (mask[:, r:r + step, :] * prio[:, None, None]).amax(dim=0)
+        out[r:r + step, :] = lookup[top.long()]
+    return out
+
+
+def postprocessFrame(img, frame_id, mask_slice, cls, conf, size_flt=1000, edge_flt=50):
+    """Relabel the flattened instance mask and extract the object table of a single frame.
+
+    Args:
+        img (numpy.ndarray): `uint8` image slice (H*W*C).
+        frame_id (int): index of the slice, start from 0.
+        mask_slice (numpy.ndarray): label image from `resolve_overlap()`.
+        cls (numpy.ndarray): predicted class of each instance.
+        conf (numpy.ndarray): classification confidence of each instance (N*C).
+        size_flt (int): size filter, in pixel^2.
+        edge_flt (int): filter objects at the edge, in pixel.
+
+    Returns:
+        tuple: labeled mask and corresponding table.
+    """
+    # For visualising class prediction
+    # 0: G1/G2, 1: S, 2: M, 3: E-early G1
+    factor = {0: 'G1/G2', 1: 'S', 2: 'M', 3: 'E'}
     img_relabel = measure.label(mask_slice, connectivity=1) 
     # original segmentation may have separated region, flood and re-label it
     img_relabel = morphology.remove_small_objects(img_relabel, min_size=size_flt)
@@ -302,58 +798,30 @@ def predictFrame(img, frame_id, demonstrator, is_gray=False, size_flt=1000, edge
                              'Center_of_the_object_0', 'Center_of_the_object_1', 'mean_intensity', 
                              'major_axis', 'minor_axis']
 
-    original_labels = []
-    for i in range(props_relabel.shape[0]):
-        original_labels.append(int(mask_slice[int(props_relabel['Center_of_the_object_0'].iloc[i]), 
-                                              int(props_relabel['Center_of_the_object_1'].iloc[i])]))
     out_props = props_relabel.copy()
-    out_props['label'] = original_labels
+    lb_ori = mask_slice[out_props['Center_of_the_object_0'].values.astype('int64'),
+                        out_props['Center_of_the_object_1'].values.astype('int64')].astype('int64')
+    out_props['label'] = lb_ori
     out_props['frame'] = frame_id
 
-    phase = []
-    g_confid = []
-    s_confid = []
-    m_confid = []
-    e = []
-    background = []
-    dic_mean = []
-    dic_std = []
-    for row in range(out_props.shape[0]):
-        lb_image = int(out_props.iloc[row]['continuous_label'])
-        lb_ori = int(out_props.iloc[row]['label'])
-
-        # get background intensity
-        b1,b3,b2,b4 = expand_bbox((out_props.iloc[row]['bbox-0'], out_props.iloc[row]['bbox-1'],
-                                   out_props.iloc[row]['bbox-2'], out_props.iloc[row]['bbox-3']),
-                                  2, img_relabel.shape)
-        obj_region = img_relabel[b1:b2, b3:b4].copy()
-        its_region = img[b1:b2, b3:b4, 0].copy()
-        dic_region = img[b1:b2, b3:b4, 2].copy()
-        background.append(np.mean(its_region[obj_region == 0]))
-        dic_mean.append(np.mean(dic_region[obj_region == lb_image]))
-        dic_std.append(np.mean(dic_region[obj_region == lb_image]))
-        
-        # get confidence score and emerging status
-        p = factor[cls[lb_ori - 1].item()]
-        if p == 'E':
-            p = 'G1/G2'
-            e.append(1)
-        else:
-            e.append(0)
-        confid = conf[lb_ori - 1]
-        phase.append(p)
-        s_confid.append(confid[1])
-        g_confid.append(confid[0] + confid[3])
-        m_confid.append(confid[2])
-
-    out_props['phase'] = phase
-    out_props['Probability of G1/G2'] = g_confid
-    out_props['Probability of S'] = s_confid
-    out_props['Probability of M'] = m_confid
+    # get confidence score and emerging status
+    p = np.array([factor[int(c)] for c in cls], dtype=object)[lb_ori - 1]
+    e = (p == 'E').astype('int64')
+    p[e == 1] = 'G1/G2'
+    confid = conf[lb_ori - 1]
+    # get background and bright field intensity
+    its = get_object_intensity(img_relabel, out_props['continuous_label'].values,
+                               out_props[['bbox-0', 'bbox-1', 'bbox-2', 'bbox-3']].values,
+                               img[:, :, 0], img[:, :, 2], bbox_factor=2)
+
+    out_props['phase'] = p.tolist()
+    out_props['Probability of G1/G2'] = confid[:, 0] + confid[:, 3]
+    out_props['Probability of S'] = confid[:, 1]
+    out_props['Probability of M'] = confid[:, 2]
     out_props['emerging'] = e
-    out_props['background_mean'] = background
-    out_props['BF_mean'] = dic_mean
-    out_props['BF_std'] = dic_std
+    out_props['background_mean'] = its['background_mean']
+    out_props['BF_mean'] = its['BF_mean']
+    out_props['BF_std'] = its['BF_mean']  # historically the mean, kept for tracking parameters tuned on it
     
     del out_props['label']
     return filter_edge(img_relabel, out_props, edge_flt)
@@ -2,18 +2,16 @@
 import math
 import logging
 import warnings
-import re
 import pandas as pd
 import numpy as np
-from copy import deepcopy
 from sklearn.svm import SVC
 import skimage.morphology as morph
-from scipy.optimize import linear_sum_assignment
+from scipy.spatial import cKDTree
 from sklearn.preprocessing import RobustScaler
 from sklearn.preprocessing import MinMaxScaler
-from pcnaDeep.data.utils import get_outlier, deduce_transition
+from pcnaDeep.data.utils import get_outlier, deduce_transition, deduce_transition_batch, LineageGraph, \
+    PHASE_CODE, PHASE_NAMES, phase_codes, phase_labels, assign_by_component
 from pcnaDeep.resolver import get_rsv_input_gt
-import tqdm
 
 
 def dist(x1, y1, x2, y2):
@@ -22,12 +20,57 @@ def dist(x1, y1, x2, y2):
     return math.sqrt((float(x1) - float(x2)) ** 2 + (float(y1) - float(y2)) ** 2)
 
 
+class TrackIndex:
+
+    def __init__(self, track):
+        """Per-track index of a tracked object table, built once with a single sort.
+
+        Rows of each track are held contiguously in frame order, `index[trackId]` gives the slice of the track in
+        the column arrays, e.g. `index.frame[index[trackId]]`.
+
+        Args:
+            track (pandas.DataFrame): tracked object table.
+        """
+        self.source = track
+        trk = track['trackId'].values
+        frame = track['frame'].values
+        self.order = np.lexsort((frame, trk))  # positional (iloc) index of each row in the table
+        self.ids, self.starts, self.counts = np.unique(trk[self.order], return_index=True, return_counts=True)
+        self.spans = {}
+        for i in range(len(self.ids)):
+            self.spans[self.ids[i]] = slice(self.starts[i], self.starts[i] + self.counts[i])
+
+        self.frame = frame[self.order]
+        self.x = track['Center_of_the_object_0'].values[self.order]
+        self.y = track['Center_of_the_object_1'].values[self.order]
+        self.cls = phase_codes(track['predicted_class'])[self.order]  # phase codes, see `PHASE_NAMES`
+        self.confid = np.array(track[['Probability of G1/G2', 'Probability of S', 'Probability of M']])[self.order]
+        self.label = track['continuous_label'].values[self.order] if 'continuous_label' in track.columns else None
+        self.emerging = track['emerging'].values[self.order] if 'emerging' in track.columns else None
+        self.parent = track['parentTrackId'].values[self.order]
+        self.lineage = track['lineageId'].values[self.order]
+
+    def __getitem__(self, trackId):
+        return self.spans[trackId]
+
+    def __contains__(self, trackId):
+        return trackId in self.spans
+
+    def __len__(self):
+        return len(self.ids)
+
+    def rows(self, trackId):
+        """Rows of a track as a data frame, in frame order.
+        """
+        return self.source.iloc[self.order[self.spans[trackId]]]
+
+
 class Refiner:
 
     def __init__(self, track, smooth=5, maxBG=5, minM=10, mode='SVM',
                  threshold_mt_F=100, threshold_mt_T=25,
                  search_range=10, sample_freq=1/5, model_train='', mask=None,
-                 dilate_factor=0.5, aso_trh=0.5, dist_weight=0.8, svm_c=0.5, dt_id=None, test_id=None):
+                 dilate_factor=0.5, aso_trh=0.5, dist_weight=0.8, svm_c=0.5, dt_id=None, test_id=None, gate=False):
         """Refinement of the tracked objects.
 
         Algorithms:
@@ -41,7 +84,7 @@ class Refiner:
             maxBG (float): Maximum appearance of other phases when searching mitosis.
             minM (float): Minimum appearance of mitosis.
             mode (str): how to resolve parent-daughter relationship, either 'SVM', 'TRAIN' or 'TRH'.
-            - Essential for TRH mode:
+            - Essential for TRH mode, `threshold_mt_F` also bounds candidate pairs with `gate`:
             threshold_mt_F (int): mitosis displace maximum, can be evaluated as maximum cytokinesis distance.
             threshold_mt_T (int): mitosis frame difference maximum, can be evaluated as maximum mitosis frame length.
             - Essential for SVM/TRAIN mode (for normalizing different imaging conditions):
@@ -49,16 +92,19 @@ class Refiner:
                 Any track length shorter than search_range will not be considered during mitosis association.
             sample_freq (float): sampling frequency: x frame per minute.
             model_train (str): path to SVM model training data.
-            mask (numpy.ndarray): object masks, same shape as input, must labeled with object ID.
+            mask (numpy.ndarray or MaskStore): object masks, same shape as input, must labeled with object ID.
             dilate_factor (float): dilate the mask with `n * mean object radius`, default 0.5.
             dist_weight (float): 0~1, distance weight in calculating cost in TRH mode *only*
             svm_c (int): SVM C parameter, higher stricter.
+            gate (bool): only consider mother/daughter pairs within `threshold_mt_F` and `search_range` frames, see
+                `extract_features()`.
         """
 
         self.logger = logging.getLogger('pcna.Refiner')
         self.flag = False
         self.mask = mask
         self.track = track.copy()
+        self._track_index = None
         self.count = np.unique(track['trackId'])
 
         self.MODE = mode
@@ -66,12 +112,12 @@ class Refiner:
                          'meanDisplace': np.mean(self.getMeanDisplace()['mean_displace'])}
         self.logger.info(self.metaData)
         self.SEARCH_RANGE = search_range
+        self.FRAME_MT_TOLERANCE = threshold_mt_T
+        self.DIST_MT_TOLERANCE = threshold_mt_F
+        self.GATE = gate
         if mode == 'SVM' or mode == 'TRAIN' or mode == 'TRAIN_GT':
             self.SVM_PATH = model_train
-        elif mode == 'TRH':
-            self.FRAME_MT_TOLERANCE = threshold_mt_T
-            self.DIST_MT_TOLERANCE = threshold_mt_F
-        else:
+        elif mode != 'TRH':
             raise ValueError('Mode can only be SVM, TRAIN or TRH, for SVM-mitosis resolver, '
                              'training of the resolver or threshold based resolver.')
 
@@ -89,7 +135,7 @@ class Refiner:
         self.MIN_M = minM
         self.short_tracks = []
         self.daug_from_broken = []
-        self.mt_dic = {}
+        self.lineage = LineageGraph()
         self.par_mt_mask = {}
         self.mt_exit_lookup = {}  # {parent ID: (exit frame, quality)}
         self.mt_entry_lookup = {}  # {daughter ID: (exit frame, quality)}
@@ -102,72 +148,104 @@ class Refiner:
             columns=['track', 'app_frame', 'disapp_frame', 'app_x', 'app_y', 'disapp_x', 'disapp_y', 'app_stage',
                      'disapp_stage', 'predicted_parent'])
 
+    @property
+    def mt_dic(self):
+        """Mitosis dictionary serialized from `self.lineage`.
+        """
+        return self.lineage.to_mt_dic()
+
+    @property
+    def track_index(self):
+        """Per-track index of `self.track`, rebuilt lazily whenever the table is replaced.
+        """
+        if self._track_index is None or self._track_index.source is not self.track:
+            self._track_index = TrackIndex(self.track)
+        return self._track_index
+
     def break_mitosis(self):
-        """Break mitosis tracks; iterate until no track is broken.
+        """Break mitosis tracks in a single pass.
+
+        Tracks are searched for mitosis level by level on the track index, all segments of a level in one
+        `deduce_transition_batch` call: once a mitosis is found the track is split, and the daughter part is searched
+        at the next level from the previous mitosis exit, until no mitosis is left. New track IDs are assigned in
+        level order, then in ascending order of the track broken, the same as breaking one mitosis per track and
+        iterating until no track is broken.
+
+        Returns:
+            (pandas.DataFrame, int): tracked object table sorted by track and frame, number of mitosis found.
         """
-        track = self.track.copy()
-        cur_max = np.max(track['trackId']) + 1
-        count = 0
-        track = track.sort_values(by=['trackId', 'frame'])
-        filtered_track = pd.DataFrame(columns=track.columns)
-        for trk in list(np.unique(track['trackId'])):
-            sub = track[track['trackId'] == trk].copy()
-            if trk in list(self.mt_dic.keys()):
-                filtered_track = filtered_track.append(sub.copy())
+        index = self.track_index
+        cur_max = np.max(self.track['trackId']) + 1
+        cls = index.cls.copy()
+        m = PHASE_CODE['M']
+        splits = []  # (level, track order, segment start, split row, M entry row, M exit row)
+        segments = []  # (track order, segment start, segment end, escape)
+        for t in range(len(index)):
+            trk = index.ids[t]
+            if trk in self.lineage:
                 continue
-
-            found = False
-            if sub.shape[0] > self.MAX_BG and 'M' in list(sub['predicted_class']):
-                cls = sub['predicted_class'].tolist()
-                confid = np.array(sub[['Probability of G1/G2', 'Probability of S', 'Probability of M']])
-                if sub['parentTrackId'].iloc[0] in self.mt_dic.keys():
-                    prev_exit = self.mt_dic[int(sub['parentTrackId'].iloc[0])]['daug'][trk]['m_exit']
-                    esp = list(sub['frame']).index(prev_exit)+1
-                else:
-                    esp = 0
-                out = deduce_transition(l=cls, tar='M', confidence=confid, min_tar=self.MIN_M, max_res=self.MAX_BG,
-                                        escape=esp)
-
-                if out is not None and out[0] != out[1] and out[1] != len(cls) - 1 and out[0] != esp:
-                    found = True
-                    cur_m_entry, m_exit = out
-                    cla = list(sub['predicted_class'])
-                    for k in range(cur_m_entry, m_exit+1):
-                        cla[k] = 'M'
-                    
-                    sub.loc[:, 'predicted_class'] = cla
-                    # split mitosis track, keep parent track with 2 'M' prediction
-                    # this makes cytokinesis unpredictable...
-                    m_entry = list(sub['frame'])[cur_m_entry]
-                    x_list = list(sub['Center_of_the_object_0'].iloc[cur_m_entry:m_exit+1])
-                    y_list = list(sub['Center_of_the_object_1'].iloc[cur_m_entry:m_exit+1])
-                    frame_list = list(sub['frame'])
-                    distance = \
-                        list(map(lambda x:dist(x_list[x], y_list[x],
-                                               x_list[x+1], y_list[x+1]) / (frame_list[x+1]-frame_list[x]),
-                                 range(len(x_list)-1)))
-                    sp_time = cur_m_entry + np.argmax(distance)+1
-                    new_track = sub[sub['frame'] >= frame_list[sp_time]].copy()
-                    new_track.loc[:, 'trackId'] = cur_max
-                    new_track.loc[:, 'lineageId'] = list(sub['lineageId'])[0]  # inherit the lineage
-                    new_track.loc[:, 'parentTrackId'] = trk  # mitosis parent asigned
-                    # register to the class
-                    x1 = sub.iloc[sp_time]['Center_of_the_object_0']
-                    y1 = sub.iloc[sp_time]['Center_of_the_object_1']
-                    x2 = sub.iloc[sp_time - 1]['Center_of_the_object_0']
-                    y2 = sub.iloc[sp_time - 1]['Center_of_the_object_1']
-                    self.mt_dic[trk] = {'div': m_entry,
-                                        'daug': {cur_max: {'m_exit': frame_list[m_exit], 
-                                            'dist': np.round(dist(x1, y1, x2, y2), 2)}}}
-                    cur_max += 1
-                    count += 1
-                    old_track = sub[sub['frame'] < frame_list[sp_time]].copy()
-                    filtered_track = filtered_track.append(old_track.copy())
-                    filtered_track = filtered_track.append(new_track.copy())
-            if not found:
-                filtered_track = filtered_track.append(sub.copy())
-
-        self.logger.info('Found mitosis track: ' + str(count))
+            start, end = index.starts[t], index.starts[t] + index.counts[t]
+            if self.lineage.parent(trk) is not None:
+                prev_exit = self.lineage.m_exit(trk)
+                esp = list(index.frame[start:end]).index(prev_exit) + 1
+            else:
+                esp = 0
+            segments.append((t, start, end, esp))
+
+        level = 0
+        while True:
+            segments = [sg for sg in segments if sg[2] - sg[1] > self.MAX_BG and np.any(cls[sg[1]:sg[2]] == m)]
+            if not segments:
+                break
+            level += 1
+            rows = np.concatenate([np.arange(sg[1], sg[2]) for sg in segments])
+            offsets = np.concatenate([[0], np.cumsum([sg[2] - sg[1] for sg in segments])])
+            entries, exits = deduce_transition_batch(cls[rows], index.confid[rows], offsets, tar='M',
+                                                     min_tar=self.MIN_M, max_res=self.MAX_BG,
+                                                     escape=[sg[3] for sg in segments])
+            daughters = []
+            for (t, start, end, esp), entry, ext in zip(segments, entries, exits):
+                if entry < 0 or entry == ext or ext == end - start - 1 or entry == esp:
+                    continue
+                cur_m_entry, m_exit = start + entry, start + ext
+                cls[cur_m_entry:m_exit + 1] = m
+                # split mitosis track at the largest displacement during mitosis
+                # this makes cytokinesis unpredictable...
+                # frame gaps are counted from the segment start, as the per-level implementation did
+                distance = [dist(index.x[cur_m_entry + k], index.y[cur_m_entry + k],
+                                 index.x[cur_m_entry + k + 1], index.y[cur_m_entry + k + 1]) /
+                            (index.frame[start + k + 1] - index.frame[start + k])
+                            for k in range(m_exit - cur_m_entry)]
+                sp_time = cur_m_entry + np.argmax(distance) + 1
+                splits.append((level, t, start, sp_time, cur_m_entry, m_exit))
+                # daughter part, search beyond mitosis exit
+                daughters.append((t, sp_time, end, m_exit - sp_time + 1))
+            segments = daughters
+
+        trk_id = np.repeat(index.ids, index.counts)
+        lineage = index.lineage.copy()
+        parent = index.parent.copy()
+        for _, t, start, sp_time, cur_m_entry, m_exit in splits:
+            trk = trk_id[start]
+            end = index.starts[t] + index.counts[t]
+            trk_id[sp_time:end] = cur_max
+            lineage[sp_time:end] = lineage[start]  # inherit the lineage
+            parent[sp_time:end] = trk  # mitosis parent asigned
+            self.lineage.add(trk, cur_max, m_exit=index.frame[m_exit],
+                             dist=np.round(dist(index.x[sp_time], index.y[sp_time],
+                                                index.x[sp_time - 1], index.y[sp_time - 1]), 2),
+                             m_entry=index.frame[cur_m_entry])
+            cur_max += 1
+
+        filtered_track = self.track.iloc[index.order].copy()
+        filtered_track['trackId'] = trk_id
+        filtered_track['lineageId'] = lineage
+        filtered_track['parentTrackId'] = parent
+        filtered_track['predicted_class'] = phase_labels(cls)
+        filtered_track = filtered_track.iloc[np.lexsort((index.frame, trk_id))]
+        count = len(splits)
+        self.logger.info('Found mitosis track: ' + str(count) + ', in ' + str(splits[-1][0] if splits else 0) +
+                         ' level(s)')
         return filtered_track, count
 
     def register_track(self):
@@ -176,8 +254,9 @@ class Refiner:
         frame_tolerance = self.SEARCH_RANGE
 
         track = self.track.copy()
+        index = self.track_index
         # annotation table: record appearance and disappearance information of the track
-        track_count = len(np.unique(track['trackId']))
+        track_count = len(index)
         ann = {"track": [i for i in range(track_count)],
                "app_frame": [0 for _ in range(track_count)],
                "disapp_frame": [0 for _ in range(track_count)],
@@ -195,112 +274,66 @@ class Refiner:
                }
 
         short_tracks = []
-        trks = list(np.unique(track['trackId']))
+        trks = list(index.ids)
+        names = np.array(PHASE_NAMES, dtype=object)
+        stage, app, disapp = self.render_emerging(cov_range=frame_tolerance)
         for i in range(track_count):
-            cur_track = track[track['trackId'] == trks[i]]
+            sl = index[trks[i]]
             # constraint A: track < 2 frame length tolerance is filtered out, No relationship can be deduced from that.
             ann['track'][i] = trks[i]
             # (dis-)appearance time
-            ann['app_frame'][i] = min(cur_track['frame'])
-            ann['disapp_frame'][i] = max(cur_track['frame'])
+            ann['app_frame'][i] = index.frame[sl.start]
+            ann['disapp_frame'][i] = index.frame[sl.stop - 1]
             # (dis-)appearance coordinate
-            ann['app_x'][i] = cur_track['Center_of_the_object_0'].iloc[0]
-            ann['app_y'][i] = cur_track['Center_of_the_object_1'].iloc[0]
-            ann['disapp_x'][i] = cur_track['Center_of_the_object_0'].iloc[cur_track.shape[0] - 1]
-            ann['disapp_y'][i] = cur_track['Center_of_the_object_1'].iloc[cur_track.shape[0] - 1]
-            rt = self.render_emerging(track=cur_track, cov_range=frame_tolerance)
-            ann['app_stage'][i] = rt[0]
-            ann['disapp_stage'][i] = rt[1]
-
-            if max(cur_track['frame']) - min(cur_track['frame']) < frame_tolerance:
+            ann['app_x'][i] = index.x[sl.start]
+            ann['app_y'][i] = index.y[sl.start]
+            ann['disapp_x'][i] = index.x[sl.stop - 1]
+            ann['disapp_y'][i] = index.y[sl.stop - 1]
+            ann['app_stage'][i] = '-'.join(names[stage[sl][app[sl]]])
+            ann['disapp_stage'][i] = '-'.join(names[stage[sl][disapp[sl]]])
+
+            if index.frame[sl.stop - 1] - index.frame[sl.start] < frame_tolerance:
                 short_tracks.append(trks[i])
         self.short_tracks = short_tracks.copy()
 
         ann = pd.DataFrame(ann)
         # register mitosis relationship from break_mitosis()
-        for i in list(self.mt_dic.keys()):
-            daug_trk = list(self.mt_dic[i]['daug'].keys())[0]
-            # parent
-            idx = ann[ann['track'] == i].index
-            ann.loc[idx, 'mitosis_identity'] = ann.loc[idx, 'mitosis_identity'] + '/' + 'parent'
-            ann.loc[idx, 'mitosis_daughter'] = daug_trk
-            ann.loc[idx, 'm_entry'] = self.mt_dic[i]['div']
-
-            # daughter
-            idx = ann[ann['track'] == daug_trk].index
-            ann.loc[idx, 'mitosis_identity'] = ann.loc[idx, 'mitosis_identity'] + '/' + 'daughter'
-            ann.loc[idx, 'mitosis_parent'] = i
-            ann.loc[idx, 'm_exit'] = self.mt_dic[i]['daug'][daug_trk]['m_exit']
+        self.lineage.to_ann(ann)
 
         track['lineageId'] = track['trackId'].copy()  # erase original lineage ID, assign in following steps
         self.logger.info("High quality tracks subjected to predict relationship: " + str(ann.shape[0] - len(short_tracks)))
 
         return track, short_tracks, ann
 
-    def render_emerging(self, track, cov_range):
-        """Render emerging phase
+    def render_emerging(self, cov_range):
+        """Render emerging phase as M, at the appearance and disappearance of all tracks.
+
+        Args:
+            cov_range (int): frames to consider at the beginning and the end.
+
+        Returns:
+            (numpy.ndarray, numpy.ndarray, numpy.ndarray): phase codes of the track index with emerging objects
+                rendered, masks of rows at the beginning and at the end of their track.
         """
-        if track.shape[0] >= 2 * cov_range:
-            bg_cls = list(track['predicted_class'].iloc[0:cov_range])
-            bg_emg = list(track['emerging'].iloc[0:cov_range])
-            end_cls = list(track['predicted_class'].iloc[(track.shape[0] - cov_range): track.shape[0]])
-            end_emg = list(track['emerging'].iloc[(track.shape[0] - cov_range): track.shape[0]])
-            
-        else:
-            bg_cls = list(track['predicted_class'].iloc[0:min(cov_range, track.shape[0])])
-            bg_emg = list(track['emerging'].iloc[0:min(cov_range, track.shape[0])])
-            end_cls = list(track['predicted_class'].iloc[max(0, track.shape[0] - cov_range):])
-            end_emg = list(track['emerging'].iloc[max(0, track.shape[0] - cov_range):])
-        
-        for i in range(len(bg_emg)):
-            if bg_emg[i] == 1:
-                bg_cls[i] = 'M'
-        for i in range(len(end_cls)):
-            if end_emg[i] == 1:
-                end_cls[i] = 'M'
-        return '-'.join(bg_cls), '-'.join(end_cls)
-
-    def revert(self, ann, mt_dic, parentId, daughterId):
-        """Remove information of a relationship registered to ann and mt_dic
+        index = self.track_index
+        stage = np.where(index.emerging == 1, PHASE_CODE['M'], index.cls).astype(np.int8)
+        pos = np.arange(stage.shape[0]) - np.repeat(index.starts, index.counts)  # position within the track
+        length = np.repeat(index.counts, index.counts)
+        return stage, pos < cov_range, pos >= length - cov_range
+
+    def revert(self, lineage, parentId, daughterId):
+        """Remove a relationship registered to the lineage graph, in place
         """
         self.logger.info('Revert: ' + str(parentId) + '-' + str(daughterId))
-        # parent
-        mt_dic[parentId]['daug'].pop(daughterId)
-        ori = ann.loc[ann['track'] == parentId]['mitosis_identity'].values[0]
-        ori = ori.replace('/parent', '', 1)
-        ann.loc[ann['track'] == parentId, 'mitosis_identity'] = ori
-        ori_daug = str(ann.loc[ann['track'] == parentId]['mitosis_daughter'].values[0])
-        ori_daug = ori_daug.split('/')
-        ori_daug.remove(str(daughterId))
-        ann.loc[ann['track'] == parentId, 'mitosis_daughter'] = '/'.join(ori_daug)
-        # daughter
-        ori = ann.loc[ann['track'] == daughterId]['mitosis_identity'].values[0]
-        ori = ori.replace('/daughter', '', 1)
-        ann.loc[ann['track'] == daughterId, 'mitosis_identity'] = ori
-        ann.loc[ann['track'] == daughterId, 'm_exit'] = None
-        ann.loc[ann['track'] == daughterId, 'mitosis_parent'] = None
-
-        if len(mt_dic[parentId]['daug'].keys()) == 0:
-            del mt_dic[parentId]
-
-        return ann, mt_dic
-
-    def register_mitosis(self, ann, mt_dic, parentId, daughterId, m_exit, dist_dif, m_entry=0):
-        """Register parent and dduahgter information to ann and mt_dic
+        lineage.remove(parentId, daughterId)
+        return
+
+    def register_mitosis(self, lineage, parentId, daughterId, m_exit, dist_dif, m_entry=0):
+        """Register parent and daughter information to the lineage graph, in place
         """
         self.logger.info('Register: ' + str(parentId) + '-' + str(daughterId))
-        ori = ann.loc[ann['track'] == parentId, "mitosis_daughter"].values[0]
-        ori_idt = ann.loc[ann['track'] == parentId, "mitosis_identity"].values[0]
-        s1 = ann.loc[ann['track'] == daughterId, "mitosis_identity"].values
-        ann.loc[ann['track'] == daughterId, "mitosis_identity"] = s1 + "/daughter"
-        ann.loc[ann['track'] == daughterId, "m_exit"] = m_exit
-        ann.loc[ann['track'] == daughterId, "mitosis_parent"] = parentId
-        ann.loc[ann['track'] == parentId, "mitosis_daughter"] = str(ori) + '/' + str(daughterId)
-        ann.loc[ann['track'] == parentId, "mitosis_identity"] = str(ori_idt) + '/parent'
-        if parentId not in list(mt_dic.keys()):
-            mt_dic[parentId] = {'div': m_entry, 'daug': {}}
-        mt_dic[parentId]['daug'][daughterId] = {'m_exit': m_exit, 'dist': dist_dif}
-        return ann, mt_dic
+        lineage.add(parentId, daughterId, m_exit=m_exit, dist=dist_dif, m_entry=m_entry)
+        return
 
     def getMtransition(self, trackId, direction='entry', skip=0):
         """Get mitosis transition time by trackId
@@ -311,13 +344,15 @@ class Refiner:
             skip (int): escape frames from `deduce_transition` method
         """
         skp = None
-        trk = self.track[self.track['trackId'] == trackId].copy()
-        c1 = list(trk['predicted_class'])
-        c1_confid = np.array(trk[['Probability of G1/G2', 'Probability of S', 'Probability of M']])
+        index = self.track_index
+        sl = index[trackId]
+        frames = list(index.frame[sl])
+        c1 = index.cls[sl]
+        c1_confid = index.confid[sl]
         if direction == 'exit':
             daug_entry = self.ann[self.ann['track'] == trackId]['m_entry'].values[0]
             if daug_entry is not None:
-                skp = list(trk['frame']).index(daug_entry)
+                skp = frames.index(daug_entry)
                 c1 = c1[:skp]
                 c1_confid = c1_confid[:skp, :]
             trans = deduce_transition(c1, tar='M', confidence=c1_confid, min_tar=1, max_res=self.MAX_BG, escape=skip)
@@ -328,7 +363,7 @@ class Refiner:
         elif direction == 'entry':
             par_exit = self.ann[self.ann['track'] == trackId]['m_exit'].values[0]
             if par_exit is not None:
-                skp = list(trk['frame']).index(par_exit)
+                skp = frames.index(par_exit)
                 c1 = c1[skp+1:]
                 c1_confid = c1_confid[skp+1:, :]
             trans = deduce_transition(c1[::-1], tar='M', confidence=c1_confid[::-1, :],
@@ -341,36 +376,41 @@ class Refiner:
             raise ValueError('Direction can either be entry or exit')
 
         if skp is not None and direction == 'entry':
-            trans = list(trk['frame'])[trans + skp + 1]
+            trans = frames[trans + skp + 1]
         else:
-            trans = list(trk['frame'])[trans]
+            trans = frames[trans]
 
         return trans
 
     def extract_pools(self, extra_par=None, extra_daug=None):
         """Extract potential parent and daughter pool
         """
-        daughter_pool = []
-        parent_pool = list(self.mt_dic.keys())
-        for i in self.mt_dic.keys():
-            for j in self.mt_dic[i]['daug'].keys():
-                daughter_pool.append(j)
+        parent_pool = self.lineage.parents()
+        daughter_pool = [d for _, d in self.lineage.relations()]
         self.daug_from_broken = daughter_pool.copy()
         pool = list(np.unique(self.track['trackId']))
-        lin_par_pool = list(set(np.unique(self.track['parentTrackId'])) - set(parent_pool))
-        lin_daug_pool = list(set(np.unique(self.track[self.track['parentTrackId'] > 0]['trackId'])) -
-                             set(daughter_pool))
-
+        lin_par_pool = set(np.unique(self.track['parentTrackId'])) - set(parent_pool)
+        lin_daug_pool = set(np.unique(self.track[self.track['parentTrackId'] > 0]['trackId'])) - set(daughter_pool)
+
+        # M classification at appearance/disappearance, as rendered in the annotation table
+        index = self.track_index
+        stage, app, disapp = self.render_emerging(cov_range=self.SEARCH_RANGE)
+        trk = np.repeat(index.ids, index.counts)
+        mt = stage == PHASE_CODE['M']
+        app_m = set(trk[mt & app])
+        disapp_m = set(trk[mt & disapp])
+
+        exclude = set(parent_pool) | lin_par_pool | set(self.short_tracks)
         for i in pool:
-            if i not in parent_pool and i not in lin_par_pool and i not in self.short_tracks:
+            if i not in exclude:
                 # wild parents: at least two M classification at the end
-                if re.search('M', self.ann[self.ann['track'] == i]['disapp_stage'].values[0]) is not None:
+                if i in disapp_m:
                     parent_pool.append(i)
 
+        exclude = set(daughter_pool) | lin_daug_pool | set(self.short_tracks)
         for i in pool:
-            if i not in daughter_pool and i not in lin_daug_pool and i not in self.short_tracks:
-                if re.search('M', self.ann[self.ann['track'] == i]['app_stage'].values[0]) is not None:
-                # if re.search('S', self.ann[self.ann['track'] == i]['app_stage'].values[0]) is None:
+            if i not in exclude:
+                if i in app_m:
                     daughter_pool.append(i)
 
         if extra_par:
@@ -387,17 +427,16 @@ class Refiner:
             p (int): parent track ID
         """
         if p not in self.par_mt_mask.keys():
-            sub = self.track[(self.track['trackId'] == p) & (self.track['frame'] >= (self.mt_entry_lookup[p][0] - 2))]
-            lbs = list(sub['continuous_label'])
-            frame = list(sub['frame'])
-            sls = []
+            index = self.track_index
+            sl = index[p]
+            keep = index.frame[sl] >= (self.mt_entry_lookup[p][0] - 2)
+            lbs = list(index.label[sl][keep])
+            frame = list(index.frame[sl][keep])
+            out = None
             for i in range(len(lbs)):
-                sl = self.mask[frame[i], :, :].copy()
-                sl[sl != lbs[i]] = 0
-                sl = sl.astype('bool')
-                sls.append(sl)
-            out = np.sum(np.stack(sls, axis=0), axis=0)
-            out = out.astype('bool')
+                # read frame by frame, mask can be an on-disk MaskStore
+                sl = self.mask[frame[i]] == lbs[i]
+                out = sl if out is None else out | sl
             # dilate the mask by 50% mean radius, adjustable
             dilate_range = int(2 * self.dilate_factor * int(np.floor(self.mean_size/4)))
             out = morph.binary_dilation(out, selem=np.ones((dilate_range, dilate_range)))
@@ -428,6 +467,15 @@ class Refiner:
     def extract_features(self, par_pool, daug_pool, remove_outlier=None, normalize=None, sample=None):
         """Extract Input Features for the classifier
 
+        Candidates are all pairs where the daughter appears after the parent disappears and its mitosis entry, and
+        pairs already registered by `break_mitosis()`. Features are computed on arrays of all pairs at once.
+
+        With `gate`, pairs are also bound in space and time: the daughter must appear within `search_range` frames,
+        and within the distance tolerance `threshold_mt_F` (see `plainPredict()`) around the parent disappearance,
+        searched on a KD-tree of daughter appearances, so that dense wells do not scale with the product of pools.
+        Positive training samples are always kept. Feature scalers in prediction are then fit on the gated pairs
+        only, which changes association scores.
+
         Args:
             par_pool (list): Parent pool.
             daug_pool (list): Daughter pool.
@@ -440,44 +488,83 @@ class Refiner:
             raise NotImplementedError('Only allowed to input sample in TRAIN mode.')
 
         self.logger.info('Extracting features...')
-        ipts = []
-        sample_id = []
-        y = []
-        for i in tqdm.tqdm(par_pool):
-            for j in range(len(daug_pool)):
-                if i != daug_pool[j]:
-                    ind = self.getAsoInput(i, daug_pool[j])
-
-                    rgd = False  # first register input from broken pairs
-                    if i in self.mt_dic.keys():
-                        if daug_pool[j] in self.mt_dic[i]['daug'].keys():
-                            ipts.append(ind)
-                            sample_id.append([i, daug_pool[j]])
-                            rgd = True
-
-                    par_end = self.ann[self.ann['track'] == i]['disapp_frame'].values[0]
-                    daug_appear = self.ann[self.ann['track'] == daug_pool[j]]['app_frame'].values[0]
-                    if not rgd and (ind[1] <= 0 or par_end >= daug_appear):
-                        continue
-                    elif not rgd:
-                        if self.mask is not None:
-                            if not self.daug_app_in_par_mask(i, daug_pool[j]):
-                                continue
-                        ipts.append(ind)
-                        sample_id.append([i, daug_pool[j]])
-
-                    if sample is not None:
-                        a = np.where(sample[:, 0] == i)[0].tolist()
-                        b = np.where(sample[:, 1] == daug_pool[j])[0].tolist()
-                        sp_index = list(set(a) & set(b))
-                        if sp_index:
-                            y.append(1)
-                        else:
-                            y.append(0)
-        ipts = np.array(ipts)
-        sample_id = np.array(sample_id)
+        index = self.track_index
+        par_last = np.array([index[i].stop - 1 for i in par_pool], dtype=int)
+        daug_first = np.array([index[j].start for j in daug_pool], dtype=int)
+        par_end = index.frame[par_last].astype(int)
+        daug_appear = index.frame[daug_first].astype(int)
+        par_xy = np.stack([index.x[par_last], index.y[par_last]], axis=1).astype(float)
+        daug_xy = np.stack([index.x[daug_first], index.y[daug_first]], axis=1).astype(float)
+        # mitosis transitions, once per track
+        m_entry = np.array([self.lookup_mt_entry(i) for i in par_pool], dtype=int)
+        for j in daug_pool:
+            self.lookup_mt_exit(j)
+
+        exempt = []  # registered pairs from broken tracks
+        daug_pos = {daug_pool[b]: b for b in range(len(daug_pool))}
+        for a in range(len(par_pool)):
+            for d in self.lineage.daughters(par_pool[a]):
+                if d in daug_pos:
+                    exempt.append((a, daug_pos[d]))
+        positive = []
+        if sample is not None:
+            par_pos = {par_pool[a]: a for a in range(len(par_pool))}
+            for p, d in sample[:, :2]:
+                if p in par_pos and d in daug_pos:
+                    positive.append((par_pos[p], daug_pos[d]))
+        n_daug = max(len(daug_pool), 1)
+        exempt = np.array(exempt, dtype=int).reshape(-1, 2) @ [n_daug, 1]
+        positive = np.array(positive, dtype=int).reshape(-1, 2) @ [n_daug, 1]
+
+        # pairs encoded as parent position * daughter pool size + daughter position, in the order of the pools
+        unit = self.DIST_MT_TOLERANCE / (self.mean_size / 2 + self.metaData['meanDisplace'])
+        if self.GATE:
+            # spatial candidates: largest radius any pair within the search range can have
+            radius = unit * (self.mean_size / 2 + self.SEARCH_RANGE * self.metaData['meanDisplace'])
+            if len(par_pool) > 0 and len(daug_pool) > 0:
+                hits = cKDTree(daug_xy).query_ball_point(par_xy, r=radius * (1 + 1e-6) + 1e-6)
+            else:
+                hits = [[] for _ in par_pool]
+            codes = np.repeat(np.arange(len(par_pool)), [len(h) for h in hits]) * n_daug + \
+                np.array([b for h in hits for b in h], dtype=int)
+            codes = np.concatenate([codes, positive])
+        else:
+            pa, pb = np.nonzero((par_end[:, None] < daug_appear[None, :]) & (m_entry[:, None] < daug_appear[None, :]))
+            codes = pa * n_daug + pb
+        codes = np.unique(np.concatenate([codes, exempt]))
+        pa, pb = codes // n_daug, codes % n_daug
+        par_arr = np.asarray(par_pool)
+        daug_arr = np.asarray(daug_pool)
+        differ = par_arr[pa] != daug_arr[pb]
+        codes, pa, pb = codes[differ], pa[differ], pb[differ]
+
+        # features, see getAsoInput()
+        frame_diff = np.where(m_entry[pa] >= daug_appear[pb], -1, daug_appear[pb] - par_end[pa])
+        distance_diff = np.sqrt((par_xy[pa, 0] - daug_xy[pb, 0]) ** 2 + (par_xy[pa, 1] - daug_xy[pb, 1]) ** 2)
+        feat = np.stack([distance_diff / (self.mean_size / 2 + np.abs(frame_diff) * self.metaData['meanDisplace']),
+                         frame_diff / self.metaData['sample_freq']], axis=1)
+
+        rgd = np.isin(codes, exempt)
+        pos = np.isin(codes, positive)
+        keep = (frame_diff > 0) & (par_end[pa] < daug_appear[pb])
+        if self.GATE:
+            keep &= ((frame_diff <= self.SEARCH_RANGE) & (feat[:, 0] <= unit)) | pos
+        if self.mask is not None:
+            # daughter appearance in the mask of the parent, see `daug_app_in_par_mask()`
+            app = self.ann.set_index('track').loc[daug_pool, ['app_x', 'app_y']].values
+            app = np.floor(app).astype(int)
+            check = np.flatnonzero(keep & ~rgd)
+            starts = np.flatnonzero(np.diff(pa[check], prepend=-1))
+            for group in np.split(check, starts[1:]):
+                if group.shape[0]:
+                    mask = self.get_parent_mask(par_pool[pa[group[0]]])
+                    keep[group] = mask[app[pb[group], 1], app[pb[group], 0]] > 0
+        keep |= rgd
+
+        ipts = np.array(feat[keep].tolist())
+        sample_id = np.stack([par_arr[pa[keep]], daug_arr[pb[keep]]], axis=1) if np.any(keep) else np.array([])
         if sample is not None:
-            y = np.array(y)
+            y = pos[keep].astype(int)
 
         if remove_outlier is not None:
             outs = get_outlier(ipts, col_ids=remove_outlier)
@@ -521,15 +608,15 @@ class Refiner:
             out[i,1] = score
         return out
 
-    def extract_train_from_break(self, sample_id, ipts, mt_dic):
+    def extract_train_from_break(self, sample_id, ipts, lineage):
         """Extract broken mitosis information to train model.
         """
 
         sample = pd.DataFrame(sample_id)
         sample.columns = ['par', 'daug']
         idx = []
-        for i in mt_dic.keys():
-            par, daug = i, list(mt_dic[i]['daug'].keys())[0]
+        for par in lineage:
+            daug = lineage.daughters(par)[0]
             sub = sample[(sample['par'] == par) & (sample['daug'] == daug)]
             if sub.shape[0] == 0:
                 warnings.warn('Positive mitosis instance (parent-daughter) ' + str(par) + '-' + str(daug) +
@@ -544,9 +631,9 @@ class Refiner:
         """Main algorithm to associate parent and daughter relationship.
         """
 
-        ann = deepcopy(self.ann)
-        track = deepcopy(self.track)
-        mt_dic = deepcopy(self.mt_dic)
+        ann = self.ann.copy()
+        track = self.track.copy()
+        lineage = self.lineage.copy()
 
         parent_pool, pool = self.extract_pools()
         
@@ -558,7 +645,7 @@ class Refiner:
 
         if ipts.shape[0] == 0:
             self.logger.warning('No potential daughters found.')
-            return track, ann, mt_dic
+            return track, ann, lineage
 
         if mode is None or mode == 'SVM':
             # Read in baseline training data
@@ -567,9 +654,9 @@ class Refiner:
             baseline_y = baseline[:, baseline.shape[1]-1]
 
             self.logger.info('Augment SVM train: ' + str(self.DO_AUG))
-            if len(mt_dic.keys()) > 0 and self.DO_AUG:
+            if len(lineage) > 0 and self.DO_AUG:
                 # Train model further with already broken tracks
-                ipts_brk = self.extract_train_from_break(sample_id, ipts, mt_dic)
+                ipts_brk = self.extract_train_from_break(sample_id, ipts, lineage)
                 y = [1 for _ in range(ipts_brk.shape[0])]
                 # Merge baseline and broken data
                 X = np.concatenate((ipts_brk, baseline_x), axis=0)
@@ -593,29 +680,34 @@ class Refiner:
             res = self.plainPredict(ipts)
         self.logger.info('Finished prediction.')
 
+        # each parent takes two rows (two daughters), cost is only defined for candidate pairs
         parent_pool = list(np.unique(sample_id[:, 0]))
         cost_r_idx = np.array([val for val in parent_pool for _ in range(2)])
         cost_c_idx = np.unique(sample_id[:, 1])
-        cost = np.zeros((cost_r_idx.shape[0], cost_c_idx.shape[0]))
-        for i in range(cost.shape[0]):
-            a = np.where(sample_id[:, 0] == cost_r_idx[i])[0].tolist()
-            for j in range(cost.shape[1]):
-                if cost_r_idx[i] != cost_c_idx[j]:
-                    b = np.where(sample_id[:, 1] == cost_c_idx[j])[0].tolist()
-                    sp_index = list(set(a) & set(b))
-                    if sp_index:
-                        if cost_r_idx[i] in self.mt_dic.keys() and \
-                                cost_c_idx[j] in self.mt_dic[cost_r_idx[i]]['daug'].keys():
-                            cost[i, j] = 1
-                        else:
-                            cost[i, j] = res[sp_index[0]][1]
-
-        cost = cost * -1
-        row_ind, col_ind = linear_sum_assignment(cost)
+        r_pos = {parent_pool[i]: i for i in range(len(parent_pool))}
+        c_pos = {cost_c_idx[j]: j for j in range(len(cost_c_idx))}
+        row, col, val = [], [], []
+        seen = set()
+        for k in range(sample_id.shape[0]):
+            par, daug = sample_id[k, 0], sample_id[k, 1]
+            if par == daug or (par, daug) in seen:
+                continue
+            seen.add((par, daug))
+            if self.lineage.parent(daug) == par:
+                score = 1
+            else:
+                score = res[k][1]
+            for r in [2 * r_pos[par], 2 * r_pos[par] + 1]:
+                row.append(r)
+                col.append(c_pos[daug])
+                val.append(-score)
+        row_ind, col_ind, costs = assign_by_component(np.array(row, dtype=int), np.array(col, dtype=int),
+                                                      np.array(val, dtype=float),
+                                                      shape=(cost_r_idx.shape[0], cost_c_idx.shape[0]))
 
         to_register = {}
         for i in range(len(row_ind)):
-            cst = cost[row_ind[i], col_ind[i]]
+            cst = costs[i]
             if cst < -self.ASO_TRH:
                 par = cost_r_idx[row_ind[i]]
                 daug = cost_c_idx[col_ind[i]]
@@ -628,12 +720,11 @@ class Refiner:
         self.logger.debug('Parent-Daughter relation to register')
         self.logger.debug(to_register)
 
-        # check original mt_dic, if not in to_register, revert the relation
-        for par in mt_dic.keys():
+        # check original relations, if not in to_register, revert the relation
+        for par in lineage:
             if par not in to_register.keys():
-                ori_daugs = list(mt_dic[par]['daug'].keys())
-                for ori_daug in ori_daugs:
-                    ann, mt_dic = self.revert(deepcopy(ann), deepcopy(mt_dic), par, ori_daug)
+                for ori_daug in lineage.daughters(par):
+                    self.revert(lineage, par, ori_daug)
 
         ips_count = 0
         for par in to_register.keys():
@@ -642,50 +733,49 @@ class Refiner:
             if self.mt_entry_lookup[par][1] == 0:
                 self.imprecise.append(par)
                 ips_count += 1
-            if par not in mt_dic.keys():
+            if par not in lineage:
                 for i in range(len(daugs)):
                     m_exit = self.mt_exit_lookup[daugs[i]][0]
                     if self.mt_exit_lookup[daugs[i]][1] == 0:
                         self.imprecise.append(daugs[i])
                         ips_count += 1
-                    ann, mt_dic = self.register_mitosis(deepcopy(ann), deepcopy(mt_dic),
-                                                        par, daugs[i], m_exit, np.round(1+csts[i],3), m_entry)
+                    self.register_mitosis(lineage, par, daugs[i], m_exit, np.round(1+csts[i],3), m_entry)
             else:
-                ori_daugs = list(mt_dic[par]['daug'].keys())
+                ori_daugs = lineage.daughters(par)
                 for ori_daug in ori_daugs:
                     if ori_daug not in daugs:
-                        ann, mt_dic = self.revert(deepcopy(ann), deepcopy(mt_dic), par, ori_daug)
+                        self.revert(lineage, par, ori_daug)
                 for i in range(len(daugs)):
                     if daugs[i] not in ori_daugs:
                         m_exit = self.mt_exit_lookup[daugs[i]][0]
                         if self.mt_exit_lookup[daugs[i]][1] == 0:
                             self.imprecise.append(daugs[i])
                             ips_count += 1
-                        ann, mt_dic = self.register_mitosis(deepcopy(ann), deepcopy(mt_dic),
-                                                            par, daugs[i], m_exit, np.round(1+csts[i],3), m_entry)
+                        self.register_mitosis(lineage, par, daugs[i], m_exit, np.round(1+csts[i],3), m_entry)
                     else:
-                        mt_dic[par]['daug'][daugs[i]]['dist'] = np.round(1+csts[i],3)
+                        lineage.set_dist(par, daugs[i], np.round(1+csts[i],3))
+        # mitosis entry of parents stays as registered from break_mitosis()
+        lineage.to_ann(ann, m_entry=False)
 
         # count 2 daughters-found relationships
         count = 0
-        for i in mt_dic.keys():
-            if len(list(mt_dic[i]['daug'].keys())) == 2:
+        for par in lineage:
+            if len(lineage.daughters(par)) == 2:
                 count += 1
 
         self.logger.info("Parent-Daughter-Daughter mitosis relations found: " + str(count))
-        self.logger.info("Parent-Daughter mitosis relations found: " + str(len(list(mt_dic.keys())) - count))
+        self.logger.info("Parent-Daughter mitosis relations found: " + str(len(lineage) - count))
         self.logger.info("Imprecise tracks involved in prediction: " + str(ips_count))
         track = track.sort_values(by=['lineageId', 'trackId', 'frame'])
-        return track, ann, mt_dic
+        return track, ann, lineage
 
     def update_table_with_mt(self):
-        """Update tracked object table with information in self.mt_dic (mitosis lookup dict).
+        """Update tracked object table with relationships in `self.lineage`.
         """
         track = self.track.copy()
-        dic = self.mt_dic.copy()
-        for trk in list(dic.keys()):
+        for trk in self.lineage:
             lin = track[track['trackId'] == trk]['lineageId'].iloc[0]
-            for d in list(dic[trk]['daug'].keys()):
+            for d in self.lineage.daughters(trk):
                 track.loc[track['trackId'] == d, 'parentTrackId'] = trk
                 track.loc[track['lineageId'] == d, 'lineageId'] = lin
 
@@ -702,55 +792,79 @@ class Refiner:
         elif self.SMOOTH%2 != 1:
             self.logger.warning('Even smoothing window found, use the biggest odd smaller than ' + str(self.SMOOTH))
             self.SMOOTH -= 1
-        count = 0
-        dic = {0: 'G1/G2', 1: 'S', 2: 'M'}
-        track = self.track.copy()
-        track_filtered = pd.DataFrame(columns=track.columns)
-        flt = np.ones(self.SMOOTH)
         escape = int(np.floor(self.SMOOTH / 2))
-        for i in np.unique(track['trackId']):
-            cur_track = track[track['trackId'] == i].copy()
-            if cur_track.shape[0] >= self.SMOOTH:
-                S = np.convolve(cur_track['Probability of S'], flt, mode='valid') / self.SMOOTH
-                M = np.convolve(cur_track['Probability of M'], flt, mode='valid') / self.SMOOTH
-                G = np.convolve(cur_track['Probability of G1/G2'], flt, mode='valid') / self.SMOOTH
-                ix = cur_track.index
-                ix = ix[escape:(cur_track.shape[0] - escape)]
-                cur_track.loc[ix, 'Probability of S'] = S
-                cur_track.loc[ix, 'Probability of G1/G2'] = G
-                cur_track.loc[ix, 'Probability of M'] = M
-                idx = np.argmax(
-                    np.array(cur_track.loc[:, ['Probability of G1/G2', 'Probability of S', 'Probability of M']]),
-                    axis=1)
-                phase = list(map(lambda x: dic[x], idx))
-                count += np.sum(phase != cur_track['predicted_class'])
-                cur_track.loc[:, 'predicted_class'] = phase
-
-            track_filtered = track_filtered.append(cur_track.copy())
+        index = self.track_index
+        track = self.track.iloc[index.order].copy()
+        confid = index.confid.astype(float)
+
+        # tracks shorter than the window are left untouched, edges of the others keep the raw confidence
+        pos = np.arange(confid.shape[0]) - np.repeat(index.starts, index.counts)  # position within the track
+        length = np.repeat(index.counts, index.counts)
+        smooth = length >= self.SMOOTH
+        center = np.flatnonzero(smooth & (pos >= escape) & (pos < length - escape))
+        # centered moving average, summed in window order
+        window = np.zeros((center.shape[0], 3))
+        for k in range(-escape, escape + 1):
+            window = window + confid[center + k]
+        confid[center] = window / self.SMOOTH
+
+        # confidence columns are ordered as the first phase codes
+        cls = index.cls.copy()
+        cls[smooth] = np.argmax(confid[smooth], axis=1)
+        count = np.sum(cls != index.cls)
+        track[['Probability of G1/G2', 'Probability of S', 'Probability of M']] = confid
+        track['predicted_class'] = phase_labels(cls)
         self.logger.info("Object classification corrected by smoothing: " + str(count))
 
-        return track_filtered
+        return track
 
     def getMeanDisplace(self):
         """Calculate mean displace of each track normalized with frame.
         """
         d = {'trackId': [], 'mean_displace': []}
-        for i in np.unique(self.track['trackId']):
-            sub = self.track[self.track['trackId'] == i]
-            dp = []
-            for j in range(1, sub.shape[0]):
-                x1 = sub['Center_of_the_object_0'].iloc[j]
-                y1 = sub['Center_of_the_object_1'].iloc[j]
-                x2 = sub['Center_of_the_object_0'].iloc[j - 1]
-                y2 = sub['Center_of_the_object_1'].iloc[j - 1]
-                frame_diff = sub['frame'].iloc[j] - sub['frame'].iloc[j - 1]  # normalize with frame
-                dp.append(dist(x1, y1, x2, y2) / frame_diff)
-            if dp:
-                d['mean_displace'].append(np.mean(dp))
+        index = self.track_index
+        x = index.x.astype(float)
+        y = index.y.astype(float)
+        # displace between consecutive rows, normalize with frame; pairs across two tracks are never read
+        dp = np.sqrt((x[1:] - x[:-1]) ** 2 + (y[1:] - y[:-1]) ** 2) / (index.frame[1:] - index.frame[:-1])
+        for i in index.ids:
+            sl = index[i]
+            if sl.stop - sl.start > 1:
+                d['mean_displace'].append(np.mean(dp[sl.start:sl.stop - 1]))
                 d['trackId'].append(i)
 
         return pd.DataFrame(d)
 
+    def lookup_mt_entry(self, parent):
+        """Register mitosis entry of a candidate parent to `self.mt_entry_lookup`. If no mitosis is classified,
+        fall back to the disappearance frame and mark as imprecise.
+
+        Returns:
+            int: mitosis entry frame.
+        """
+        m_entry = self.getMtransition(parent, direction='entry')
+        if m_entry is None:
+            m_entry = self.track_index.frame[self.track_index[parent].stop - 1]
+            self.mt_entry_lookup[parent] = (m_entry, 0)  # 0: imprecise
+        else:
+            self.mt_entry_lookup[parent] = (m_entry, 1)  # 1: precise
+        return m_entry
+
+    def lookup_mt_exit(self, daughter):
+        """Register mitosis exit of a candidate daughter to `self.mt_exit_lookup`. If no mitosis is classified,
+        fall back to the appearance frame and mark as imprecise.
+
+        Returns:
+            int: mitosis exit frame.
+        """
+        m_exit = self.getMtransition(daughter, direction='exit')
+        if m_exit is None:
+            m_exit = self.track_index.frame[self.track_index[daughter].start]
+            self.mt_exit_lookup[daughter] = (m_exit, 0)
+        else:
+            self.mt_exit_lookup[daughter] = (m_exit, 1)
+        return m_exit
+
     def getAsoInput(self, parent, daughter):
         """Generate SVM classifier input for track 1 & 2.
 
@@ -766,35 +880,26 @@ class Refiner:
             - distance_diff /= ave_displace
             - frame_diff /= sample_freq
         """
-        par = self.track[self.track['trackId'] == parent].sort_values(by='frame')
-        daug = self.track[self.track['trackId'] == daughter].sort_values(by='frame')
+        index = self.track_index
+        par = index[parent]
+        daug = index[daughter]
 
         # Feature 2: mitosis frame difference
         # For secondary mitosis, skip the frame before mitosis exit
-        m_entry = self.getMtransition(parent, direction='entry')
-        m_exit = self.getMtransition(daughter, direction='exit')
-        if m_entry is None:
-            m_entry = par['frame'].iloc[-1]
-            self.mt_entry_lookup[parent] = (m_entry, 0)  # 0: imprecise
-        else:
-            self.mt_entry_lookup[parent] = (m_entry, 1)  # 1: precise
-        if m_exit is None:
-            m_exit = daug['frame'].iloc[0]
-            self.mt_exit_lookup[daughter] = (m_exit, 0)
-        else:
-            self.mt_exit_lookup[daughter] = (m_exit, 1)
+        m_entry = self.lookup_mt_entry(parent)
+        self.lookup_mt_exit(daughter)
 
-        if m_entry >= daug['frame'].iloc[0]:
+        if m_entry >= index.frame[daug.start]:
             # mitosis daughter should appear after NEBD of parent, set -1 to be filtered out in extract_feature() method
             frame_diff = -1
         else:
-            frame_diff = daug['frame'].iloc[0] - par['frame'].iloc[-1]
+            frame_diff = index.frame[daug.start] - index.frame[par.stop - 1]
 
         # Feature 1: distance
-        x1 = par['Center_of_the_object_0'].iloc[-1]
-        y1 = par['Center_of_the_object_1'].iloc[-1]
-        x2 = daug['Center_of_the_object_0'].iloc[0]
-        y2 = daug['Center_of_the_object_1'].iloc[0]
+        x1 = index.x[par.stop - 1]
+        y1 = index.y[par.stop - 1]
+        x2 = index.x[daug.start]
+        y2 = index.y[daug.start]
         distance_diff = dist(x1, y1, x2, y2)
 
         out = [distance_diff / (self.mean_size/2 + np.abs(frame_diff) * self.metaData['meanDisplace']),
@@ -822,8 +927,9 @@ class Refiner:
             self.logger.info('Generating SVM samples from mitosis-broken tracked object table.')
             dic = {}
             ct = 0
-            for i in np.unique(self.track['trackId']):
-                par = self.track[self.track['trackId'] == i]['parentTrackId'].iloc[0]
+            index = self.track_index
+            for i in index.ids:
+                par = index.parent[index[i].start]
                 if par != 0:
                     ct += 1
                     if par in dic.keys():
@@ -864,26 +970,20 @@ class Refiner:
         self.flag = True
         if self.MODE != 'TRAIN_GT':
             self.track = self.smooth_track()
-            count = 0
-            while True:
-                count += 1
-                self.logger.info('Level ' + str(count) + ' mitosis:')
-                out = self.break_mitosis()
-                self.track = out[0]
-                if out[1] == 0:
-                    break
+            self.track = self.break_mitosis()[0]
         else:
-            self.track, _, self.mt_dic, self.imprecise = get_rsv_input_gt(self.track, 'predicted_class')
+            self.track, _, mt_dic, self.imprecise = get_rsv_input_gt(self.track, 'predicted_class')
+            self.lineage = LineageGraph.from_mt_dic(mt_dic)
 
         self.track, self.short_tracks, self.ann = self.register_track()
         if self.MODE == 'TRAIN_GT':
             return self.get_SVM_train()
         elif self.MODE == 'TRH':
-            self.track, self.ann, self.mt_dic = self.associate(mode='TRH')
+            self.track, self.ann, self.lineage = self.associate(mode='TRH')
         elif self.MODE == 'SVM':
             if self.SVM_PATH == '':
                 raise ValueError('Path to SVM training data has not set yet, use setSVMpath() to supply an SVM model.')
-            self.track, self.ann, self.mt_dic = self.associate()
+            self.track, self.ann, self.lineage = self.associate()
         elif self.MODE == 'TRAIN':
             return self.track, self.mt_dic
 
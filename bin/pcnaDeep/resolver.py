@@ -1,31 +1,46 @@
 # -*- coding: utf-8 -*-
 import logging
+import multiprocessing as mp
 import pandas as pd
 import numpy as np
 import pprint
-from pcnaDeep.data.utils import deduce_transition, find_daugs
+from pcnaDeep.data.utils import deduce_transition, LineageGraph, PHASE_CODE, PHASE_NAMES, phase_codes, phase_labels
 from pcnaDeep.data.annotate import findM
 from sklearn.cluster import KMeans
 from sklearn.preprocessing import MinMaxScaler
 
 
 def list_dist(a, b):
-    """Count difference between elements of two lists.
+    """Count difference between elements of two lists. G1/G2 in A is not counted against resolved G1 or G2 in B.
 
     Args:
-        a (list): classifications with method A
-        b (list): classifications with method B
+        a (list): classifications with method A, as names or phase codes
+        b (list): classifications with method B, as names or phase codes
     """
+    a = phase_codes(a)
+    b = phase_codes(b)
+    assert a.shape[0] == b.shape[0]
+    resolved_g = np.isin(b, [PHASE_CODE[p] for p in ('G1', 'G2', 'G1*', 'G2*')])
+    return int(np.sum((a != b) & ~((a == PHASE_CODE['G1/G2']) & resolved_g)))
 
-    count = 0
-    assert len(a) == len(b)
-    for i in range(len(a)):
-        if a[i] != b[i]:
-            count += 1
-        if a[i] == 'G1/G2' and (b[i] in ['G1', 'G2', 'G1*', 'G2*']):
-            count -= 1
 
-    return count
+def _leading_run(cls, phase):
+    """Length of the leading run of a phase code in a code array.
+    """
+    other = np.flatnonzero(cls != phase)
+    return other[0] if other.shape[0] else cls.shape[0]
+
+
+def _track_spans(track):
+    """Group rows of a tracked object table by track, in frame order.
+
+    Returns:
+        (numpy.ndarray, dict): positional index of the rows sorted by track and frame,
+            {trackId: slice of the track in the sorted rows}.
+    """
+    order = np.lexsort((track['frame'].values, track['trackId'].values))
+    ids, starts, counts = np.unique(track['trackId'].values[order], return_index=True, return_counts=True)
+    return order, {ids[i]: slice(starts[i], starts[i] + counts[i]) for i in range(ids.shape[0])}
 
 
 def get_rsv_input_gt(track, gt_name='predicted_class', G2_trh=200, no_cls_GT=False):
@@ -178,16 +193,44 @@ def resolve_from_gt(track, gt_name='predicted_class', extra_gt=None, G2_trh=None
     return rsTrack, phase
 
 
+_worker_resolver = None
+
+
+def _init_resolve_worker(ann, lineage, params):
+    """Initialize the resolver held by a lineage resolution worker process.
+    """
+    global _worker_resolver
+    _worker_resolver = Resolver(pd.DataFrame(), ann, lineage, **params)
+
+
+def _resolve_lineages(lineages):
+    """Resolve a chunk of lineages in a worker process.
+
+    Args:
+        lineages (list): list of (lineage ID, lineage table) pairs.
+
+    Returns:
+        (list, dict, list, list): resolved lineage tables, `arrest`, `unresolved` and `mt_unresolved` of the chunk.
+    """
+    rsv = _worker_resolver
+    rsv.arrest = {}
+    rsv.unresolved = []
+    rsv.mt_unresolved = []
+    out = [rsv.resolveLineage(d, i) for i, d in lineages]
+    return out, rsv.arrest, rsv.unresolved, rsv.mt_unresolved
+
+
 class Resolver:
 
-    def __init__(self, track, ann, mt_dic, maxBG=25, minS=20, minM=10, minLineage=10, impreciseExit=None, G2_trh=100):
+    def __init__(self, track, ann, mt_dic, maxBG=25, minS=20, minM=10, minLineage=10, impreciseExit=None, G2_trh=100,
+                 workers=1):
         """Resolve cell cycle duration, identity G1 or G2.
 
         Args:
             - pcnaDeep.tracker outputs:
                 track (pandas.DataFrame): tracked object table;
                 ann (pandas.DataFrame): track annotation table;
-                mt_dic (dict): mitosis information lookup dictionary;
+                mt_dic (dict or LineageGraph): mitosis information lookup dictionary, or the lineage graph;
                 impreciseExit (list): list of tracks which M-G1 transition not clearly labeled.
             - GPR algorithm parameters for searching S/M phase:
                 maxBG (float): maximum background class appearance allowed within target phase;
@@ -196,6 +239,7 @@ class Resolver:
             - Options:
                 minLineage (int): minimum lineage length to record in the output phase table.
                 G2_trh (int): G2 intensity threshold for classifying arrested G1/G2 tracks. Background subtracted.
+                workers (int): number of processes to resolve lineages in parallel, default 1 (sequential).
         """
         if impreciseExit is None:
             impreciseExit = []
@@ -205,7 +249,10 @@ class Resolver:
         self.ann = ann
         self.maxBG = maxBG
         self.minS = minS
-        self.mt_dic = mt_dic
+        if isinstance(mt_dic, LineageGraph):
+            self.lineage = mt_dic
+        else:
+            self.lineage = LineageGraph.from_mt_dic(mt_dic)
         self.minM = minM
         self.rsTrack = None
         self.minLineage = minLineage
@@ -213,6 +260,7 @@ class Resolver:
         self.mt_unresolved = []
         self.arrest = {}  # trackId : arrest phase
         self.G2_trh = G2_trh
+        self.workers = workers
         self.phase = pd.DataFrame(columns=['track', 'type', 'G1', 'S', 'M', 'G2', 'parent'])
 
     def doResolve(self):
@@ -225,11 +273,13 @@ class Resolver:
 
         self.logger.info('Resolving cell cycle phase...')
         track = self.track.copy()
-        rt = pd.DataFrame()
-        for i in np.unique(track['lineageId']):
-            d = track[track['lineageId'] == i]
-            t = self.resolveLineage(d, i)
-            rt = rt.append(t)
+        track['predicted_class'] = phase_labels(phase_codes(track['predicted_class']))
+        lineages = list(track.groupby('lineageId', sort=True))
+        if self.workers > 1 and len(lineages) > 1:
+            resolved = self.resolveLineageParallel(lineages)
+        else:
+            resolved = [self.resolveLineage(d, i) for i, d in lineages]
+        rt = pd.concat(resolved)
         rt = rt.sort_values(by=['trackId', 'frame'])
         self.rsTrack = rt.copy()
         self.check_trans_integrity()
@@ -244,18 +294,47 @@ class Resolver:
         self.getAnn()
         return self.rsTrack, phase
 
+    def resolveLineageParallel(self, lineages):
+        """Resolve lineages in a process pool. Lineages are independent, and are sent to the workers in contiguous
+        chunks; bookkeeping of each chunk (`arrest`, `unresolved`, `mt_unresolved`) is merged back in lineage order,
+        so that the result is the same as resolving sequentially.
+
+        Args:
+            lineages (list): list of (lineage ID, lineage table) pairs, sorted by lineage ID.
+
+        Returns:
+            list: resolved lineage tables.
+        """
+        workers = min(self.workers, len(lineages))
+        n_chunks = min(workers * 4, len(lineages))
+        bounds = np.linspace(0, len(lineages), n_chunks + 1).astype(int)
+        chunks = [lineages[bounds[i]:bounds[i + 1]] for i in range(n_chunks)]
+        params = {'maxBG': self.maxBG, 'minS': self.minS, 'minM': self.minM, 'minLineage': self.minLineage,
+                  'impreciseExit': self.impreciseExit, 'G2_trh': self.G2_trh}
+        self.logger.info('Resolving ' + str(len(lineages)) + ' lineages with ' + str(workers) + ' processes.')
+
+        resolved = []
+        with mp.Pool(workers, initializer=_init_resolve_worker, initargs=(self.ann, self.lineage, params)) as pool:
+            for out, arrest, unresolved, mt_unresolved in pool.imap(_resolve_lineages, chunks):
+                resolved.extend(out)
+                self.arrest.update(arrest)
+                self.unresolved.extend(unresolved)
+                self.mt_unresolved.extend(mt_unresolved)
+        return resolved
+
     def check_trans_integrity(self):
         """Check track transition integrity. If transition other than G1->S; S->G2, G2->M, M->G1 found, do not resolve.
         """
-        for t in np.unique(self.rsTrack['trackId']):
+        allowed = [(PHASE_CODE[a], PHASE_CODE[b]) for a, b in [('G1', 'S'), ('S', 'G2'), ('G2', 'M'), ('M', 'G1')]]
+        order, spans = _track_spans(self.rsTrack)
+        rcls = phase_codes(self.rsTrack['resolved_class'])[order]
+        for t in spans.keys():
             if t not in self.mt_unresolved and t not in self.unresolved:
-                sub = self.rsTrack[self.rsTrack['trackId'] == t]
-                rcls = list(sub['resolved_class'])
-                for i in range(1,sub.shape[0]):
-                    if rcls[i-1] != rcls[i]:
-                        trs = '-'.join([rcls[i-1], rcls[i]])
-                        if trs not in ['G1-S','S-G2','G2-M','M-G1']:
-                            self.logger.warning('Wrong transition ' + trs + ' in track: ' + str(t))
+                sub = rcls[spans[t]]
+                for i in np.flatnonzero(sub[1:] != sub[:-1]) + 1:
+                    if (sub[i - 1], sub[i]) not in allowed:
+                        trs = '-'.join([PHASE_NAMES[sub[i - 1]], PHASE_NAMES[sub[i]]])
+                        self.logger.warning('Wrong transition ' + trs + ' in track: ' + str(t))
         return
 
     def getAnn(self):
@@ -336,14 +415,13 @@ class Resolver:
             rsd = self.resolveTrack(lineage.copy(), m_entry=m_entry, m_exit=m_exit)
             return rsd
         else:
-            out = pd.DataFrame()
             lg = lineage[lineage['trackId'] == main]
-            out = out.append(self.resolveTrack(lg.copy(), m_entry=m_entry, m_exit=m_exit))
-            daugs = self.mt_dic[main]['daug']
-            for i in list(daugs.keys()):
-                out = out.append(
-                    self.resolveLineage(lineage[lineage['trackId'].isin(find_daugs(lineage, i) + [i])].copy(), i))
-            return out
+            out = [self.resolveTrack(lg.copy(), m_entry=m_entry, m_exit=m_exit)]
+            for i in self.lineage.daughters(main):
+                out.append(
+                    self.resolveLineage(lineage[lineage['trackId'].isin(self.lineage.descendants(i) + [i])].copy(),
+                                        i))
+            return pd.concat(out)
 
     def resolveTrack(self, trk, m_entry=None, m_exit=None):
         """Resolve single track.
@@ -361,15 +439,16 @@ class Resolver:
         """
 
         UNRESOLVED_FRACTION = 0.2  # after resolving the class, if more than x% class has been corrected, label with
-        resolved_class = ['G1/G2' for _ in range(trk.shape[0])]
+        G, S, M, G1, G2 = (PHASE_CODE[p] for p in ('G1/G2', 'S', 'M', 'G1', 'G2'))
+        resolved_class = np.full(trk.shape[0], G, dtype=np.int8)
         if trk.shape[0] == 0:
             raise ValueError('Track not found!')
             #return None
 
         track_id = trk['trackId'].tolist()[0]
-        cls = list(trk['predicted_class'])
-        if list(np.unique(cls)) == ['S']:
-            trk['resolved_class'] = 'S'
+        cls = phase_codes(trk['predicted_class'])
+        if np.all(cls == S):
+            trk['resolved_class'] = phase_labels(cls)
             self.arrest[track_id] = 'S'
             return trk
 
@@ -381,41 +460,32 @@ class Resolver:
         if not (out is None or out[0] == out[1]):
             flag = True
             a = (out[0], np.min((out[1] + 1, len(resolved_class) - 1)))
-            resolved_class[a[0]:a[1] + 1] = ['S' for _ in range(a[0], a[1] + 1)]
+            resolved_class[a[0]:a[1] + 1] = S
 
             if a[0] > 0:
-                resolved_class[:a[0]] = ['G1' for _ in range(a[0])]
+                resolved_class[:a[0]] = G1
             if a[1] < len(resolved_class) - 1:
-                resolved_class[a[1]:] = ['G2' for _ in range(len(resolved_class) - a[1])]
+                resolved_class[a[1]:] = G2
 
         frame = trk['frame'].tolist()
         if m_exit is not None:
-            emerging = trk['emerging'].tolist()
-            if 1 in emerging:
-                exit_idx = int(np.min((frame.index(m_exit), emerging.index(1))))  # Emerging classification refers to G1
+            emerging = np.flatnonzero(trk['emerging'].values == 1)
+            if emerging.shape[0]:
+                exit_idx = int(np.min((frame.index(m_exit), emerging[0])))  # Emerging classification refers to G1
             else:
                 exit_idx = frame.index(m_exit)
-            resolved_class[:exit_idx + 1] = ['M' for _ in range(exit_idx + 1)]
-            i = exit_idx + 1
-            while i < len(resolved_class):
-                if resolved_class[i] == 'G1/G2':
-                    resolved_class[i] = 'G1'
-                else:
-                    break
-                i += 1
+            resolved_class[:exit_idx + 1] = M
+            run = _leading_run(resolved_class[exit_idx + 1:], G)
+            resolved_class[exit_idx + 1:exit_idx + 1 + run] = G1
         if m_entry is not None:
-            resolved_class[frame.index(m_entry):] = ['M' for _ in range(len(resolved_class) - frame.index(m_entry))]
-            i = frame.index(m_entry) - 1
-            while i >= 0:
-                if resolved_class[i] == 'G1/G2':
-                    resolved_class[i] = 'G2'
-                else:
-                    break
-                i -= 1
+            entry_idx = frame.index(m_entry)
+            resolved_class[entry_idx:] = M
+            run = _leading_run(resolved_class[:entry_idx][::-1], G)
+            resolved_class[entry_idx - run:entry_idx] = G2
 
         if not flag and m_exit is not None and m_entry is not None:
             resolved_class = cls.copy()
-            self.mt_unresolved.extend([track_id] + find_daugs(self.track, track_id))
+            self.mt_unresolved.extend([track_id] + self.lineage.descendants(track_id))
 
         if m_exit is None and m_entry is None:
             # some tracks begin/end with mitosis and not associated during refinement. In this case, override any
@@ -438,23 +508,23 @@ class Resolver:
 
             if mt_out_begin is not None and mt_out_end is None:
                 if mt_out_begin[0] == 0:
-                    resolved_class[mt_out_begin[0]: mt_out_begin[1] + 1] = ['M' for _ in
-                                                                            range(mt_out_begin[0], mt_out_begin[1] + 1)]
+                    resolved_class[mt_out_begin[0]: mt_out_begin[1] + 1] = M
                     # if followed with G1/G2 only, change to G1
-                    if np.unique(resolved_class[mt_out_begin[1] + 1:]).tolist() == ['G1/G2']:
-                        resolved_class = ['G1' if i == 'G1/G2' else i for i in resolved_class]
+                    rest = resolved_class[mt_out_begin[1] + 1:]
+                    if rest.shape[0] and np.all(rest == G):
+                        resolved_class[resolved_class == G] = G1
 
             if mt_out_end is not None and mt_out_begin is None:
                 if mt_out_end[0] == 0:
-                    resolved_class = resolved_class[::-1]
-                    resolved_class[mt_out_end[0]: mt_out_end[1] + 1] = ['M' for _ in
-                                                                        range(mt_out_end[0], mt_out_end[1] + 1)]
-                    if np.unique(resolved_class[mt_out_end[1] + 1:]).tolist() == ['G1/G2']:
-                        resolved_class = ['G2' if i == 'G1/G2' else i for i in resolved_class]
-                    resolved_class = resolved_class[::-1]
-
-        trk['resolved_class'] = resolved_class
-        if np.unique(resolved_class).tolist() == ['G1/G2']:
+                    resolved_class = resolved_class[::-1].copy()
+                    resolved_class[mt_out_end[0]: mt_out_end[1] + 1] = M
+                    rest = resolved_class[mt_out_end[1] + 1:]
+                    if rest.shape[0] and np.all(rest == G):
+                        resolved_class[resolved_class == G] = G2
+                    resolved_class = resolved_class[::-1].copy()
+
+        trk['resolved_class'] = phase_labels(resolved_class)
+        if np.all(resolved_class == G):
             self.arrest[track_id] = 'G1'
         if list_dist(cls, resolved_class) > UNRESOLVED_FRACTION * len(resolved_class):
             self.unresolved.append(track_id)
@@ -465,17 +535,23 @@ class Resolver:
         """
         out = {'track': [], 'type': [], 'length': [], 'lin_length':[], 'arrest': [], 
                'G1': [], 'S': [], 'M': [], 'G2': [], 'parent': []}
+        arrest = {PHASE_CODE['G1*']: 'G1', PHASE_CODE['G2*']: 'G2', PHASE_CODE['S']: 'S', PHASE_CODE['M']: 'M'}
+        order, spans = _track_spans(self.rsTrack)
+        rcls = phase_codes(self.rsTrack['resolved_class'])[order]
+        frame = self.rsTrack['frame'].values[order]
+        lineage = self.rsTrack['lineageId'].values[order]
+        lin_frame = self.rsTrack.groupby('lineageId')['frame'].agg(['min', 'max'])
+        lin_lengths = dict(zip(lin_frame.index, lin_frame['max'] - lin_frame['min']))
 
         # register tracks
         for i in range(self.ann.shape[0]):
             info = self.ann.loc[i, :]
             if info['track'] in self.unresolved or info['track'] in self.mt_unresolved:
                 continue
-            sub = self.rsTrack[self.rsTrack['trackId'] == info['track']]
-            lin = list(sub['lineageId'])[0]
-            sub_lin = self.rsTrack[self.rsTrack['lineageId'] == lin]
-            lin_length = int(np.max(sub_lin['frame']) - np.min(sub_lin['frame'])) + 1
-            length = int(np.max(sub['frame']) - np.min(sub['frame']) + 1)
+            sl = spans[info['track']]
+            sub, fme = rcls[sl], frame[sl]
+            lin_length = int(lin_lengths[lineage[sl.start]]) + 1
+            length = int(fme[-1] - fme[0] + 1)
             par = info['mitosis_parent']
             if par is None or par in self.mt_unresolved:
                 par = 0
@@ -485,26 +561,9 @@ class Resolver:
             out['lin_length'].append(lin_length)
             out['M'].append(np.nan)  # resolve later
 
-            if list(np.unique(sub['resolved_class'])) == ['G1*']:
-                out['type'].append('arrest' + '-G1')
-                out['arrest'].append(length)
-                out['G1'].append(np.nan)
-                out['S'].append(np.nan)
-                out['G2'].append(np.nan)
-            elif list(np.unique(sub['resolved_class'])) == ['G2*']:
-                out['type'].append('arrest' + '-G2')
-                out['arrest'].append(length)
-                out['G1'].append(np.nan)
-                out['S'].append(np.nan)
-                out['G2'].append(np.nan)
-            elif list(np.unique(sub['resolved_class'])) == ['S']:
-                out['type'].append('arrest' + '-S')
-                out['arrest'].append(length)
-                out['G1'].append(np.nan)
-                out['S'].append(np.nan)
-                out['G2'].append(np.nan)
-            elif list(np.unique(sub['resolved_class'])) == ['M']:
-                out['type'].append('arrest' + '-M')
+            cls = np.unique(sub)
+            if cls.shape[0] == 1 and cls[0] in arrest:
+                out['type'].append('arrest' + '-' + arrest[cls[0]])
                 out['arrest'].append(length)
                 out['G1'].append(np.nan)
                 out['S'].append(np.nan)
@@ -512,30 +571,29 @@ class Resolver:
             else:
                 out['type'].append('normal')
                 out['arrest'].append(np.nan)
-                cls = list(np.unique(sub['resolved_class']))
                 remain = ['G1', 'G2', 'S']
                 for c in cls:
-                    if c == 'M' or c == 'G1/G2':
+                    if c == PHASE_CODE['M'] or c == PHASE_CODE['G1/G2']:
                         continue
-                    fme = list(sub[sub['resolved_class'] == c]['frame'])
-                    lgt = fme[-1] - fme[0] + 1
-                    if sub['resolved_class'].tolist()[0] == c:
+                    fme_c = fme[sub == c]
+                    lgt = int(fme_c[-1] - fme_c[0] + 1)
+                    if sub[0] == c:
                         lgt = '>' + str(lgt)
-                    elif sub['resolved_class'].tolist()[-1] == c:
+                    elif sub[-1] == c:
                         lgt = '>' + str(lgt)
-                    out[c].append(lgt)
-                    remain.remove(c)
+                    out[PHASE_NAMES[c]].append(lgt)
+                    remain.remove(PHASE_NAMES[c])
                 for u in remain:
                     out[u].append(np.nan)
         out = pd.DataFrame(out)
 
         # register mitosis, mitosis time only registered in daughter 'M' column
-        # **Only registered mitosis in mt_dic will be recorded
-        for i in self.mt_dic.keys():
+        # **Only registered mitosis in the lineage graph will be recorded
+        for i in self.lineage:
             if i in self.mt_unresolved:
                 continue
-            for j in self.mt_dic[i]['daug'].keys():
-                m = self.mt_dic[i]['daug'][j]['m_exit'] - self.mt_dic[i]['div'] + 1
+            for j in self.lineage.daughters(i):
+                m = self.lineage.m_exit(j) - self.lineage.m_entry(i) + 1
                 out.loc[out['track'] == j, 'M'] = int(m)
 
         # filter length
@@ -355,3 +355,113 @@ def resolve_joined_frame(frame, table, n=4, boundary_width=5, dilate_time=3, fil
                     obj_count += 1
 
     return filter_edge(new_frame, new_table, filter_edge_width)
+
+
+def tile_grid(height, width, tile_size, overlap=64):
+    """Tiles covering a frame of any size, neighbouring tiles overlap by at least `overlap` pixels.
+
+    Tiles are of the same size, the last tile of each row and column is aligned to the frame border. A frame
+    dimension smaller than the tile is covered by a single tile of that dimension.
+
+    Args:
+        height (int): frame height.
+        width (int): frame width.
+        tile_size (int): tile height and width.
+        overlap (int): minimum overlap of neighbouring tiles, should exceed the size of an object.
+
+    Returns:
+        list: (row_start, col_start, row_end, col_end) of each tile, by row.
+    """
+    if overlap < 0 or tile_size <= overlap:
+        raise ValueError('Tile size should be larger than the overlap, and the overlap non-negative.')
+
+    def starts(n):
+        if n <= tile_size:
+            return [0]
+        return list(range(0, n - tile_size, tile_size - overlap)) + [n - tile_size]
+
+    return [(r, c, min(r + tile_size, height), min(c + tile_size, width))
+            for r in starts(height) for c in starts(width)]
+
+
+def stitch_instances(crops, shape, iou_trh=0.5):
+    """Merge instances detected on overlapping tiles into one label image of the frame.
+
+    An object in an overlap zone is detected on several tiles. Instances of different tiles whose bounding boxes
+    intersect are compared on the bounding box intersection only, and are duplicates if their mask IoU reaches
+    `iou_trh`, or if one of them is cut by the inner border of its tile and lies within the other by `iou_trh` of its
+    area. Of a group of duplicates, an uncut instance is kept over a cut one, then the larger one. If all of them
+    are cut, i.e. the object is larger than the overlap, the union of their masks is kept. Instances with an empty
+    mask are dropped. Overlapping pixels of kept instances go to the instance of higher confidence, resolved against
+    each instance overlapped, the earlier one wins on a tie.
+
+    Args:
+        crops (dict): instances of all tiles, see `pcnaDeep.predictor.instances_to_crops()`, with
+            `bbox` (N*4, row_start, col_start, row_end, col_end in the frame), `mask` (list of bounding box local
+            binary masks), `cls` (N), `conf` (N*C), `cut` (N, touches an inner tile border) and `tile` (N).
+        shape (tuple): frame height and width.
+        iou_trh (float): IoU to merge duplicates.
+
+    Returns:
+        numpy.ndarray: `uint16` label image, object labeled with (index of kept instance + 1).
+        numpy.ndarray: predicted class of kept instances.
+        numpy.ndarray: classification confidence of kept instances.
+    """
+    bbox = crops['bbox']
+    n = bbox.shape[0]
+    area = np.array([np.count_nonzero(m) for m in crops['mask']], dtype='int64')
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in range(n):
+        js = np.nonzero((bbox[i + 1:, 0] < bbox[i, 2]) & (bbox[i + 1:, 2] > bbox[i, 0]) &
+                        (bbox[i + 1:, 1] < bbox[i, 3]) & (bbox[i + 1:, 3] > bbox[i, 1]) &
+                        (crops['tile'][i + 1:] != crops['tile'][i]))[0] + i + 1
+        for j in js:
+            r0, c0 = max(bbox[i, 0], bbox[j, 0]), max(bbox[i, 1], bbox[j, 1])
+            r1, c1 = min(bbox[i, 2], bbox[j, 2]), min(bbox[i, 3], bbox[j, 3])
+            inter = np.count_nonzero(
+                crops['mask'][i][r0 - bbox[i, 0]:r1 - bbox[i, 0], c0 - bbox[i, 1]:c1 - bbox[i, 1]] &
+                crops['mask'][j][r0 - bbox[j, 0]:r1 - bbox[j, 0], c0 - bbox[j, 1]:c1 - bbox[j, 1]])
+            if inter == 0:
+                continue
+            if inter / (area[i] + area[j] - inter) >= iou_trh or \
+                    ((crops['cut'][i] or crops['cut'][j]) and inter / min(area[i], area[j]) >= iou_trh):
+                parent[find(j)] = find(i)
+
+    groups = {}
+    for i in range(n):
+        groups.setdefault(find(i), []).append(i)
+    keep = []
+    bbox = bbox.copy()
+    masks = list(crops['mask'])
+    for g in groups.values():
+        best = max(g, key=lambda k: (not crops['cut'][k], area[k]))
+        if area[best] == 0:
+            continue  # empty once cropped to its tile, never a duplicate
+        if crops['cut'][best] and len(g) > 1:
+            r0, c0 = bbox[g, 0].min(), bbox[g, 1].min()
+            r1, c1 = bbox[g, 2].max(), bbox[g, 3].max()
+            union = np.zeros((r1 - r0, c1 - c0), dtype='bool')
+            for k in g:
+                union[bbox[k, 0] - r0:bbox[k, 2] - r0, bbox[k, 1] - c0:bbox[k, 3] - c0] |= masks[k]
+            bbox[best] = [r0, c0, r1, c1]
+            masks[best] = union
+        keep.append(best)
+    keep.sort()
+
+    label = np.zeros(shape, dtype='uint16')  # uint16 locks object detection within 65536
+    score = np.max(crops['conf'][keep], axis=1) if keep else np.zeros(0)
+    for k, i in enumerate(keep):
+        win = label[bbox[i, 0]:bbox[i, 2], bbox[i, 1]:bbox[i, 3]]
+        m = masks[i].copy()
+        for ori in np.unique(win[m]):
+            if ori != 0 and score[k] <= score[ori - 1]:
+                m[win == ori] = False
+        win[m] = k + 1
+    return label, crops['cls'][keep], crops['conf'][keep]
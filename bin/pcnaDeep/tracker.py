@@ -7,10 +7,161 @@ from skimage.util import img_as_uint
 from skimage.morphology import remove_small_objects
 import pandas as pd
 import numpy as np
-from pcnaDeep.data.utils import json2mask, expand_bbox, getDetectInput
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from pcnaDeep.data.utils import json2mask, getDetectInput, get_object_intensity, phase_codes, phase_labels, \
+    assign_by_component
 
+BACKENDS = ('trackpy', 'lap', 'online')
+ONLINE_POS_COLUMNS = ['Center_of_the_object_0', 'Center_of_the_object_1', 'BF_mean', 'BF_std']
 
-def track(df, displace=40, gap_fill=5):
+
+def _check_link_cost(search_range, pos_columns, weights, max_cost):
+    """Validate link cost parameters, see `link_lap()`.
+
+    Returns:
+        (numpy.ndarray, float): weights and cost cut-off, defaults filled.
+    """
+    if weights is None:
+        weights = np.ones(len(pos_columns))
+    weights = np.asarray(weights, dtype=float)
+    if weights.shape[0] != len(pos_columns) or np.any(weights < 0):
+        raise ValueError('Link cost needs one non-negative weight for each position column: ' + str(list(pos_columns)))
+    if max_cost is None:
+        max_cost = float(search_range) ** 2
+    if max_cost <= 0:
+        raise ValueError('Link cost cut-off must be positive, not ' + str(max_cost))
+    return weights, max_cost
+
+
+def link_lap(f, search_range, pos_columns, weights=None, max_cost=None):
+    """Link objects frame to frame by linear assignment, as an alternative to `trackpy.link()`.
+
+    Candidates of each object are searched in the next frame with a KD-tree on the first two position columns
+    (x, y), within `search_range`. A candidate link costs the weighted squared distance over all position columns,
+    `sum(weights * (a - b) ** 2)`, and is only considered below `max_cost`. Links of two consecutive frames are
+    assigned together with the minimum total of `cost - max_cost`, i.e. any link below the cut-off is preferred to
+    leaving both objects unlinked.
+
+    Args:
+        f (pandas.DataFrame): object table with `frame` and position columns.
+        search_range (float): maximum (x, y) displacement between consecutive frames.
+        pos_columns (list): position columns, the first two are taken as (x, y).
+        weights (list): weight of each position column in the link cost, default 1 for all.
+        max_cost (float): cost cut-off of a link, default `search_range ** 2`, i.e. the distance restriction of
+            `trackpy.link()` in the weighted space.
+
+    Returns:
+        (pandas.DataFrame): copy of the object table with track ID in column `particle`, from 0 in order of appearance.
+    """
+    weights, max_cost = _check_link_cost(search_range, pos_columns, weights, max_cost)
+    frame = f['frame'].values
+    order = np.argsort(frame, kind='stable')
+    feature = f[list(pos_columns)].values[order].astype(float) * np.sqrt(weights)
+    xy = f[list(pos_columns)[:2]].values[order].astype(float)
+    _, starts = np.unique(frame[order], return_index=True)
+    bounds = np.append(starts, frame.shape[0])
+
+    particle = np.zeros(frame.shape[0], dtype=int)
+    n_particle = 0
+    prev, prev_tree = None, None
+    for i in range(starts.shape[0]):
+        cur = np.arange(bounds[i], bounds[i + 1])
+        cur_tree = cKDTree(xy[cur])
+        assigned = np.zeros(cur.shape[0], dtype=bool)
+        if prev is not None:
+            pairs = prev_tree.sparse_distance_matrix(cur_tree, search_range, output_type='ndarray')
+            row, col = pairs['i'].astype(int), pairs['j'].astype(int)
+            cost = np.sum((feature[prev[row]] - feature[cur[col]]) ** 2, axis=1)
+            keep = cost < max_cost
+            row, col, _ = assign_by_component(row[keep], col[keep], cost[keep] - max_cost,
+                                              (prev.shape[0], cur.shape[0]))
+            particle[cur[col]] = particle[prev[row]]
+            assigned[col] = True
+        new = cur[~assigned]
+        particle[new] = np.arange(n_particle, n_particle + new.shape[0])
+        n_particle += new.shape[0]
+        prev, prev_tree = cur, cur_tree
+
+    out = f.copy()
+    out['particle'] = 0
+    out.iloc[order, out.columns.get_loc('particle')] = particle
+    return out
+
+
+def close_gaps(t, search_range, pos_columns, gap_fill, weights=None, max_cost=None):
+    """Join linked track segments over gaps, the second stage after frame to frame linking.
+
+    The end of each segment is a candidate to the start of another segment that appears 2 to `gap_fill + 1` frames
+    later, within `search_range` (x, y). A candidate costs as a link in `link_lap()`, multiplied by the number of
+    missing frames, so that the shorter gap is preferred, and is only considered below `max_cost`. All segment ends and
+    starts of the movie are assigned together in one sparse assignment. Linking time hardly grows with `gap_fill`,
+    as lost objects are not carried through the following frames.
+
+    Args:
+        t (pandas.DataFrame): linked object table with `frame`, position columns and track ID in column `particle`.
+        search_range (float): maximum (x, y) displacement over a gap.
+        pos_columns (list): position columns, the first two are taken as (x, y).
+        gap_fill (int): maximum number of frames a track can be missing.
+        weights (list): weight of each position column in the link cost, default 1 for all.
+        max_cost (float): cost cut-off of a link, default `search_range ** 2`.
+
+    Returns:
+        (pandas.DataFrame): copy of the object table, joined segments share `particle`, renumbered from 0 in the order
+            of their first segment.
+    """
+    weights, max_cost = _check_link_cost(search_range, pos_columns, weights, max_cost)
+    out = t.copy()
+    frame = t['frame'].values
+    particle = t['particle'].values
+    feature = t[list(pos_columns)].values.astype(float) * np.sqrt(weights)
+    xy = t[list(pos_columns)[:2]].values.astype(float)
+
+    # first (head) and last (tail) object of each segment
+    order = np.lexsort((frame, particle))
+    ids, first, count = np.unique(particle[order], return_index=True, return_counts=True)
+    head = order[first]
+    tail = order[first + count - 1]
+    head_order = np.argsort(frame[head], kind='stable')
+    tail_order = np.argsort(frame[tail], kind='stable')
+    head_frame = frame[head][head_order]
+    tail_frame = frame[tail][tail_order]
+
+    # candidates are searched for segment starts of one frame at a time, among tails 2 ~ gap_fill + 1 frames before
+    row, col = [], []
+    fr, fr_start = np.unique(head_frame, return_index=True)
+    fr_bound = np.append(fr_start, head_frame.shape[0])
+    for i in range(fr.shape[0]):
+        lo = np.searchsorted(tail_frame, fr[i] - gap_fill - 1, side='left')
+        hi = np.searchsorted(tail_frame, fr[i] - 2, side='right')
+        if lo >= hi:
+            continue
+        ts = tail_order[lo:hi]
+        hs = head_order[fr_bound[i]:fr_bound[i + 1]]
+        pairs = cKDTree(xy[tail[ts]]).sparse_distance_matrix(cKDTree(xy[head[hs]]), search_range,
+                                                              output_type='ndarray')
+        row.append(ts[pairs['i'].astype(int)])
+        col.append(hs[pairs['j'].astype(int)])
+    if not row:
+        return out
+    row = np.concatenate(row)
+    col = np.concatenate(col)
+    cost = np.sum((feature[tail[row]] - feature[head[col]]) ** 2, axis=1) * (frame[head[col]] - frame[tail[row]] - 1)
+    keep = cost < max_cost
+    row, col, _ = assign_by_component(row[keep], col[keep], cost[keep] - max_cost, (ids.shape[0], ids.shape[0]))
+
+    # joined segments form chains, take the ID of the first segment and renumber in order of appearance
+    graph = coo_matrix((np.ones(row.shape[0]), (row, col)), shape=(ids.shape[0], ids.shape[0]))
+    _, chain = connected_components(graph, directed=False)
+    root = np.full(chain.max() + 1, ids.max())
+    np.minimum.at(root, chain, ids)
+    _, joined = np.unique(root[chain], return_inverse=True)
+    out['particle'] = joined[np.searchsorted(ids, particle)]
+    return out
+
+
+def track(df, displace=40, gap_fill=5, backend='trackpy', weights=None, max_cost=None):
     """Track and relabel mask with trackID.
 
     Args:
@@ -23,40 +174,176 @@ def track(df, displace=40, gap_fill=5):
             - (other optional columns)
 
         displace (int): maximum distance an object can move between frames.
-        gap_fill (int): temporal filling fo tracks.
+        gap_fill (int): temporal filling fo tracks. With the 'lap' backend, gaps are closed after linking with
+            `close_gaps()`, no gap closing if 0.
+        backend (str): linking backend, 'trackpy' (`trackpy.link()`), 'lap' (`link_lap()`) or 'online'
+            (`OnlineTracker`, frames are fed in order).
+        weights (list): 'lap' and 'online' backends only, link cost weights of (x, y, BF_mean, BF_std), see `link_lap()`.
+        max_cost (float): 'lap' and 'online' backends only, link cost cut-off, see `link_lap()`.
     
     Return:
-        (pandas.DataFrame): tracked object table.
+        (pandas.DataFrame): tracked object table, `predicted_class` as categorical of `PHASE_NAMES`.
     """
     TRACK_WITH_DIC = True
 
-    f = df[['Center_of_the_object_0', 'Center_of_the_object_1', 'BF_mean', 'BF_std', 'frame']]
+    f = df[['Center_of_the_object_0', 'Center_of_the_object_1', 'BF_mean', 'BF_std', 'frame']].reset_index(drop=True)
     f.columns = ['x', 'y', 'BF_mean', 'BF_std', 'frame']
     if TRACK_WITH_DIC:
         pc = f.columns[:-1]
     else:
         pc = ['x','y']
-    t = tp.link(f, search_range=displace, memory=gap_fill, adaptive_stop=0.4 * displace, pos_columns=pc)
-    t.columns = ['Center_of_the_object_0', 'Center_of_the_object_1', 'BF_mean', 'BF_std', 'frame', 'trackId']
-    out = pd.merge(df, t, on=['Center_of_the_object_0', 'Center_of_the_object_1', 'BF_mean', 'BF_std', 'frame'])
-    #  change format for downstream
-    out['trackId'] += 1
-    out['lineageId'] = out['trackId']
-    out['parentTrackId'] = 0
-    out = out[
-        ['frame', 'trackId', 'lineageId', 'parentTrackId', 'Center_of_the_object_0', 'Center_of_the_object_1', 'phase',
-         'Probability of G1/G2', 'Probability of S', 'Probability of M', 'continuous_label', 'major_axis', 'minor_axis',
-         'mean_intensity', 'emerging', 'background_mean', 'BF_mean', 'BF_std']]
-    names = list(out.columns)
-    names[4] = 'Center_of_the_object_1'
-    names[5] = 'Center_of_the_object_0'
-    names[6] = 'predicted_class'
-    out.columns = names
+    if backend == 'trackpy':
+        t = tp.link(f, search_range=displace, memory=gap_fill, adaptive_stop=0.4 * displace, pos_columns=pc)
+    elif backend == 'online':
+        tracker = OnlineTracker(displace=displace, gap_fill=gap_fill, weights=weights, max_cost=max_cost)
+        out = [tracker.update(df.iloc[idx]) for idx in df.groupby('frame', sort=True).indices.values()]
+        tracker.finish()
+        return pd.concat(out, ignore_index=True).sort_values(by=['trackId', 'frame'])
+    elif backend == 'lap':
+        if weights is not None and not TRACK_WITH_DIC:
+            weights = weights[:2]
+        t = link_lap(f, search_range=displace, pos_columns=pc, weights=weights, max_cost=max_cost)
+        if gap_fill > 0:
+            t = close_gaps(t, search_range=displace, pos_columns=pc, gap_fill=gap_fill, weights=weights,
+                           max_cost=max_cost)
+    else:
+        raise ValueError('Tracker backend must be one of ' + str(BACKENDS) + ', not ' + str(backend))
+    # linkers keep the row index of the object table, assign track IDs back by position
+    trk = t['particle'].reindex(f.index).values + 1
+    out = _format_track(df, trk)
     out = out.sort_values(by=['trackId', 'frame'])
 
     return out
 
 
+def _format_track(df, trk):
+    """Object table in the output format of `track()`, unsorted.
+
+    Args:
+        df (pandas.DataFrame): object table, see `track()`.
+        trk (numpy.ndarray): track ID of each row.
+    """
+    #  change format for downstream, labels of the two center coordinates are swapped
+    out = df[['frame', 'Center_of_the_object_0', 'Center_of_the_object_1', 'phase', 'Probability of G1/G2',
+              'Probability of S', 'Probability of M', 'continuous_label', 'major_axis', 'minor_axis', 'mean_intensity',
+              'emerging', 'background_mean', 'BF_mean', 'BF_std']].reset_index(drop=True)
+    out.columns = ['frame', 'Center_of_the_object_1', 'Center_of_the_object_0', 'predicted_class',
+                   'Probability of G1/G2', 'Probability of S', 'Probability of M', 'continuous_label', 'major_axis',
+                   'minor_axis', 'mean_intensity', 'emerging', 'background_mean', 'BF_mean', 'BF_std']
+    out.insert(1, 'trackId', trk)
+    out.insert(2, 'lineageId', trk)
+    out.insert(3, 'parentTrackId', 0)
+    if not pd.api.types.is_numeric_dtype(out['predicted_class']):
+        # categorical phases, codes are used downstream and names are written out
+        out['predicted_class'] = phase_labels(phase_codes(out['predicted_class']))
+    return out
+
+
+class OnlineTracker:
+
+    def __init__(self, displace=40, gap_fill=5, weights=None, max_cost=None):
+        """Track objects frame by frame as they are detected, the incremental counterpart of `track()`.
+
+        Objects of each new frame are first linked to tracks of the previous frame as in `link_lap()`, the rest are
+        then joined to tracks lost 2 to `gap_fill + 1` frames before as in `close_gaps()`. Gaps are assigned one frame
+        at a time rather than over the whole movie, so results may slightly differ from the 'lap' backend. Only the
+        last object of tracks lost for no more than `gap_fill` frames is kept for linking. Track IDs are final once
+        assigned, so objects are returned by `update()` as soon as they are linked and nothing else is held.
+
+        Args:
+            displace (float): maximum distance an object can move between frames, see `track()`.
+            gap_fill (int): maximum number of frames a track can be missing.
+            weights (list): link cost weights of (x, y, BF_mean, BF_std), see `link_lap()`.
+            max_cost (float): link cost cut-off, see `link_lap()`.
+        """
+        self.displace = float(displace)
+        self.gap_fill = int(gap_fill)
+        if self.gap_fill < 0:
+            raise ValueError('Tracker gap fill should not be negative, not ' + str(gap_fill))
+        self.weights, self.max_cost = _check_link_cost(displace, ONLINE_POS_COLUMNS, weights, max_cost)
+        self._scale = np.sqrt(self.weights)
+        self.frame = None  # last frame linked
+        self.n_track = 0
+        # last object of each track in the window
+        self._tail_id = np.zeros(0, dtype=int)
+        self._tail_frame = np.zeros(0, dtype=int)
+        self._tail_xy = np.zeros((0, 2))
+        self._tail_feature = np.zeros((0, len(ONLINE_POS_COLUMNS)))
+
+    def update(self, props, frame=None):
+        """Link objects of the next frame.
+
+        Args:
+            props (pandas.DataFrame): object table of one frame, e.g. `out_props` of `predictFrame()`, see `track()`.
+            frame (int): frame index, required if `props` is empty, default from the `frame` column.
+
+        Returns:
+            (pandas.DataFrame): objects of the frame with their track IDs, in the format of `track()`, may be empty.
+        """
+        if frame is None:
+            if props.shape[0] == 0:
+                raise ValueError('Frame index is required for a frame without objects.')
+            frame = props['frame'].iloc[0]
+        frame = int(frame)
+        if np.any(props['frame'].values != frame):
+            raise ValueError('Objects must come from the single frame ' + str(frame) + '.')
+        if self.frame is not None and frame <= self.frame:
+            raise ValueError('Frames must arrive in order, got frame ' + str(frame) + ' after ' + str(self.frame))
+        self.frame = frame
+
+        feature = props[ONLINE_POS_COLUMNS].values.astype(float) * self._scale
+        xy = props[ONLINE_POS_COLUMNS[:2]].values.astype(float)
+        trk = np.zeros(props.shape[0], dtype=int)
+        tail_used = np.zeros(self._tail_id.shape[0], dtype=bool)
+        # frame to frame links first, then over gaps among objects left
+        for gap in [False, True]:
+            if gap:
+                ts = np.flatnonzero((self._tail_frame <= frame - 2) & ~tail_used)
+            else:
+                ts = np.flatnonzero(self._tail_frame == frame - 1)
+            hs = np.flatnonzero(trk == 0)
+            if ts.shape[0] == 0 or hs.shape[0] == 0:
+                continue
+            pairs = cKDTree(self._tail_xy[ts]).sparse_distance_matrix(cKDTree(xy[hs]), self.displace,
+                                                                      output_type='ndarray')
+            row, col = pairs['i'].astype(int), pairs['j'].astype(int)
+            cost = np.sum((self._tail_feature[ts[row]] - feature[hs[col]]) ** 2, axis=1)
+            if gap:
+                cost = cost * (frame - self._tail_frame[ts[row]] - 1)
+            keep = cost < self.max_cost
+            row, col, _ = assign_by_component(row[keep], col[keep], cost[keep] - self.max_cost,
+                                              (ts.shape[0], hs.shape[0]))
+            row, col = ts[row], hs[col]
+            trk[col] = self._tail_id[row]
+            tail_used[row] = True
+            self._tail_frame[row] = frame
+            self._tail_xy[row] = xy[col]
+            self._tail_feature[row] = feature[col]
+
+        # objects left start new tracks
+        new = np.flatnonzero(trk == 0)
+        trk[new] = np.arange(self.n_track + 1, self.n_track + new.shape[0] + 1)
+        self.n_track += new.shape[0]
+        self._tail_id = np.append(self._tail_id, trk[new])
+        self._tail_frame = np.append(self._tail_frame, np.full(new.shape[0], frame))
+        self._tail_xy = np.concatenate([self._tail_xy, xy[new]])
+        self._tail_feature = np.concatenate([self._tail_feature, feature[new]])
+
+        # tracks lost for more than gap_fill frames can not be joined by the next frame
+        live = self._tail_frame >= frame - self.gap_fill
+        if not np.all(live):
+            self._tail_id = self._tail_id[live]
+            self._tail_frame = self._tail_frame[live]
+            self._tail_xy = self._tail_xy[live]
+            self._tail_feature = self._tail_feature[live]
+        return _format_track(props, trk)
+
+    def finish(self):
+        """End the movie and reset the tracker, track IDs start over from 1.
+        """
+        self.__init__(self.displace, self.gap_fill, self.weights, self.max_cost)
+
+
 def track_mask(mask, displace=40, gap_fill=5, render_phase=False, size_min=100, PCNA_intensity=None, BF_intensity=None):
     """Track binary mask objects.
 
@@ -78,8 +365,6 @@ def track_mask(mask, displace=40, gap_fill=5, render_phase=False, size_min=100,
     PHASE_DIC = {10: 'G1/G2', 50: 'S', 100: 'M', 200: 'G1/G2'}
     p = pd.DataFrame()
     mask_lbd = np.zeros(mask.shape)
-    h = mask.shape[1]
-    w = mask.shape[2]
     
     for i in range(mask.shape[0]):
         # remove small objects
@@ -110,10 +395,6 @@ def track_mask(mask, displace=40, gap_fill=5, render_phase=False, size_min=100,
         probS = []
         probM = []
         e = []
-        background = []
-        its = []
-        dic_mean = []
-        dic_std = []
 
         for k in range(props.shape[0]):
             if render_phase:
@@ -142,21 +423,10 @@ def track_mask(mask, displace=40, gap_fill=5, render_phase=False, size_min=100,
                 probM.append(0)
                 e.append(0)
                 phase.append(0)
-            # extract intensity
-            b1, b3, b2, b4 = expand_bbox((props.iloc[k][0], props.iloc[k][1],
-                                          props.iloc[k][2], props.iloc[k][3]), BBOX_FACTOR, (h,w))
-            lbd = int(props.iloc[k][6])
-            obj_region = mask_lbd[i, b1:b2, b3:b4].copy()
-            its_region = PCNA_intensity[i, b1:b2, b3:b4].copy()
-            dic_region = BF_intensity[i, b1:b2, b3:b4].copy()
-            if 0 not in obj_region:
-                background.append(0)
-            else:
-                background.append(np.mean(its_region[obj_region == 0]))
-            cal = obj_region == lbd
-            its.append(np.mean(its_region[cal]))
-            dic_mean.append(np.mean(dic_region[cal]))
-            dic_std.append(np.std(dic_region[cal]))
+        # extract intensity
+        its = get_object_intensity(mask_lbd[i, :, :], props['continuous_label'].values,
+                                   props[['bbox-0', 'bbox-1', 'bbox-2', 'bbox-3']].values,
+                                   PCNA_intensity[i, :, :], BF_intensity[i, :, :], bbox_factor=BBOX_FACTOR)
 
         props['Probability of G1/G2'] = probG
         props['Probability of S'] = probS
@@ -164,10 +434,10 @@ def track_mask(mask, displace=40, gap_fill=5, render_phase=False, size_min=100,
         props['emerging'] = e
         props['phase'] = phase
         props['frame'] = i
-        props['mean_intensity'] = its
-        props['background_mean'] = background
-        props['BF_mean'] = dic_mean
-        props['BF_std'] = dic_std
+        props['mean_intensity'] = its['mean_intensity']
+        props['background_mean'] = np.nan_to_num(its['background_mean'], nan=0)
+        props['BF_mean'] = its['BF_mean']
+        props['BF_std'] = its['BF_std']
         del props['max_intensity'], props['bbox-0'], props['bbox-1'], props['bbox-2'], props['bbox-3']
         p = p.append(props)
 
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+import argparse
+import copy
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import time
+import yaml
+import numpy as np
+import pandas as pd
+from sklearn.metrics import f1_score
+from pcnaDeep.refiner import Refiner
+from pcnaDeep.resolver import Resolver
+from pcnaDeep.data.utils import MaskStore
+
+# grid keys only used by the resolver, settings differing only in them share one refinement
+RESOLVER_KEYS = ('POST_PROCESS.MIN_S', 'POST_PROCESS.RESOLVER.')
+PHASES = ['G1', 'S', 'M', 'G2']
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Sweep Refiner and Resolver parameters on a tracked object table.")
+    parser.add_argument(
+        "tracks",
+        help="Tracked object table, i.e. the `_tracks.csv` output.",
+    )
+    parser.add_argument(
+        "--grid",
+        required=True,
+        metavar="FILE",
+        help="YAML file of parameter values to sweep, config keys (nested or dot separated, e.g. "
+             "POST_PROCESS.REFINER.SMOOTH) mapped to lists of values. All combinations are run.",
+    )
+    parser.add_argument(
+        "--pcna-config",
+        default="../config/pcnaCfg.yaml",
+        metavar="FILE",
+        help="path to pcnaDeep config file, parameters not in the grid are taken from it",
+    )
+    parser.add_argument(
+        "--mask",
+        default=None,
+        help="Optional mask of the tracked table (`_mask.tif`), required if the mask constraint is enabled.",
+    )
+    parser.add_argument(
+        "--gt",
+        default=None,
+        help="Optional ground truth table of the same objects with column `resolved_class`, e.g. the corrected "
+             "`_tracks_refined.csv`. Objects are matched by frame and continuous_label.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of processes, each refines and resolves one setting at a time.",
+    )
+    parser.add_argument(
+        "--output",
+        required=True,
+        help="Csv file to save the summary, one row per setting.",
+    )
+    return parser
+
+
+def flatten_grid(grid, prefix=''):
+    """Flatten nested grid config into dot separated keys.
+
+    Returns:
+        (dict): key to list of values.
+    """
+    out = {}
+    for k, v in grid.items():
+        if isinstance(v, dict):
+            out.update(flatten_grid(v, prefix + str(k) + '.'))
+        else:
+            out[prefix + str(k)] = v if isinstance(v, list) else [v]
+    return out
+
+
+def set_param(config, key, value):
+    """Set a dot separated key in the nested config.
+    """
+    keys = key.split('.')
+    ref = config
+    for k in keys[:-1]:
+        ref = ref[k]
+    if keys[-1] not in ref:
+        raise KeyError('Field not found in config file: ' + key)
+    ref[keys[-1]] = value
+
+
+def get_refiner(track, config, mask=None):
+    """Refiner of the config, see `main.py`.
+    """
+    post_cfg = config['POST_PROCESS']
+    refiner_cfg = post_cfg['REFINER']
+    df = None
+    if bool(refiner_cfg['MASK_CONSTRAINT']['ENABLED']):
+        if mask is None:
+            raise ValueError('Mask constraint enabled, mask is required.')
+        df = float(refiner_cfg['MASK_CONSTRAINT']['DILATE_FACTOR'])
+    else:
+        mask = None
+    return Refiner(track, threshold_mt_F=int(refiner_cfg['MAX_DIST_TRH']),
+                   threshold_mt_T=int(refiner_cfg['MAX_FRAME_TRH']), smooth=int(refiner_cfg['SMOOTH']),
+                   maxBG=float(post_cfg['MAX_BG']), minM=float(post_cfg['MIN_M']),
+                   search_range=int(refiner_cfg['SEARCH_RANGE']), sample_freq=float(refiner_cfg['SAMPLE_FREQ']),
+                   model_train=refiner_cfg['SVM_TRAIN_DATA'], svm_c=int(refiner_cfg['C']), mode=refiner_cfg['MODE'],
+                   mask=mask, dilate_factor=df, aso_trh=float(refiner_cfg['ASO_TRH']),
+                   dist_weight=float(refiner_cfg['DIST_WEIGHT']), gate=bool(refiner_cfg['GATE']))
+
+
+def get_resolver(track, ann, mt_dic, imprecise, config):
+    """Resolver of the config, see `main.py`. Runs in a single process.
+    """
+    post_cfg = config['POST_PROCESS']
+    return Resolver(track, ann, mt_dic, maxBG=float(post_cfg['MAX_BG']), minS=float(post_cfg['MIN_S']),
+                    minM=float(post_cfg['MIN_M']), minLineage=int(post_cfg['RESOLVER']['MIN_LINEAGE']),
+                    impreciseExit=imprecise, G2_trh=int(post_cfg['RESOLVER']['G2_TRH']), workers=1)
+
+
+def summarize_phase(phase):
+    """Statistics of complete phase durations, incomplete ones (`>n`) are excluded.
+
+    Returns:
+        (dict): number of tracks and arrested tracks, count, mean, median and standard deviation of each phase.
+    """
+    out = {'tracks': phase.shape[0], 'arrest': int(np.sum(phase['type'] != 'normal'))}
+    for p in PHASES:
+        v = pd.to_numeric(phase[p], errors='coerce').dropna().values
+        out[p + '_n'] = v.shape[0]
+        out[p + '_mean'] = np.mean(v) if v.shape[0] else np.nan
+        out[p + '_median'] = np.median(v) if v.shape[0] else np.nan
+        out[p + '_std'] = np.std(v) if v.shape[0] else np.nan
+    return out
+
+
+def score_phase(track_rsd, gt):
+    """Accuracy of resolved classes against the ground truth, on objects matched by frame and continuous_label.
+
+    Returns:
+        (dict): matched object count, accuracy and macro F1 score.
+    """
+    m = track_rsd[['frame', 'continuous_label', 'resolved_class']].merge(
+        gt[['frame', 'continuous_label', 'resolved_class']], on=['frame', 'continuous_label'], suffixes=('', '_gt'))
+    pred = m['resolved_class'].astype(str).values
+    true = m['resolved_class_gt'].astype(str).values
+    if m.shape[0] == 0:
+        return {'matched': 0, 'accuracy': np.nan, 'macro_f1': np.nan}
+    return {'matched': m.shape[0], 'accuracy': np.mean(pred == true),
+            'macro_f1': f1_score(true, pred, labels=np.unique(true), average='macro')}
+
+
+_worker_inputs = None
+
+
+def _init_sweep_worker(track, mask_fp, gt):
+    """Hold the inputs shared by all settings in a worker process, the mask is memory-mapped from disk.
+    """
+    global _worker_inputs
+    logging.getLogger('pcna').setLevel(logging.ERROR)
+    mask = MaskStore(mask_fp) if mask_fp is not None else None
+    _worker_inputs = (track, mask, gt)
+
+
+def _run_group(configs):
+    """Refine once and resolve each setting of a group sharing the Refiner parameters.
+
+    Args:
+        configs (list): (setting index, config) pairs.
+
+    Returns:
+        (list): (setting index, summary) pairs.
+    """
+    track, mask, gt = _worker_inputs
+    out = []
+    start = time.time()
+    try:
+        ann, track_rfd, mt_dic, imprecise = get_refiner(track.copy(), configs[0][1], mask).doTrackRefine()
+    except Exception as e:
+        return [(i, {'error': 'Refiner ' + type(e).__name__ + ': ' + str(e)}) for i, _ in configs]
+    refine_time = time.time() - start
+    for i, config in configs:
+        start = time.time()
+        try:
+            track_rsd, phase = get_resolver(track_rfd.copy(), ann.copy(), copy.deepcopy(mt_dic), imprecise,
+                                            config).doResolve()
+        except Exception as e:
+            out.append((i, {'error': 'Resolver ' + type(e).__name__ + ': ' + str(e)}))
+            continue
+        rec = summarize_phase(phase)
+        if gt is not None:
+            rec.update(score_phase(track_rsd, gt))
+        rec['refine_time'] = refine_time
+        rec['resolve_time'] = time.time() - start
+        rec['error'] = ''
+        out.append((i, rec))
+    return out
+
+
+def sweep(track, config, grid, mask_fp=None, gt=None, workers=1):
+    """Run Refiner and Resolver for every combination of grid values.
+
+    Args:
+        track (pandas.DataFrame): tracked object table.
+        config (dict): base pcnaDeep config.
+        grid (dict): dot separated config key to list of values, see `flatten_grid()`.
+        mask_fp (str): optional, path to the mask.
+        gt (pandas.DataFrame): optional, ground truth table with `resolved_class`, see `score_phase()`.
+        workers (int): number of processes.
+
+    Returns:
+        (pandas.DataFrame): grid values and summary of each setting.
+    """
+    keys = list(grid.keys())
+    settings = list(itertools.product(*[grid[k] for k in keys]))
+    refine_keys = [j for j, k in enumerate(keys) if not k.startswith(RESOLVER_KEYS)]
+    groups = {}
+    for i, values in enumerate(settings):
+        cfg = copy.deepcopy(config)
+        for k, v in zip(keys, values):
+            set_param(cfg, k, v)
+        groups.setdefault(tuple([str(values[j]) for j in refine_keys]), []).append((i, cfg))
+    groups = list(groups.values())
+
+    results = {}
+    if workers > 1 and len(groups) > 1:
+        with mp.Pool(min(workers, len(groups)), initializer=_init_sweep_worker,
+                     initargs=(track, mask_fp, gt)) as pool:
+            for res in pool.imap_unordered(_run_group, groups):
+                results.update(dict(res))
+    else:
+        # the initializer silences pipeline logs, restore them for the caller afterwards
+        logger = logging.getLogger('pcna')
+        level = logger.level
+        try:
+            _init_sweep_worker(track, mask_fp, gt)
+            for g in groups:
+                results.update(dict(_run_group(g)))
+        finally:
+            logger.setLevel(level)
+
+    out = pd.DataFrame(settings, columns=keys)
+    summary = pd.DataFrame([results[i] for i in range(len(settings))])
+    return pd.concat([out, summary], axis=1)
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+    with open(args.pcna_config, 'r') as f:
+        pcna_cfg = yaml.safe_load(f)
+    with open(args.grid, 'r') as f:
+        grid = flatten_grid(yaml.safe_load(f))
+    track = pd.read_csv(args.tracks)
+    gt = pd.read_csv(args.gt) if args.gt is not None else None
+
+    start = time.time()
+    out = sweep(track, pcna_cfg, grid, mask_fp=args.mask, gt=gt, workers=args.workers)
+    out.to_csv(args.output, index=False)
+    print(out.to_string(index=False))
+    print('{} settings in {:.2f}s'.format(out.shape[0], time.time() - start))
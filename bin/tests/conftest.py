@@ -0,0 +1,5 @@
+import os
+import sys
+
+# scripts and the pcnaDeep package live in bin/, as when running from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
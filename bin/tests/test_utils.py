@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import threading
+import time
+import numpy as np
+import pytest
+import tifffile
+import pcnaDeep.data.utils as utils
+from pcnaDeep.data.utils import PHASES, WatchStack, deduce_transition, deduce_transition_batch, getDetectInputFrame
+
+
+def random_tracks(rng, n, max_len, values=None):
+    """Ragged tracks of predicted phases, concatenated with their offsets.
+
+    Args:
+        values (numpy.ndarray): optional, draw confidences from these values instead of uniformly.
+    """
+    lengths = rng.integers(0, max_len + 1, size=n)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    # runs of the same phase, so that target phases span several frames
+    cls = np.repeat(rng.integers(0, len(PHASES), size=offsets[-1]), rng.integers(1, 6, size=offsets[-1]))
+    cls = cls[:offsets[-1]]
+    if values is None:
+        confidence = rng.random((offsets[-1], len(PHASES)))
+    else:
+        confidence = rng.choice(values, size=(offsets[-1], len(PHASES)))
+    return cls, confidence, offsets
+
+
+def reference(cls, confidence, offsets, tar, min_tar, max_res, escape, casual_end):
+    entry, m_exit = [], []
+    for t in range(offsets.shape[0] - 1):
+        s, e = offsets[t], offsets[t + 1]
+        esc = escape[t] if np.ndim(escape) else escape
+        out = deduce_transition(cls[s:e], tar, confidence[s:e], min_tar, max_res, escape=esc,
+                                casual_end=casual_end)
+        entry.append(out[0] if out is not None else -1)
+        m_exit.append(out[1] if out is not None else -1)
+    return np.array(entry), np.array(m_exit)
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('tar', ['M', 'S'])
+@pytest.mark.parametrize('casual_end', [True, False])
+def test_deduce_transition_batch(seed, tar, casual_end):
+    rng = np.random.default_rng(seed)
+    cls, confidence, offsets = random_tracks(rng, 200, 60)
+    escape = rng.integers(0, 4, size=offsets.shape[0] - 1)
+    for min_tar, max_res in [(1, 1), (2, 3), (4, 10)]:
+        for esc in [0, escape]:
+            expected = reference(cls, confidence, offsets, tar, min_tar, max_res, esc, casual_end)
+            entry, m_exit = deduce_transition_batch(cls, confidence, offsets, tar, min_tar, max_res,
+                                                    escape=esc, casual_end=casual_end)
+            np.testing.assert_array_equal(entry, expected[0])
+            np.testing.assert_array_equal(m_exit, expected[1])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_deduce_transition_batch_near_max_res(seed, monkeypatch):
+    # decimal confidences accumulate to values within rounding error of max_res, e.g. 0.1 + 0.2 vs 0.3
+    rng = np.random.default_rng(seed)
+    cls, confidence, offsets = random_tracks(rng, 300, 40, values=np.array([0.1, 0.2, 0.3, 0.7]))
+    fallback = []
+
+    def counted(*args, **kwargs):
+        fallback.append(1)
+        return deduce_transition(*args, **kwargs)
+
+    monkeypatch.setattr(utils, 'deduce_transition', counted)
+    for max_res in [0.3, 0.6, 0.7, 1.1]:
+        expected = reference(cls, confidence, offsets, 'M', 0.6, max_res, 0, True)
+        entry, m_exit = deduce_transition_batch(cls, confidence, offsets, 'M', 0.6, max_res)
+        np.testing.assert_array_equal(entry, expected[0])
+        np.testing.assert_array_equal(m_exit, expected[1])
+    assert len(fallback) > 0
+
+
+def test_deduce_transition_batch_names():
+    cls = np.array(['G1/G2', 'M', 'M', 'G1/G2', 'M', 'M', 'S', 'M'])
+    confidence = np.full((cls.shape[0], len(PHASES)), 0.9)
+    offsets = np.array([0, 0, 3, 8])
+    entry, m_exit = deduce_transition_batch(cls, confidence, offsets, 'M', 1, 2)
+    expected = reference(cls, confidence, offsets, 'M', 1, 2, 0, True)
+    np.testing.assert_array_equal(entry, expected[0])
+    np.testing.assert_array_equal(m_exit, expected[1])
+    assert entry[0] == -1 and m_exit[0] == -1
+
+
+def test_deduce_transition_batch_offsets():
+    cls = np.zeros(4, dtype=int)
+    confidence = np.ones((4, len(PHASES)))
+    with pytest.raises(ValueError):
+        deduce_transition_batch(cls, confidence, [0, 3], 'M', 1, 1)
+
+
+def write_frames(dirs, names, frames, pause, end_mark=None):
+    """Write each frame file in two steps, as an acquisition software still writing it, then mark the end.
+
+    Args:
+        dirs (list): directories, frames are tuples of one image per directory.
+    """
+    for name, imgs in zip(names, frames):
+        for d, img in zip(dirs, imgs):
+            buf = io.BytesIO()
+            tifffile.imwrite(buf, img)
+            data = buf.getvalue()
+            with open(os.path.join(d, name), 'wb') as f:
+                f.write(data[:len(data) // 2])
+                f.flush()
+                time.sleep(pause)
+                f.write(data[len(data) // 2:])
+        time.sleep(pause)
+    if end_mark is not None:
+        open(os.path.join(dirs[0], end_mark), 'w').close()
+
+
+def test_watch_stack(tmp_path):
+    rng = np.random.default_rng(0)
+    dirs = [str(tmp_path / 'pcna'), str(tmp_path / 'dic')]
+    for d in dirs:
+        os.mkdir(d)
+    # natural order, t2 before t10
+    names = ['t1.tif', 't2.tif', 't10.tif']
+    frames = [(rng.integers(0, 60000, (64, 48), dtype='uint16'), rng.integers(0, 60000, (64, 48), dtype='uint16'))
+              for _ in names]
+    writer = threading.Thread(target=write_frames, args=(dirs, names, frames, 0.2, 'END'))
+    start = time.time()
+    writer.start()
+    out = list(WatchStack(dirs[0], dirs[1], gamma=0.8, sat=2, poll=0.02, timeout=10))
+    writer.join()
+
+    # ends on the mark, not the timeout
+    assert time.time() - start < 10
+    assert len(out) == len(frames)
+    for img, (pcna, dic) in zip(out, frames):
+        np.testing.assert_array_equal(img, getDetectInputFrame(pcna, dic, gamma=0.8, sat=2))
+
+
+def test_watch_stack_timeout(tmp_path):
+    rng = np.random.default_rng(1)
+    frames = [(rng.integers(0, 255, (32, 32, 3), dtype='uint8'),) for _ in range(2)]
+    writer = threading.Thread(target=write_frames, args=([str(tmp_path)], ['a1.tif', 'a2.tif'], frames, 0.1))
+    start = time.time()
+    writer.start()
+    out = list(WatchStack(str(tmp_path), poll=0.02, timeout=0.5))
+    writer.join()
+
+    assert time.time() - start >= 0.5
+    assert len(out) == len(frames)
+    for img, (composite,) in zip(out, frames):
+        np.testing.assert_array_equal(img, composite)
+
+
+def test_watch_stack_input(tmp_path):
+    with pytest.raises(ValueError):
+        WatchStack(str(tmp_path / 'missing'))